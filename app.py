@@ -1,39 +1,57 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Request, g, render_template, request, jsonify, send_file, Response, stream_with_context
 import os
+import tempfile
 import sqlite3
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 import json
+import threading
+import multiprocessing
+import re
+import time
+import hashlib
+import shutil
+import queue
+import zipfile
+import base64
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 try:
     from dotenv import load_dotenv
     load_dotenv()
+    DOTENV_DISPONIBLE = True
 except ImportError:
-    print("python-dotenv no está disponible, usando variables de entorno del sistema")
+    DOTENV_DISPONIBLE = False
 
-try:
-    import requests
-except ImportError:
-    print("requests no está disponible, instalando...")
-    import subprocess
-    import sys
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "requests==2.31.0"])
-    import requests
+import logging
+
+import observabilidad
+
+# Logging estructurado: nivel y proporción de los eventos de cada petición que se registran
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO")
+LOG_MUESTREO = float(os.getenv("LOG_MUESTREO", "0.1"))
+observabilidad.configurar_logging(LOG_NIVEL, LOG_MUESTREO)
+logger = logging.getLogger(__name__)
+
+def registrar(nivel, evento, muestrear=False, exc_info=False, **campos):
+    """Registra un evento con campos; los de cada petición se muestrean"""
+    logger.log(nivel, evento, exc_info=exc_info, extra={'campos': campos, 'muestrear': muestrear})
+
+if not DOTENV_DISPONIBLE:
+    registrar(logging.INFO, "python-dotenv no está disponible, usando variables de entorno del sistema")
+
+import extraccion
+import resumen_paginas
+from cache_imagenes import CacheImagenes
+from cliente_llm import ClienteLLM, ErrorLLM, LimiteConcurrencia
 
 try:
-    import PyPDF2
-    import fitz  # PyMuPDF
-    from PIL import Image
+    import indice_vectorial
+    VECTORES_DISPONIBLE = True
 except ImportError:
-    print("PyPDF2, PyMuPDF o Pillow no están disponibles, instalando...")
-    import subprocess
-    import sys
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "PyPDF2==3.0.1", "pymupdf==1.23.26", "Pillow==10.0.1"])
-    import PyPDF2
-    import fitz
-    from PIL import Image
-
-import logging
+    registrar(logging.WARNING, "numpy no está disponible, la búsqueda semántica queda desactivada")
+    VECTORES_DISPONIBLE = False
 
 # Cargar variables de entorno
 
@@ -42,25 +60,170 @@ app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__fil
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB máximo
 app.secret_key = os.urandom(24)
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Crear directorios necesarios
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs('data', exist_ok=True)
-
-# Configuración básica completada
-print("Aplicación inicializada correctamente")
-
 # Configuración de OpenRouter (adaptado del ejemplo PyQt5)
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 MODEL_NAME = "x-ai/grok-4.1-fast:free"
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
+API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# Cliente de OpenRouter con conexiones persistentes, reintentos y circuit breaker
+cliente_llm = ClienteLLM(
+    API_URL, OPENROUTER_API_KEY,
+    timeout_conexion=float(os.getenv("LLM_TIMEOUT_CONEXION", "5")),
+    timeout_lectura=float(os.getenv("LLM_TIMEOUT_LECTURA", "30")),
+    timeout_total=float(os.getenv("LLM_TIMEOUT_TOTAL", "60")),
+    reintentos=int(os.getenv("LLM_REINTENTOS", "2")),
+    umbral_circuito=int(os.getenv("LLM_UMBRAL_CIRCUITO", "5")),
+    enfriamiento_circuito=float(os.getenv("LLM_ENFRIAMIENTO_CIRCUITO", "30")),
+)
+
+# Llamadas simultáneas al modelo por proceso (0 = sin límite). Las que no entran en
+# LLM_ESPERA_ADMISION segundos reciben 429 con Retry-After en lugar de ocupar un hilo
+LLM_MAX_EN_CURSO = int(os.getenv("LLM_MAX_EN_CURSO", "4"))
+LLM_ESPERA_ADMISION = float(os.getenv("LLM_ESPERA_ADMISION", "0"))
+limite_llm = LimiteConcurrencia(LLM_MAX_EN_CURSO, LLM_ESPERA_ADMISION)
+
+# Segundos que se sugieren en Retry-After a los turnos rechazados
+REINTENTAR_TRAS_SEGUNDOS = int(os.getenv("REINTENTAR_TRAS_SEGUNDOS", "5"))
+
+# Un turno a la vez por sesión: espera máxima por el turno anterior y
+# vencimiento de la reserva si el proceso que la tomó muere
+ESPERA_TURNO_SESION = float(os.getenv("ESPERA_TURNO_SESION", "5"))
+RESERVA_TURNO_SEGUNDOS = float(os.getenv("RESERVA_TURNO_SEGUNDOS", "120"))
+
+# Número de hilos que procesan PDFs en segundo plano
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
+# Segundos sin progreso tras los que un trabajo en 'procesando' se da por
+# abandonado (su proceso murió o se reinició) y vuelve a la cola; cada lote
+# de páginas guardado renueva la reserva
+RESERVA_TRABAJO_SEGUNDOS = int(os.getenv("RESERVA_TRABAJO_SEGUNDOS", "600"))
+
+# Máximo de procesos para renderizar páginas en paralelo (1 = secuencial)
+RENDER_WORKERS = max(1, int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1))))
+
+# Páginas máximas a procesar por PDF (0 = sin límite)
+MAX_PAGINAS_PDF = int(os.getenv("MAX_PAGINAS_PDF", "0"))
+
+# Páginas que se confirman en la base de datos en cada transacción
+LOTE_PAGINAS_PDF = max(1, int(os.getenv("LOTE_PAGINAS_PDF", "8")))
+
+# Subida en lote: máximo de PDFs por petición (contando los de cada .zip) y
+# tamaño máximo de la petición en MB
+MAX_ARCHIVOS_LOTE = int(os.getenv("MAX_ARCHIVOS_LOTE", "100"))
+MAX_SUBIDA_LOTE_MB = int(os.getenv("MAX_SUBIDA_LOTE_MB", "500"))
+# Archivos de una subida en lote que se registran en la misma transacción
+# y se informan juntos en la respuesta
+ARCHIVOS_POR_GRUPO_LOTE = max(1, int(os.getenv("ARCHIVOS_POR_GRUPO_LOTE", "8")))
+# Ingestas en lote simultáneas; tienen su propio pool para no ocupar los
+# hilos de INGEST_WORKERS que atienden las subidas de un solo PDF
+LOTES_INGESTA_SIMULTANEOS = max(1, int(os.getenv("LOTES_INGESTA_SIMULTANEOS", "1")))
+
+# Tamaño máximo del contexto de PDFs enviado al modelo (caracteres)
+LIMITE_CONTEXTO_PDF = int(os.getenv("LIMITE_CONTEXTO_PDF", "4000"))
+
+# Largo máximo del resumen precalculado de cada página (caracteres)
+LARGO_RESUMEN_PAGINA = int(os.getenv("LARGO_RESUMEN_PAGINA", "300"))
+
+# Turnos (pregunta y respuesta) que se envían al modelo sin resumir
+TURNOS_RECIENTES = int(os.getenv("TURNOS_RECIENTES", "4"))
+
+# Presupuesto aproximado de tokens para el historial y para su resumen
+LIMITE_TOKENS_HISTORIAL = int(os.getenv("LIMITE_TOKENS_HISTORIAL", "3000"))
+LIMITE_TOKENS_RESUMEN = int(os.getenv("LIMITE_TOKENS_RESUMEN", "600"))
+
+# Renderizar las imágenes de página al pedirlas y no durante la ingesta
+RENDERIZADO_DIFERIDO = os.getenv("RENDERIZADO_DIFERIDO", "1") != "0"
+
+# Espacio máximo en disco para las imágenes generadas bajo demanda (MB)
+CACHE_IMAGENES_MAX_MB = int(os.getenv("CACHE_IMAGENES_MAX_MB", "200"))
+
+# Mantenimiento del almacenamiento (huérfanos, cuotas, ANALYZE y VACUUM):
+# segundos entre ejecuciones compartidos por todos los procesos (0 = desactivado)
+MANTENIMIENTO_INTERVALO = int(os.getenv("MANTENIMIENTO_INTERVALO", "3600"))
+
+# Antigüedad mínima de un archivo sin fila o de una ingesta fallida para borrarlos
+GC_GRACIA_SEGUNDOS = int(os.getenv("GC_GRACIA_SEGUNDOS", "3600"))
+
+# Cuotas de data/uploads y de los datos de SQLite (MB); al superarlas se borran
+# los PDFs usados hace más tiempo hasta bajar al 90% (0 = sin límite)
+CUOTA_DISCO_MB = int(os.getenv("CUOTA_DISCO_MB", "0"))
+CUOTA_BD_MB = int(os.getenv("CUOTA_BD_MB", "0"))
+
+# Fracción de espacio libre en SQLite (o de filas borradas en el índice
+# vectorial) a partir de la cual se compacta con VACUUM (o se reescribe)
+FRACCION_COMPACTAR = float(os.getenv("FRACCION_COMPACTAR", "0.2"))
+
+# Caché de respuestas: vigencia en segundos y número máximo de entradas
+RESPUESTAS_CACHE_TTL = int(os.getenv("RESPUESTAS_CACHE_TTL", str(24 * 3600)))
+RESPUESTAS_CACHE_MAX = int(os.getenv("RESPUESTAS_CACHE_MAX", "1000"))
+
+# URL pública con la que se enlazan las imágenes dentro de las respuestas
+URL_PUBLICA = os.getenv("URL_PUBLICA", "https://prueba-7-tr52.onrender.com").rstrip('/')
+
+# Máximo de imágenes de página que se insertan en una respuesta (0 = ninguna)
+MAX_IMAGENES_RESPUESTA = int(os.getenv("MAX_IMAGENES_RESPUESTA", "6"))
+
+# Entrega de imágenes delegada al servidor web: '' (la sirve Flask), 'x-sendfile' o 'x-accel'
+IMAGENES_OFFLOAD = os.getenv("IMAGENES_OFFLOAD", "").lower()
+# Ubicación interna de nginx que apunta a UPLOAD_FOLDER (solo para 'x-accel')
+IMAGENES_ACCEL_PREFIJO = os.getenv("IMAGENES_ACCEL_PREFIJO", "/_uploads/")
+app.config['USE_X_SENDFILE'] = IMAGENES_OFFLOAD == 'x-sendfile'
+
+# Índice de texto completo (se desactiva si SQLite no trae FTS5)
+FTS_DISPONIBLE = True
+
+# Métricas que se exportan en /metrics
+METRICA_PETICIONES = observabilidad.Histograma(
+    'http_peticion_duracion_segundos', 'Duración de las peticiones HTTP hasta devolver la respuesta',
+    ('ruta', 'metodo', 'codigo'))
+METRICA_CHAT_ETAPAS = observabilidad.Histograma(
+    'chat_etapa_duracion_segundos', 'Duración de cada etapa de un turno de chat', ('etapa', 'modo'))
+METRICA_LLM = observabilidad.Histograma(
+    'llm_duracion_segundos', 'Duración de las llamadas al modelo', ('modo', 'resultado'))
+METRICA_LLM_PRIMER_TOKEN = observabilidad.Histograma(
+    'llm_primer_token_segundos', 'Tiempo hasta el primer fragmento de una respuesta en stream')
+METRICA_INGESTA_ETAPAS = observabilidad.Histograma(
+    'ingesta_etapa_duracion_segundos', 'Duración de cada etapa del procesamiento de un PDF', ('etapa',))
+METRICA_INGESTA_VELOCIDAD = observabilidad.Histograma(
+    'ingesta_paginas_por_segundo', 'Páginas por segundo de cada PDF procesado',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+METRICA_INGESTA_PAGINAS = observabilidad.Contador(
+    'ingesta_paginas_total', 'Páginas de PDF procesadas')
+METRICA_CHAT_RECHAZOS = observabilidad.Contador(
+    'chat_rechazos_total', 'Turnos de chat rechazados con 429', ('motivo',))
+METRICA_PDFS_BORRADOS = observabilidad.Contador(
+    'pdfs_borrados_total', 'PDFs borrados por la API, la recolección de huérfanos o las cuotas', ('motivo',))
+METRICA_LLM_EN_CURSO = observabilidad.Medidor(
+    'llm_llamadas_en_curso', 'Llamadas al modelo en curso en este proceso',
+    calcular=lambda: {(): limite_llm.en_curso})
+METRICA_COLA_INGESTA = observabilidad.Medidor(
+    'ingesta_trabajos', 'Trabajos de ingesta pendientes y en curso (de la base de datos)', ('estado',),
+    calcular=lambda: contar_trabajos_activos())
 
 # Configuración de la base de datos
+RUTA_DB = os.path.join('data', 'database.sqlite')
+
+# Espera máxima por el lock de escritura, caché de páginas y mmap de SQLite
+SQLITE_TIMEOUT = float(os.getenv("SQLITE_TIMEOUT", "10"))
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "16"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "128"))
+
+def abrir_conexion():
+    """Abre una conexión con los pragmas de la aplicación"""
+    conn = sqlite3.connect(RUTA_DB, timeout=SQLITE_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    # Con WAL, NORMAL solo sincroniza en los checkpoints y sigue siendo seguro ante caídas
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_MB * 1024}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
 def init_db():
-    conn = sqlite3.connect('data/database.sqlite')
+    conn = abrir_conexion()
+    # WAL queda guardado en el archivo: lectores y escritor ya no se bloquean entre sí
+    conn.execute('PRAGMA journal_mode = WAL')
     c = conn.cursor()
     
     c.execute('''
@@ -68,10 +231,16 @@ def init_db():
             id TEXT PRIMARY KEY,
             filename TEXT NOT NULL,
             file_path TEXT NOT NULL,
-            uploaded_at TEXT DEFAULT CURRENT_TIMESTAMP
+            uploaded_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            content_hash TEXT
         )
     ''')
     
+    # SHA-256 del archivo; versiona las URLs de sus imágenes
+    c.execute('PRAGMA table_info(pdf_files)')
+    if 'content_hash' not in [columna[1] for columna in c.fetchall()]:
+        c.execute('ALTER TABLE pdf_files ADD COLUMN content_hash TEXT')
+    
     c.execute('''
         CREATE TABLE IF NOT EXISTS pdf_content (
             id TEXT PRIMARY KEY,
@@ -116,299 +285,2292 @@ def init_db():
         )
     ''')
     
+    # Trabajos de procesamiento de PDFs en segundo plano
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_jobs (
+            id TEXT PRIMARY KEY,
+            pdf_id TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            fase TEXT,
+            paginas_total INTEGER,
+            paginas_procesadas INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (pdf_id) REFERENCES pdf_files(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Resumen acumulado de los mensajes antiguos de cada sesión
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id TEXT PRIMARY KEY,
+            resumen TEXT NOT NULL DEFAULT '',
+            resumido_hasta TEXT,
+            mensajes_resumidos INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Fragmentos de página para el índice vectorial; AUTOINCREMENT evita
+    # reutilizar ids que aún tienen una fila en la matriz de vectores
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pdf_id TEXT NOT NULL,
+            page_number INTEGER NOT NULL,
+            texto TEXT NOT NULL,
+            FOREIGN KEY (pdf_id) REFERENCES pdf_files(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Caché de respuestas del modelo y sus contadores
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS respuestas_cache (
+            clave TEXT PRIMARY KEY,
+            respuesta TEXT NOT NULL,
+            creada_en REAL NOT NULL,
+            ultimo_uso REAL NOT NULL,
+            aciertos INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_respuestas_cache_ultimo_uso ON respuestas_cache (ultimo_uso)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS cache_estadisticas (
+            nombre TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    crear_indice_fts(c)
+    
     conn.commit()
+    aplicar_migraciones(conn)
     conn.close()
 
-init_db()
+def crear_indice_fts(c):
+    """Crea el índice FTS5 sobre pdf_content y los triggers que lo mantienen al día
+
+    Es un índice de contenido externo y se enlaza por rowid. Desde la
+    migración 8 el rowid de pdf_content es su columna `fila` (INTEGER
+    PRIMARY KEY), que VACUUM no renumera.
+    """
+    global FTS_DISPONIBLE
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pdf_content_fts'")
+    existia = c.fetchone() is not None
+    
+    try:
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS pdf_content_fts USING fts5(
+                text_content,
+                content='pdf_content',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        registrar(logging.WARNING, "FTS5 no está disponible, se usará el contexto sin ranking", error=str(e))
+        FTS_DISPONIBLE = False
+        return
+    
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS pdf_content_fts_insert AFTER INSERT ON pdf_content BEGIN
+            INSERT INTO pdf_content_fts (rowid, text_content) VALUES (new.rowid, new.text_content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS pdf_content_fts_delete AFTER DELETE ON pdf_content BEGIN
+            INSERT INTO pdf_content_fts (pdf_content_fts, rowid, text_content)
+            VALUES ('delete', old.rowid, old.text_content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS pdf_content_fts_update AFTER UPDATE ON pdf_content BEGIN
+            INSERT INTO pdf_content_fts (pdf_content_fts, rowid, text_content)
+            VALUES ('delete', old.rowid, old.text_content);
+            INSERT INTO pdf_content_fts (rowid, text_content) VALUES (new.rowid, new.text_content);
+        END
+    ''')
+    
+    # Indexar el contenido que ya existía antes de crear el índice
+    if not existia:
+        c.execute("INSERT INTO pdf_content_fts (pdf_content_fts) VALUES ('rebuild')")
+
+def reconstruir_pdf_content_con_fila(conn):
+    """Da a pdf_content una clave entera propia para enlazar el índice FTS
+
+    VACUUM puede renumerar el rowid implícito de una tabla cuya PRIMARY KEY
+    es de texto, y con él quedaba desenlazado el FTS de contenido externo.
+    Con `fila INTEGER PRIMARY KEY` el rowid es esa columna y se conserva. Las
+    filas se copian con el mismo rowid, así el índice FTS sigue valiendo, y
+    se recrean los índices y triggers de la tabla.
+    """
+    if 'fila' in [columna[1] for columna in conn.execute('PRAGMA table_info(pdf_content)')]:
+        return
+    objetos = conn.execute('''
+        SELECT sql FROM sqlite_master
+        WHERE tbl_name = 'pdf_content' AND type IN ('index', 'trigger') AND sql IS NOT NULL
+    ''').fetchall()
+    conn.execute('''
+        CREATE TABLE pdf_content_nueva (
+            fila INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            pdf_id TEXT NOT NULL,
+            page_number INTEGER NOT NULL,
+            text_content TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (pdf_id) REFERENCES pdf_files(id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO pdf_content_nueva (fila, id, pdf_id, page_number, text_content, created_at)
+        SELECT rowid, id, pdf_id, page_number, text_content, created_at FROM pdf_content
+    ''')
+    # DROP TABLE se lleva los índices y triggers sin dispararlos
+    conn.execute('DROP TABLE pdf_content')
+    conn.execute('ALTER TABLE pdf_content_nueva RENAME TO pdf_content')
+    for (sql,) in objetos:
+        conn.execute(sql)
+
+# Migraciones versionadas con PRAGMA user_version; cada una se aplica una sola vez.
+# Todo cambio de esquema nuevo va aquí: crear_app() solo compara user_version.
+# Cada paso es una sentencia SQL o una función que recibe la conexión.
+MIGRACIONES = [
+    # 1: índices compuestos para el historial, las páginas de cada PDF y la cola
+    [
+        'CREATE INDEX IF NOT EXISTS idx_messages_sesion_fecha ON messages (session_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_content_pdf_pagina ON pdf_content (pdf_id, page_number)',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_images_pdf_pagina ON pdf_images (pdf_id, page_number)',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_chunks_pdf_pagina ON pdf_chunks (pdf_id, page_number)',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_jobs_estado_fecha ON pdf_jobs (estado, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_jobs_pdf_fecha ON pdf_jobs (pdf_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_files_subido ON pdf_files (uploaded_at)',
+        'CREATE INDEX IF NOT EXISTS idx_chat_sessions_actualizada ON chat_sessions (updated_at)',
+        'ANALYZE',
+    ],
+    # 2: el id desempata las fechas iguales en la paginación por cursor del historial
+    [
+        'DROP INDEX IF EXISTS idx_messages_sesion_fecha',
+        'CREATE INDEX IF NOT EXISTS idx_messages_sesion_fecha_id ON messages (session_id, created_at, id)',
+        'DROP INDEX IF EXISTS idx_chat_sessions_actualizada',
+        'CREATE INDEX IF NOT EXISTS idx_chat_sessions_actualizada_id ON chat_sessions (updated_at, id)',
+    ],
+    # 3: búsqueda de PDFs ya subidos por su hash
+    [
+        'CREATE INDEX IF NOT EXISTS idx_pdf_files_hash ON pdf_files (content_hash)',
+    ],
+    # 4: resumen precalculado de cada página y esquema (títulos por página) de cada PDF
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS pdf_page_digests (
+            pdf_id TEXT NOT NULL,
+            page_number INTEGER NOT NULL,
+            titulos TEXT NOT NULL DEFAULT '',
+            palabras_clave TEXT NOT NULL DEFAULT '',
+            resumen TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (pdf_id, page_number),
+            FOREIGN KEY (pdf_id) REFERENCES pdf_files(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+        'ALTER TABLE pdf_files ADD COLUMN esquema TEXT',
+    ],
+    # 5: reserva de la sesión mientras se responde un turno (vencimiento en segundos epoch)
+    [
+        'ALTER TABLE chat_sessions ADD COLUMN turno_hasta REAL',
+    ],
+    # 6: contadores por PDF y totales globales mantenidos por triggers, para que la
+    # vista de debug y el manifiesto de imágenes no recorran todas las páginas
+    [
+        'ALTER TABLE pdf_files ADD COLUMN paginas_texto INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE pdf_files ADD COLUMN caracteres_texto INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE pdf_files ADD COLUMN imagenes INTEGER NOT NULL DEFAULT 0',
+        '''
+        UPDATE pdf_files SET
+            paginas_texto = (SELECT COUNT(*) FROM pdf_content pc WHERE pc.pdf_id = pdf_files.id),
+            caracteres_texto = (SELECT COALESCE(SUM(LENGTH(pc.text_content)), 0)
+                                FROM pdf_content pc WHERE pc.pdf_id = pdf_files.id),
+            imagenes = (SELECT COUNT(*) FROM pdf_images pi WHERE pi.pdf_id = pdf_files.id)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS pdf_estadisticas (
+            nombre TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        INSERT OR REPLACE INTO pdf_estadisticas (nombre, valor)
+        SELECT 'pdfs', COUNT(*) FROM pdf_files
+        UNION ALL SELECT 'paginas_texto', COALESCE(SUM(paginas_texto), 0) FROM pdf_files
+        UNION ALL SELECT 'caracteres_texto', COALESCE(SUM(caracteres_texto), 0) FROM pdf_files
+        UNION ALL SELECT 'imagenes', COALESCE(SUM(imagenes), 0) FROM pdf_files
+        ''',
+        # Los totales se ajustan desde las tablas hijas y no desde pdf_files: así
+        # el borrado en cascada de un PDF descuenta sus filas una sola vez
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_pdf_insert AFTER INSERT ON pdf_files BEGIN
+            UPDATE pdf_estadisticas SET valor = valor + 1 WHERE nombre = 'pdfs';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_pdf_delete AFTER DELETE ON pdf_files BEGIN
+            UPDATE pdf_estadisticas SET valor = valor - 1 WHERE nombre = 'pdfs';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_contenido_insert AFTER INSERT ON pdf_content BEGIN
+            UPDATE pdf_files SET paginas_texto = paginas_texto + 1,
+                                 caracteres_texto = caracteres_texto + COALESCE(LENGTH(new.text_content), 0)
+            WHERE id = new.pdf_id;
+            UPDATE pdf_estadisticas
+            SET valor = valor + CASE nombre WHEN 'paginas_texto' THEN 1
+                                            ELSE COALESCE(LENGTH(new.text_content), 0) END
+            WHERE nombre IN ('paginas_texto', 'caracteres_texto');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_contenido_delete AFTER DELETE ON pdf_content BEGIN
+            UPDATE pdf_files SET paginas_texto = paginas_texto - 1,
+                                 caracteres_texto = caracteres_texto - COALESCE(LENGTH(old.text_content), 0)
+            WHERE id = old.pdf_id;
+            UPDATE pdf_estadisticas
+            SET valor = valor - CASE nombre WHEN 'paginas_texto' THEN 1
+                                            ELSE COALESCE(LENGTH(old.text_content), 0) END
+            WHERE nombre IN ('paginas_texto', 'caracteres_texto');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_contenido_update
+        AFTER UPDATE OF text_content ON pdf_content BEGIN
+            UPDATE pdf_files
+            SET caracteres_texto = caracteres_texto + COALESCE(LENGTH(new.text_content), 0)
+                                                    - COALESCE(LENGTH(old.text_content), 0)
+            WHERE id = new.pdf_id;
+            UPDATE pdf_estadisticas
+            SET valor = valor + COALESCE(LENGTH(new.text_content), 0) - COALESCE(LENGTH(old.text_content), 0)
+            WHERE nombre = 'caracteres_texto';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_imagen_insert AFTER INSERT ON pdf_images BEGIN
+            UPDATE pdf_files SET imagenes = imagenes + 1 WHERE id = new.pdf_id;
+            UPDATE pdf_estadisticas SET valor = valor + 1 WHERE nombre = 'imagenes';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS pdf_estadisticas_imagen_delete AFTER DELETE ON pdf_images BEGIN
+            UPDATE pdf_files SET imagenes = imagenes - 1 WHERE id = old.pdf_id;
+            UPDATE pdf_estadisticas SET valor = valor - 1 WHERE nombre = 'imagenes';
+        END
+        ''',
+        # El id desempata las fechas iguales en el listado paginado de PDFs
+        'DROP INDEX IF EXISTS idx_pdf_files_subido',
+        'CREATE INDEX IF NOT EXISTS idx_pdf_files_subido_id ON pdf_files (uploaded_at, id)',
+    ],
+    # 7: último uso de cada PDF (segundos epoch) para desalojar los menos usados y
+    # última ejecución de cada tarea de mantenimiento, compartida entre procesos
+    [
+        'ALTER TABLE pdf_files ADD COLUMN ultimo_uso REAL',
+        '''
+        CREATE TABLE IF NOT EXISTS tareas_mantenimiento (
+            nombre TEXT PRIMARY KEY,
+            ultima_ejecucion REAL NOT NULL DEFAULT 0
+        )
+        ''',
+    ],
+    # 8: rowid estable en pdf_content para que VACUUM no desenlace el índice FTS
+    [
+        reconstruir_pdf_content_con_fila,
+    ],
+    # 9: la caché de respuestas ya no se vacía entera con cada página que se escribe;
+    # la clave incluye la huella del contexto recuperado, así que basta con el TTL
+    [
+        'DROP TRIGGER IF EXISTS respuestas_cache_invalidar_insert',
+        'DROP TRIGGER IF EXISTS respuestas_cache_invalidar_update',
+        'DROP TRIGGER IF EXISTS respuestas_cache_invalidar_delete',
+    ],
+]
+
+def aplicar_migraciones(conn):
+    """Aplica en orden las migraciones posteriores a la versión de la base"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for numero, sentencias in enumerate(MIGRACIONES[version:], start=version + 1):
+        # BEGIN IMMEDIATE: si varios workers arrancan a la vez, solo uno migra
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= numero:
+                conn.rollback()
+                continue
+            for sentencia in sentencias:
+                if callable(sentencia):
+                    sentencia(conn)
+                else:
+                    conn.execute(sentencia)
+            conn.execute(f'PRAGMA user_version = {numero}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        registrar(logging.INFO, "Base de datos migrada", version=numero)
+
+def preparar_base_de_datos():
+    """Crea el esquema y aplica las migraciones; se ejecuta una vez por despliegue"""
+    os.makedirs(os.path.dirname(RUTA_DB), exist_ok=True)
+    init_db()
+
+def esquema_al_dia():
+    """True si la base ya tiene todas las migraciones (una sola consulta, sin escribir)
+
+    Además deja FTS_DISPONIBLE según exista o no el índice de texto completo.
+    """
+    global FTS_DISPONIBLE
+    if not os.path.exists(RUTA_DB):
+        return False
+    conn = abrir_conexion()
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        existe_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pdf_content_fts'"
+        ).fetchone() is not None
+    finally:
+        conn.close()
+    if version < len(MIGRACIONES):
+        return False
+    FTS_DISPONIBLE = existe_fts
+    return True
+
+@app.cli.command('inicializar-bd')
+def inicializar_bd_comando():
+    """Crea o migra la base de datos (paso de build: flask --app app inicializar-bd)"""
+    preparar_base_de_datos()
+    registrar(logging.INFO, "Base de datos lista", version=len(MIGRACIONES))
+
+# Una conexión por hilo, abierta la primera vez y reutilizada después
+_conexiones = threading.local()
 
 def get_db():
-    conn = sqlite3.connect('data/database.sqlite')
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_conexiones, 'conn', None)
+    if conn is None:
+        conn = _conexiones.conn = abrir_conexion()
     return conn
 
+@app.teardown_request
+def descartar_transaccion(error=None):
+    """Deshace lo que una petición dejó sin confirmar en la conexión de su hilo"""
+    conn = getattr(_conexiones, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# Menciones de páginas en las respuestas de Grok, en una sola pasada: "página 3",
+# "pág. 3", "page 3", y "portada" o "primera página" para la página 1
+PATRON_PAGINA = re.compile(r'(?:página|pág\.|page)\s*(\d+)|portada|primera\s+página', re.IGNORECASE)
+
+def version_imagen(content_hash):
+    """Parte del hash del PDF que va en ?v= de las URLs de sus imágenes"""
+    return content_hash[:16] if content_hash else None
+
+def url_imagen(img, absoluta=True, **parametros):
+    """URL de la imagen de una fila con pdf_id, image_name y content_hash
+
+    Si el PDF ya tiene hash, la URL lleva ?v=<hash> y se puede guardar en
+    caché como inmutable.
+    """
+    url = f"/api/imagen/{img['pdf_id']}/{img['image_name']}"
+    if absoluta:
+        url = URL_PUBLICA + url
+    version = version_imagen(img['content_hash'])
+    if version:
+        parametros['v'] = version
+    if parametros:
+        url += '?' + '&'.join(f"{clave}={valor}" for clave, valor in parametros.items())
+    return url
+
+def mapa_imagenes_por_pagina(imagenes_pdfs, **parametros):
+    """Crea un mapa número de página -> URL de su imagen"""
+    imagenes_por_pagina = {}
+    for img in imagenes_pdfs:
+        if img['image_name'] and img['page_number']:
+            imagenes_por_pagina[img['page_number']] = url_imagen(img, **parametros)
+    return imagenes_por_pagina
+
+def menciones_de_paginas(texto):
+    """Produce (número de página, fin de la mención) en el orden en que aparecen"""
+    for match in PATRON_PAGINA.finditer(texto):
+        numero = match.group(1)
+        yield (int(numero) if numero else 1), match.end()
+
+def paginas_mencionadas(texto):
+    """Devuelve los números de página mencionados en el texto"""
+    return [pagina for pagina, _ in menciones_de_paginas(texto)]
+
 def procesar_respuesta_con_imagenes(respuesta_grok, imagenes_pdfs):
     """
     Post-procesa la respuesta de Grok para insertar automáticamente 
     las imágenes cuando menciona páginas específicas del PDF
+
+    Cada página se inserta una vez, tras su primera mención, y como mucho
+    MAX_IMAGENES_RESPUESTA en total. La salida se arma con una lista de
+    tramos y un solo join, sin copiar la respuesta en cada inserción.
     """
-    import re
-    
-    if not imagenes_pdfs:
+    if not imagenes_pdfs or MAX_IMAGENES_RESPUESTA <= 0:
         return respuesta_grok
     
-    respuesta_final = respuesta_grok
+    # Crear un mapa de imágenes por página
+    imagenes_por_pagina = mapa_imagenes_por_pagina(imagenes_pdfs)
     
-    # Detectar menciones de páginas en la respuesta de Grok
-    patrones_pagina = [
-        r'[Pp]ágina\s*(\d+)',
-        r'[Pp]ág\.\s*(\d+)', 
-        r'[Pp]age\s*(\d+)',
-        r'[Pp]ortada',  # Para página 1
-        r'primera\s+página',  # Para página 1
-    ]
+    tramos = []
+    copiado_hasta = 0
+    insertadas = set()
+    for pagina_num, fin_mencion in menciones_de_paginas(respuesta_grok):
+        if pagina_num in insertadas or pagina_num not in imagenes_por_pagina:
+            continue
+        tramos.append(respuesta_grok[copiado_hasta:fin_mencion])
+        tramos.append(f"\n\n![Página {pagina_num} del PDF]({imagenes_por_pagina[pagina_num]})\n\n")
+        copiado_hasta = fin_mencion
+        insertadas.add(pagina_num)
+        if len(insertadas) >= MAX_IMAGENES_RESPUESTA:
+            break
     
-    # Crear un mapa de imágenes por página
-    imagenes_por_pagina = {}
-    for img in imagenes_pdfs:
-        if img['image_name'] and img['page_number']:
-            pagina = img['page_number']
-            imagen_url = f"https://prueba-7-tr52.onrender.com/api/imagen/{img['pdf_id']}/{img['image_name']}"
-            imagenes_por_pagina[pagina] = imagen_url
+    if insertadas:
+        tramos.append(respuesta_grok[copiado_hasta:])
+        return ''.join(tramos)
     
-    # Buscar menciones de páginas y agregar imágenes
-    for patron in patrones_pagina:
-        matches = re.finditer(patron, respuesta_final, re.IGNORECASE)
-        
-        for match in matches:
-            if 'portada' in match.group().lower() or 'primera' in match.group().lower():
-                pagina_num = 1
-            else:
-                try:
-                    pagina_num = int(match.group(1))
-                except (IndexError, ValueError):
-                    continue
-            
-            # Si tenemos imagen para esta página, insertarla después de la mención
-            if pagina_num in imagenes_por_pagina:
-                imagen_url = imagenes_por_pagina[pagina_num]
-                imagen_markdown = f"\n\n![Página {pagina_num} del PDF]({imagen_url})\n\n"
-                
-                # Insertar la imagen después de la mención de la página
-                pos_final = match.end()
-                respuesta_final = (respuesta_final[:pos_final] + 
-                                 imagen_markdown + 
-                                 respuesta_final[pos_final:])
-                break  # Solo insertar una vez por página
-    
-    # Si la respuesta menciona "imágenes" o "mostrar" y no se insertó ninguna, agregar todas
-    if (('imagen' in respuesta_final.lower() or 'mostrar' in respuesta_final.lower() or 
-         'ver' in respuesta_final.lower()) and 
-        '![Página' not in respuesta_final):
-        
-        respuesta_final += "\n\n### 📄 **Páginas del PDF:**\n"
-        for pagina, imagen_url in sorted(imagenes_por_pagina.items()):
-            respuesta_final += f"\n![Página {pagina} del PDF]({imagen_url})\n"
-    
-    return respuesta_final
-
-def procesar_pdf_completo(pdf_id, ruta_archivo):
-    """Procesa un PDF extrayendo texto e imágenes usando PyPDF2 y pdf2image"""
+    # Si la respuesta menciona "imágenes" o "mostrar" y no trae ninguna, agregar las primeras páginas
+    texto = respuesta_grok.lower()
+    if ('imagen' in texto or 'mostrar' in texto or 'ver' in texto) and '![página' not in texto:
+        tramos = [respuesta_grok, "\n\n### 📄 **Páginas del PDF:**\n"]
+        for pagina, imagen_url in sorted(imagenes_por_pagina.items())[:MAX_IMAGENES_RESPUESTA]:
+            tramos.append(f"\n![Página {pagina} del PDF]({imagen_url})\n")
+        return ''.join(tramos)
+    
+    return respuesta_grok
+
+def actualizar_trabajo(c, job_id, **campos):
+    """Actualiza el estado de un trabajo de procesamiento"""
+    if not job_id:
+        return
+    campos['updated_at'] = datetime.now().isoformat()
+    asignaciones = ', '.join(f"{campo} = ?" for campo in campos)
+    c.execute(f'UPDATE pdf_jobs SET {asignaciones} WHERE id = ?',
+              (*campos.values(), job_id))
+
+def guardar_lote_paginas(c, pdf_id, lote):
+    """Inserta el texto y las imágenes de un lote de páginas ya extraídas"""
+    c.executemany('''
+        INSERT INTO pdf_content (id, pdf_id, page_number, text_content)
+        VALUES (?, ?, ?, ?)
+    ''', [(str(uuid.uuid4()), pdf_id, pagina, texto)
+          for pagina, texto, _, _ in lote if texto and texto.strip()])
+    
+    c.executemany('''
+        INSERT INTO pdf_images (id, pdf_id, page_number, image_name, image_path, image_description)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(str(uuid.uuid4()), pdf_id, pagina, image_name, image_path, f"Página {pagina} del PDF")
+          for pagina, _, image_name, image_path in lote if image_name])
+
+def guardar_resumenes_paginas(c, pdf_id, paginas):
+    """Guarda el resumen de cada (page_number, texto) y devuelve [(página, título)]"""
+    filas, titulos = [], []
+    for pagina, texto in paginas:
+        if not texto or not texto.strip():
+            continue
+        resumen = resumen_paginas.resumir_pagina(texto, LARGO_RESUMEN_PAGINA)
+        filas.append((pdf_id, pagina, ' / '.join(resumen['titulos']),
+                      ', '.join(resumen['palabras_clave']), resumen['resumen']))
+        titulos.extend((pagina, titulo) for titulo in resumen['titulos'])
+    # REPLACE: un trabajo reintentado vuelve a resumir las mismas páginas
+    c.executemany('''
+        INSERT OR REPLACE INTO pdf_page_digests (pdf_id, page_number, titulos, palabras_clave, resumen)
+        VALUES (?, ?, ?, ?, ?)
+    ''', filas)
+    return titulos
+
+def guardar_esquema(c, pdf_id, titulos, total_paginas):
+    """Guarda en pdf_files el esquema del documento como JSON [[página, título], ...]"""
+    esquema = resumen_paginas.esquema_documento(titulos, total_paginas)
+    c.execute('UPDATE pdf_files SET esquema = ? WHERE id = ?',
+              (json.dumps(esquema, ensure_ascii=False), pdf_id))
+
+def resumir_paginas_pendientes():
+    """Resume las páginas de los PDFs procesados antes de existir los resúmenes"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT DISTINCT pc.pdf_id FROM pdf_content pc
+        WHERE NOT EXISTS (SELECT 1 FROM pdf_page_digests d WHERE d.pdf_id = pc.pdf_id)
+    ''')
+    for (pdf_id,) in c.fetchall():
+        c.execute('''
+            SELECT page_number, text_content FROM pdf_content
+            WHERE pdf_id = ? ORDER BY page_number
+        ''', (pdf_id,))
+        paginas = c.fetchall()
+        titulos = guardar_resumenes_paginas(c, pdf_id, paginas)
+        guardar_esquema(c, pdf_id, titulos, len(paginas))
+        conn.commit()
+        registrar(logging.INFO, "Páginas resumidas", pdf_id=pdf_id, paginas=len(paginas))
+
+# Índice vectorial compartido por los hilos de este proceso
+_indice_vectorial = None
+_indice_vectorial_lock = threading.Lock()
+
+def obtener_indice_vectorial():
+    """Abre el índice vectorial la primera vez que se necesita (None si no hay numpy)"""
+    global _indice_vectorial
+    if not VECTORES_DISPONIBLE:
+        return None
+    with _indice_vectorial_lock:
+        if _indice_vectorial is None:
+            _indice_vectorial = indice_vectorial.IndiceVectorial(os.path.join('data', 'vectores'))
+        return _indice_vectorial
+
+def fragmentar_paginas(c, pdf_id, paginas):
+    """Guarda los fragmentos de cada (page_number, texto) y devuelve [(id, texto)]
+
+    Los vectores se anexan después del commit con indexar_fragmentos.
+    """
+    fragmentos = []
+    if not VECTORES_DISPONIBLE:
+        return fragmentos
+    for pagina, texto in paginas:
+        for fragmento in indice_vectorial.dividir_en_fragmentos(texto or ''):
+            c.execute('''
+                INSERT INTO pdf_chunks (pdf_id, page_number, texto)
+                VALUES (?, ?, ?)
+            ''', (pdf_id, pagina, fragmento))
+            fragmentos.append((c.lastrowid, fragmento))
+    return fragmentos
+
+def indexar_fragmentos(fragmentos):
+    """Anexa los vectores de los fragmentos ya confirmados en pdf_chunks"""
+    indice = obtener_indice_vectorial()
+    if indice is None or not fragmentos:
+        return
+    try:
+        indice.agregar([id_fragmento for id_fragmento, _ in fragmentos],
+                       [texto for _, texto in fragmentos])
+    except Exception:
+        registrar(logging.ERROR, "Error actualizando el índice vectorial", exc_info=True)
+
+def indexar_paginas_sin_fragmentos():
+    """Fragmenta e indexa las páginas procesadas antes de existir el índice vectorial
+
+    Después repara los fragmentos que quedaron sin vector.
+    """
+    if not VECTORES_DISPONIBLE:
+        return
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT DISTINCT pc.pdf_id FROM pdf_content pc
+        WHERE NOT EXISTS (SELECT 1 FROM pdf_chunks ch WHERE ch.pdf_id = pc.pdf_id)
+    ''')
+    for (pdf_id,) in c.fetchall():
+        c.execute('''
+            SELECT page_number, text_content FROM pdf_content
+            WHERE pdf_id = ? ORDER BY page_number
+        ''', (pdf_id,))
+        fragmentos = fragmentar_paginas(c, pdf_id, c.fetchall())
+        conn.commit()
+        indexar_fragmentos(fragmentos)
+        registrar(logging.INFO, "Fragmentos agregados al índice vectorial", pdf_id=pdf_id,
+                  fragmentos=len(fragmentos))
+    # En el mismo hilo, para no indexar dos veces los fragmentos recién creados
+    indexar_fragmentos_sin_vector()
+
+def indexar_fragmentos_sin_vector(tamano_bloque=1000):
+    """Indexa los fragmentos confirmados que no llegaron al índice vectorial
+
+    Pasa si el proceso muere entre el commit de un lote y indexar_fragmentos.
+    Se saltean los PDFs con un trabajo pendiente o en curso, cuyos
+    fragmentos todavía se están indexando.
+    """
+    indice = obtener_indice_vectorial()
+    if indice is None:
+        return
+    c = get_db().cursor()
+    c.execute('''
+        SELECT ch.id FROM pdf_chunks ch
+        WHERE NOT EXISTS (
+            SELECT 1 FROM pdf_jobs pj WHERE pj.pdf_id = ch.pdf_id AND pj.estado IN ('pendiente', 'procesando')
+        )
+    ''')
+    faltantes = indice.ids_faltantes(fila[0] for fila in c.fetchall())
+    for inicio in range(0, len(faltantes), tamano_bloque):
+        bloque = faltantes[inicio:inicio + tamano_bloque]
+        c.execute(f'''
+            SELECT id, texto FROM pdf_chunks WHERE id IN ({', '.join('?' * len(bloque))})
+        ''', bloque)
+        fragmentos = c.fetchall()
+        indice.agregar([fila['id'] for fila in fragmentos], [fila['texto'] for fila in fragmentos],
+                       omitir_existentes=True)
+    if faltantes:
+        registrar(logging.INFO, "Fragmentos sin vector reindexados", fragmentos=len(faltantes))
+
+def calcular_hash_archivo(ruta, tamano_bloque=1024 * 1024):
+    """SHA-256 del archivo leído por bloques"""
+    sha = hashlib.sha256()
+    with open(ruta, 'rb') as archivo:
+        for bloque in iter(lambda: archivo.read(tamano_bloque), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def calcular_hashes_pendientes():
+    """Calcula el hash de los PDFs subidos antes de existir la columna content_hash"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id, file_path FROM pdf_files WHERE content_hash IS NULL')
+    for pdf in c.fetchall():
+        if not os.path.isfile(pdf['file_path']):
+            continue
+        c.execute('UPDATE pdf_files SET content_hash = ? WHERE id = ?',
+                  (calcular_hash_archivo(pdf['file_path']), pdf['id']))
+        conn.commit()
+
+def paginas_a_procesar_de(ruta_archivo):
+    """Páginas del PDF que se procesan, respetando MAX_PAGINAS_PDF"""
+    total_paginas = extraccion.contar_paginas(ruta_archivo)
+    return min(MAX_PAGINAS_PDF, total_paginas) if MAX_PAGINAS_PDF else total_paginas
+
+def extraer_lotes_de_paginas(pdf_id, ruta_archivo, paginas_a_procesar):
+    """Lotes de páginas (página, texto, imagen, ruta) extraídas del PDF, renderizadas si no es diferido"""
+    images_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'images', pdf_id)
+    if not RENDERIZADO_DIFERIDO:
+        os.makedirs(images_dir, exist_ok=True)
+    # Sin renderizado solo queda extraer texto, que no compensa repartir entre procesos
+    if not RENDERIZADO_DIFERIDO and RENDER_WORKERS > 1 and paginas_a_procesar > 1:
+        return procesar_paginas_en_paralelo(ruta_archivo, images_dir, paginas_a_procesar)
+    return extraccion.agrupar_en_lotes(
+        extraccion.procesar_paginas(ruta_archivo, images_dir, 0, paginas_a_procesar,
+                                    renderizar=not RENDERIZADO_DIFERIDO),
+        LOTE_PAGINAS_PDF)
+
+def guardar_paginas_extraidas(c, pdf_id, lote):
+    """Guarda texto, imágenes, fragmentos y resúmenes de un lote; devuelve (fragmentos, títulos)
+
+    Los fragmentos se indexan después del commit con indexar_fragmentos.
+    """
+    guardar_lote_paginas(c, pdf_id, lote)
+    textos = [(pagina, texto) for pagina, texto, _, _ in lote]
+    fragmentos = fragmentar_paginas(c, pdf_id, textos)
+    return fragmentos, guardar_resumenes_paginas(c, pdf_id, textos)
+
+def procesar_pdf_completo(pdf_id, ruta_archivo, job_id=None):
+    """Procesa un PDF extrayendo texto e imágenes en una sola pasada con PyMuPDF
+
+    Las páginas se confirman en lotes de LOTE_PAGINAS_PDF, así que la memoria
+    no depende del número de páginas. Si se indica job_id, el progreso se
+    guarda en pdf_jobs con cada lote.
+    """
+    cronometro = observabilidad.Cronometro(METRICA_INGESTA_ETAPAS)
     try:
         conn = get_db()
         c = conn.cursor()
         
-        # Crear directorio para imágenes del PDF
-        images_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'images', pdf_id)
-        os.makedirs(images_dir, exist_ok=True)
+        # Las subidas ya traen el hash; solo falta en los PDFs anteriores a la columna
+        c.execute('SELECT content_hash FROM pdf_files WHERE id = ?', (pdf_id,))
+        pdf = c.fetchone()
+        if pdf and not pdf['content_hash']:
+            with cronometro.etapa('hash'):
+                c.execute('UPDATE pdf_files SET content_hash = ? WHERE id = ?',
+                          (calcular_hash_archivo(ruta_archivo), pdf_id))
         
-        # Extraer texto con PyPDF2
-        with open(ruta_archivo, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            total_pages = len(pdf_reader.pages)
-            
-            # Extraer texto de todas las páginas (máximo 20 para no sobrecargar)
-            for page_num in range(min(20, total_pages)):
-                page = pdf_reader.pages[page_num]
-                
-                # Extraer texto de la página
-                texto_pagina = page.extract_text()
-                if texto_pagina.strip():
-                    content_id = str(uuid.uuid4())
-                    c.execute('''
-                        INSERT INTO pdf_content (id, pdf_id, page_number, text_content)
-                        VALUES (?, ?, ?, ?)
-                    ''', (content_id, pdf_id, page_num + 1, texto_pagina))
-                    
-                    print(f"Página {page_num + 1}: {len(texto_pagina)} caracteres extraídos")
-        
-        # Extraer imágenes con PyMuPDF (todas las páginas)
-        try:
-            pdf_document = fitz.open(ruta_archivo)
-            
-            # Procesar todas las páginas (máximo 20)
-            for page_num in range(min(20, len(pdf_document))):
-                page = pdf_document[page_num]
-                
-                # Convertir página a imagen
-                mat = fitz.Matrix(2, 2)  # Escala 2x para mejor calidad
-                pix = page.get_pixmap(matrix=mat)
-                
-                # Guardar como PNG
-                image_name = f"page_{page_num + 1}.png"
-                image_path = os.path.join(images_dir, image_name)
-                pix.save(image_path)
-                
-                # Guardar referencia en base de datos
-                image_id = str(uuid.uuid4())
-                c.execute('''
-                    INSERT INTO pdf_images (id, pdf_id, page_number, image_name, image_path, image_description)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (image_id, pdf_id, page_num + 1, image_name, image_path, f"Página {page_num + 1} del PDF"))
-                
-                print(f"Imagen extraída: Página {page_num + 1} -> {image_name}")
-            
-            pdf_document.close()
+        paginas_a_procesar = paginas_a_procesar_de(ruta_archivo)
+        
+        actualizar_trabajo(c, job_id, fase='extrayendo', paginas_total=paginas_a_procesar,
+                           paginas_procesadas=0)
+        conn.commit()
+        
+        lotes = extraer_lotes_de_paginas(pdf_id, ruta_archivo, paginas_a_procesar)
+        
+        paginas_procesadas = 0
+        titulos_documento = []
+        # El tiempo de espera por cada lote es el de extracción (y renderizado)
+        inicio_lote = time.perf_counter()
+        for lote in lotes:
+            cronometro.registrar('extraccion', time.perf_counter() - inicio_lote)
+            with cronometro.etapa('guardado'):
+                fragmentos, titulos = guardar_paginas_extraidas(c, pdf_id, lote)
+                titulos_documento.extend(titulos)
+                paginas_procesadas += len(lote)
+                actualizar_trabajo(c, job_id, paginas_procesadas=paginas_procesadas)
+                conn.commit()
+            with cronometro.etapa('indexado'):
+                indexar_fragmentos(fragmentos)
+            METRICA_INGESTA_PAGINAS.incrementar(len(lote))
             
-        except Exception as img_error:
-            print(f"Error extrayendo imágenes: {img_error}")
-            # Continuar aunque falle la extracción de imágenes
+            registrar(logging.DEBUG, "Lote de páginas procesado", pdf_id=pdf_id,
+                      paginas=paginas_procesadas, total=paginas_a_procesar)
+            inicio_lote = time.perf_counter()
         
+        guardar_esquema(c, pdf_id, titulos_documento, paginas_procesadas)
+        actualizar_trabajo(c, job_id, estado='completado', fase=None)
         conn.commit()
-        conn.close()
+        
+        segundos = cronometro.total
+        if paginas_procesadas:
+            METRICA_INGESTA_VELOCIDAD.observar(paginas_procesadas / max(segundos, 1e-6))
+        registrar(logging.INFO, "PDF procesado", pdf_id=pdf_id, paginas=paginas_procesadas,
+                  duracion_ms=round(segundos * 1000, 1), etapas=cronometro.duraciones)
         
         return True
         
     except Exception as e:
-        print(f"Error procesando PDF: {e}")
+        registrar(logging.ERROR, "Error procesando PDF", exc_info=True, pdf_id=pdf_id, job_id=job_id)
+        if job_id:
+            try:
+                # Descartar el lote a medias antes de registrar el error
+                conn = get_db()
+                conn.rollback()
+                c = conn.cursor()
+                actualizar_trabajo(c, job_id, estado='error', error=str(e))
+                conn.commit()
+            except Exception as job_error:
+                registrar(logging.ERROR, "Error registrando fallo del trabajo", job_id=job_id,
+                          error=str(job_error))
         return False
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+# Pool de procesos compartido para renderizar páginas
+_pool_render = None
+_pool_render_lock = threading.Lock()
 
-@app.route('/api/subir-pdf', methods=['POST'])
-def subir_pdf():
-    if 'archivo' not in request.files:
-        return jsonify({'error': 'No se proporcionó ningún archivo'}), 400
-    
-    archivo = request.files['archivo']
-    if archivo.filename == '':
-        return jsonify({'error': 'No se seleccionó ningún archivo'}), 400
+def obtener_pool_render():
+    """Crea el pool de procesos de renderizado la primera vez que se necesita"""
+    global _pool_render
+    with _pool_render_lock:
+        if _pool_render is None:
+            # 'spawn' evita heredar hilos y locks de PyMuPDF del proceso web
+            _pool_render = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pool_render
+
+def procesar_paginas_en_paralelo(ruta_archivo, images_dir, total_paginas):
+    """Reparte las páginas entre el pool de procesos y produce un lote por rango terminado
+
+    Cada proceso abre su propia copia del documento y procesa como máximo
+    LOTE_PAGINAS_PDF páginas, que es lo que se confirma de una vez.
+    """
+    pool = obtener_pool_render()
+    # Al menos un rango por proceso para que todos trabajen
+    tamano_rango = min(LOTE_PAGINAS_PDF, -(-total_paginas // RENDER_WORKERS))
+    futuros = [pool.submit(extraccion.procesar_rango, ruta_archivo, images_dir, inicio, fin)
+               for inicio, fin in extraccion.dividir_paginas(total_paginas, tamano_rango)]
     
-    if not archivo.filename.endswith('.pdf'):
-        return jsonify({'error': 'El archivo debe ser un PDF'}), 400
+    try:
+        for futuro in as_completed(futuros):
+            yield futuro.result()
+    finally:
+        # Si el consumidor falla, no seguir renderizando el resto del PDF
+        for futuro in futuros:
+            futuro.cancel()
+
+# Cola de procesamiento de PDFs en segundo plano
+_ejecutor_ingesta = None
+_ejecutor_lock = threading.Lock()
+
+def obtener_ejecutor_ingesta():
+    """Crea el pool de hilos de ingesta la primera vez que se necesita"""
+    global _ejecutor_ingesta
+    with _ejecutor_lock:
+        if _ejecutor_ingesta is None:
+            _ejecutor_ingesta = ThreadPoolExecutor(
+                max_workers=INGEST_WORKERS, thread_name_prefix='ingesta-pdf')
+        return _ejecutor_ingesta
+
+# Pool de la ingesta en lote, aparte del de un solo PDF
+_ejecutor_lotes = None
+
+def obtener_ejecutor_lotes():
+    """Crea el pool de las ingestas en lote la primera vez que se necesita"""
+    global _ejecutor_lotes
+    with _ejecutor_lock:
+        if _ejecutor_lotes is None:
+            _ejecutor_lotes = ThreadPoolExecutor(
+                max_workers=LOTES_INGESTA_SIMULTANEOS, thread_name_prefix='ingesta-lote')
+        return _ejecutor_lotes
+
+def reclamar_trabajo(c, job_id):
+    """Pasa un trabajo de pendiente a procesando sin confirmar; False si otro hilo o proceso ya lo tomó"""
+    c.execute('''
+        UPDATE pdf_jobs SET estado = 'procesando', updated_at = ?
+        WHERE id = ? AND estado = 'pendiente'
+    ''', (datetime.now().isoformat(), job_id))
+    return c.rowcount == 1
+
+def ejecutar_trabajo(job_id, pdf_id, ruta_archivo):
+    """Reclama un trabajo pendiente y procesa su PDF"""
+    conn = get_db()
+    # Solo un hilo (o proceso) puede reclamar cada trabajo
+    reclamado = reclamar_trabajo(conn.cursor(), job_id)
+    conn.commit()
     
-    pdf_id = str(uuid.uuid4())
-    nombre_archivo = secure_filename(archivo.filename)
-    ruta_archivo = os.path.join(app.config['UPLOAD_FOLDER'], f'{pdf_id}_{nombre_archivo}')
-    archivo.save(ruta_archivo)
+    if reclamado:
+        procesar_pdf_completo(pdf_id, ruta_archivo, job_id=job_id)
+
+def encolar_trabajo(job_id, pdf_id, ruta_archivo):
+    """Envía un trabajo al pool de ingesta"""
+    obtener_ejecutor_ingesta().submit(ejecutar_trabajo, job_id, pdf_id, ruta_archivo)
+
+# Lotes de páginas que el extractor de la ingesta en lote puede adelantar al escritor
+LOTES_EN_VUELO = 2
+# Segundos máximos que la ingesta en lote acumula páginas antes de escribirlas
+ESPERA_CONFIRMACION_LOTE = 1.0
+
+def extraer_documentos(trabajos, eventos, cancelado):
+    """Extractor de la ingesta en lote: solo lee los PDFs, nunca escribe en la base
+
+    Lee (job_id, pdf_id, ruta) de `trabajos` hasta None y pone en `eventos`
+    ('inicio', trabajo, páginas), ('lote', trabajo, lote), ('fin', trabajo,
+    None) o ('error', trabajo, excepción); al terminar pone None.
+    """
+    def poner(evento):
+        # Si el escritor ya terminó nadie vaciará la cola
+        while not cancelado.is_set():
+            try:
+                eventos.put(evento, timeout=1)
+                return
+            except queue.Full:
+                pass
     
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        c.execute('''
-            INSERT INTO pdf_files (id, filename, file_path)
-            VALUES (?, ?, ?)
-        ''', (pdf_id, nombre_archivo, ruta_archivo))
-        
-        conn.commit()
-        conn.close()
-        
-        # Procesar PDF para extraer texto e imágenes
-        procesado_exitoso = procesar_pdf_completo(pdf_id, ruta_archivo)
-        
-        return jsonify({
-            'exito': True,
-            'pdfId': pdf_id,
-            'nombreArchivo': nombre_archivo,
-            'procesado': procesado_exitoso
-        })
+        for trabajo in iter(trabajos.get, None):
+            _, pdf_id, ruta_archivo = trabajo
+            if cancelado.is_set():
+                continue
+            try:
+                paginas = paginas_a_procesar_de(ruta_archivo)
+                poner(('inicio', trabajo, paginas))
+                for lote in extraer_lotes_de_paginas(pdf_id, ruta_archivo, paginas):
+                    poner(('lote', trabajo, lote))
+                poner(('fin', trabajo, None))
+            except Exception as e:
+                poner(('error', trabajo, e))
+    finally:
+        poner(None)
+
+def escribir_eventos_ingesta(conn, pendientes, documentos, resultado, cronometro):
+    """Escribe en una sola transacción los eventos acumulados de la ingesta en lote
+
+    `documentos` guarda el progreso de cada PDF en curso por job_id. Los
+    trabajos se reclaman aquí, dentro de la transacción, así el extractor no
+    compite por el lock de escritura. Si la transacción falla, se descarta
+    con descartar_eventos_ingesta.
+    """
+    c = conn.cursor()
+    fragmentos, terminados, paginas = [], [], 0
+    # Trabajos de este lote reclamados en transacciones anteriores y en esta
+    propios = set(documentos)
+    reclamados, vistos = set(), set()
+    try:
+        with cronometro.etapa('guardado'):
+            for tipo, (job_id, pdf_id, _), datos in pendientes:
+                if tipo == 'inicio':
+                    vistos.add(job_id)
+                    if reclamar_trabajo(c, job_id):
+                        reclamados.add(job_id)
+                        documentos[job_id] = {'pdf_id': pdf_id, 'procesadas': 0, 'titulos': [],
+                                              'inicio': time.perf_counter()}
+                        actualizar_trabajo(c, job_id, fase='extrayendo', paginas_total=datos,
+                                           paginas_procesadas=0)
+                elif tipo == 'error':
+                    registrar(logging.ERROR, "Error procesando PDF", pdf_id=pdf_id, job_id=job_id,
+                              error=str(datos))
+                    if documentos.pop(job_id, None):
+                        actualizar_trabajo(c, job_id, estado='error', error=str(datos))
+                        resultado['errores'] += 1
+                elif job_id not in documentos:
+                    # Lo reclamó otro hilo o proceso, o ya falló
+                    continue
+                elif tipo == 'lote':
+                    documento = documentos[job_id]
+                    nuevos, titulos = guardar_paginas_extraidas(c, pdf_id, datos)
+                    fragmentos.extend(nuevos)
+                    documento['titulos'].extend(titulos)
+                    documento['procesadas'] += len(datos)
+                    paginas += len(datos)
+                    actualizar_trabajo(c, job_id, paginas_procesadas=documento['procesadas'])
+                else:
+                    documento = documentos.pop(job_id)
+                    guardar_esquema(c, pdf_id, documento['titulos'], documento['procesadas'])
+                    actualizar_trabajo(c, job_id, estado='completado', fase=None)
+                    terminados.append(documento)
+            conn.commit()
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        conn.rollback()
+        registrar(logging.ERROR, "Error guardando un lote de la ingesta", exc_info=True)
+        descartar_eventos_ingesta(conn, pendientes, documentos, propios, reclamados, vistos, e, resultado)
+        return
+    
+    with cronometro.etapa('indexado'):
+        indexar_fragmentos(fragmentos)
+    METRICA_INGESTA_PAGINAS.incrementar(paginas)
+    for documento in terminados:
+        segundos = time.perf_counter() - documento['inicio']
+        if documento['procesadas']:
+            METRICA_INGESTA_VELOCIDAD.observar(documento['procesadas'] / max(segundos, 1e-6))
+        registrar(logging.INFO, "PDF procesado", pdf_id=documento['pdf_id'], paginas=documento['procesadas'],
+                  duracion_ms=round(segundos * 1000, 1), lote=True)
+    resultado['completados'] += len(terminados)
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    datos = request.json
-    mensaje = datos.get('mensaje')
-    id_sesion = datos.get('idSesion')
+def descartar_eventos_ingesta(conn, pendientes, documentos, propios, reclamados, vistos, error, resultado):
+    """Registra el fallo de una transacción de la ingesta en lote ya deshecha
+
+    Solo se marcan con error los trabajos que reclamó este lote: los de
+    transacciones anteriores siguen en 'procesando' y los reclamados en la
+    que falló volvieron a 'pendiente' con el rollback; el UPDATE condicional
+    no pisa un trabajo que otro proceso tomó mientras tanto. Los que el lote
+    no llegó a reclamar pasan a la cola de un solo PDF. Si registrar el
+    fallo también falla, los trabajos quedan para liberar_trabajos_vencidos.
+    """
+    c = conn.cursor()
+    sin_reclamar = []
+    for tipo, trabajo, _ in pendientes:
+        job_id = trabajo[0]
+        documentos.pop(job_id, None)
+        if tipo == 'inicio' and job_id not in vistos:
+            sin_reclamar.append(trabajo)
     
-    if not mensaje:
-        return jsonify({'error': 'Se requiere un mensaje'}), 400
+    try:
+        for job_id in {trabajo[0] for _, trabajo, _ in pendientes}:
+            if job_id in propios:
+                estado = 'procesando'
+            elif job_id in reclamados:
+                estado = 'pendiente'
+            else:
+                continue
+            c.execute('''
+                UPDATE pdf_jobs SET estado = 'error', fase = NULL, error = ?, updated_at = ?
+                WHERE id = ? AND estado = ?
+            ''', (str(error), datetime.now().isoformat(), job_id, estado))
+            resultado['errores'] += c.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        registrar(logging.ERROR, "Error registrando el fallo de un lote de la ingesta", exc_info=True)
     
+    for trabajo in sin_reclamar:
+        encolar_trabajo(*trabajo)
+
+def procesar_lote_pdfs(trabajos):
+    """Ingesta en lote: una sola pasada para todos los PDFs que llegan por `trabajos`
+
+    Un hilo extrae las páginas mientras este las escribe. Las páginas de
+    varios documentos se acumulan en memoria y se escriben juntas en una
+    transacción cada LOTE_PAGINAS_PDF páginas (o cada
+    ESPERA_CONFIRMACION_LOTE segundos), así los PDFs chicos no pagan varios
+    commits cada uno y el lock de escritura nunca queda tomado mientras se
+    espera al extractor. Cada PDF conserva su trabajo en pdf_jobs.
+    """
+    eventos = queue.Queue(maxsize=LOTES_EN_VUELO)
+    cancelado = threading.Event()
+    threading.Thread(target=extraer_documentos, args=(trabajos, eventos, cancelado),
+                     name='ingesta-lote-extraccion', daemon=True).start()
+    
+    cronometro = observabilidad.Cronometro(METRICA_INGESTA_ETAPAS)
     conn = get_db()
+    documentos = {}
+    resultado = {'completados': 0, 'errores': 0}
+    pendientes, paginas_pendientes, plazo = [], 0, None
+    
+    try:
+        terminado = False
+        while not terminado:
+            inicio_espera = time.perf_counter()
+            try:
+                evento = eventos.get(timeout=max(0.0, plazo - inicio_espera) if pendientes else None)
+            except queue.Empty:
+                evento = ()
+            cronometro.registrar('extraccion', time.perf_counter() - inicio_espera)
+            
+            if evento is None:
+                terminado = True
+            elif evento:
+                if not pendientes:
+                    plazo = time.perf_counter() + ESPERA_CONFIRMACION_LOTE
+                pendientes.append(evento)
+                if evento[0] == 'lote':
+                    paginas_pendientes += len(evento[2])
+            
+            if pendientes and (terminado or paginas_pendientes >= LOTE_PAGINAS_PDF
+                               or time.perf_counter() >= plazo):
+                escribir_eventos_ingesta(conn, pendientes, documentos, resultado, cronometro)
+                pendientes, paginas_pendientes = [], 0
+    except Exception:
+        # Nadie revisa el futuro del pool; lo que quedó a medias lo recupera liberar_trabajos_vencidos
+        registrar(logging.ERROR, "Error en la ingesta en lote", exc_info=True)
+    finally:
+        cancelado.set()
+    
+    registrar(logging.INFO, "Lote de PDFs procesado", duracion_ms=round(cronometro.total * 1000, 1),
+              etapas=cronometro.duraciones, **resultado)
+    return resultado
+
+def vencimiento_reserva_trabajo():
+    """updated_at por debajo del cual un trabajo pendiente o en curso se da por abandonado"""
+    return (datetime.now() - timedelta(seconds=RESERVA_TRABAJO_SEGUNDOS)).isoformat()
+
+def borrar_paginas_de_pdf(c, pdf_id):
+    """Quita el texto, las imágenes, los fragmentos y los resúmenes que guardó una ingesta a medias"""
+    for tabla in ('pdf_content', 'pdf_images', 'pdf_chunks', 'pdf_page_digests'):
+        c.execute(f'DELETE FROM {tabla} WHERE pdf_id = ?', (pdf_id,))
+
+def liberar_trabajos_vencidos(conn):
+    """Devuelve a la cola los trabajos cuyo proceso murió a mitad de la ingesta
+
+    Un trabajo en 'procesando' sin progreso desde hace RESERVA_TRABAJO_SEGUNDOS
+    vuelve a 'pendiente' sin las páginas que alcanzó a guardar, así el
+    reintento no las duplica. Devuelve [(job_id, pdf_id, ruta)] de esos
+    trabajos y de los pendientes que nadie reclamó en ese tiempo.
+    """
+    c = conn.cursor()
+    vencimiento = vencimiento_reserva_trabajo()
+    c.execute('''
+        SELECT pj.id, pj.pdf_id, pj.estado, pf.file_path
+        FROM pdf_jobs pj
+        INNER JOIN pdf_files pf ON pf.id = pj.pdf_id
+        WHERE pj.estado IN ('pendiente', 'procesando') AND pj.updated_at < ?
+        ORDER BY pj.created_at ASC
+    ''', (vencimiento,))
+    liberados = []
+    for trabajo in c.fetchall():
+        if trabajo['estado'] == 'procesando':
+            # Solo si nadie lo renovó ni lo liberó entre la lectura y la escritura
+            c.execute('''
+                UPDATE pdf_jobs
+                SET estado = 'pendiente', fase = NULL, paginas_procesadas = 0, updated_at = ?
+                WHERE id = ? AND estado = 'procesando' AND updated_at < ?
+            ''', (datetime.now().isoformat(), trabajo['id'], vencimiento))
+            if c.rowcount != 1:
+                continue
+            borrar_paginas_de_pdf(c, trabajo['pdf_id'])
+            conn.commit()
+            registrar(logging.WARNING, "Trabajo abandonado devuelto a la cola", job_id=trabajo['id'],
+                      pdf_id=trabajo['pdf_id'])
+        liberados.append((trabajo['id'], trabajo['pdf_id'], trabajo['file_path']))
+    return liberados
+
+def reanudar_trabajos_pendientes():
+    """Vuelve a encolar los trabajos que quedaron pendientes o abandonados tras un reinicio"""
+    conn = get_db()
+    liberar_trabajos_vencidos(conn)
     c = conn.cursor()
+    c.execute('''
+        SELECT pj.id, pj.pdf_id, pf.file_path
+        FROM pdf_jobs pj
+        INNER JOIN pdf_files pf ON pf.id = pj.pdf_id
+        WHERE pj.estado = 'pendiente'
+        ORDER BY pj.created_at ASC
+    ''')
+    pendientes = c.fetchall()
     
-    # Crear sesión si no existe
-    if not id_sesion:
-        id_sesion = str(uuid.uuid4())
+    for trabajo in pendientes:
+        encolar_trabajo(trabajo['id'], trabajo['pdf_id'], trabajo['file_path'])
+
+def contar_trabajos_activos():
+    """{(estado,): cantidad} de los trabajos pendientes y en curso de todos los procesos"""
+    c = get_db().cursor()
+    c.execute('''
+        SELECT estado, COUNT(*) AS cantidad FROM pdf_jobs
+        WHERE estado IN ('pendiente', 'procesando')
+        GROUP BY estado
+    ''')
+    conteos = {('pendiente',): 0, ('procesando',): 0}
+    conteos.update({(fila['estado'],): fila['cantidad'] for fila in c.fetchall()})
+    return conteos
+
+_trabajos_reanudados = False
+
+@app.before_request
+def reanudar_trabajos_al_arrancar():
+    """Reanuda la cola con la primera petición atendida por este proceso
+
+    Se hace aquí y no al importar el módulo para que los procesos del pool
+    de renderizado (que importan el módulo principal con 'spawn') no
+    reclamen trabajos.
+    """
+    global _trabajos_reanudados
+    if _trabajos_reanudados:
+        return
+    _trabajos_reanudados = True
+    reanudar_trabajos_pendientes()
+    obtener_ejecutor_ingesta().submit(indexar_paginas_sin_fragmentos)
+    obtener_ejecutor_ingesta().submit(calcular_hashes_pendientes)
+    obtener_ejecutor_ingesta().submit(resumir_paginas_pendientes)
+    if MANTENIMIENTO_INTERVALO > 0:
+        threading.Thread(target=bucle_mantenimiento, name='mantenimiento', daemon=True).start()
+
+# Tablas con filas de cada PDF (todas con ON DELETE CASCADE hacia pdf_files)
+TABLAS_DE_PDF = ('pdf_content', 'pdf_images', 'pdf_chunks', 'pdf_jobs', 'pdf_page_digests')
+
+# Último uso de cada PDF acumulado en memoria; el mantenimiento lo vuelca a la base
+_usos_pdfs = {}
+_usos_pdfs_lock = threading.Lock()
+
+def registrar_uso_pdfs(pdf_ids):
+    """Anota que los PDFs se usaron ahora, sin escribir en la base durante la petición"""
+    ahora = time.time()
+    with _usos_pdfs_lock:
+        for pdf_id in pdf_ids:
+            _usos_pdfs[pdf_id] = ahora
+
+def guardar_usos_pdfs(conn):
+    """Vuelca a pdf_files.ultimo_uso los usos anotados desde la última vez"""
+    with _usos_pdfs_lock:
+        usos = list(_usos_pdfs.items())
+        _usos_pdfs.clear()
+    if usos:
+        conn.executemany('UPDATE pdf_files SET ultimo_uso = MAX(COALESCE(ultimo_uso, 0), ?) WHERE id = ?',
+                         [(momento, pdf_id) for pdf_id, momento in usos])
+        conn.commit()
+
+def tamano_directorio(ruta):
+    """Bytes de todos los archivos bajo `ruta` (0 si no existe)"""
+    total = 0
+    for raiz, _, archivos in os.walk(ruta):
+        for nombre in archivos:
+            try:
+                total += os.path.getsize(os.path.join(raiz, nombre))
+            except OSError:
+                pass
+    return total
+
+def ruta_en_subidas(ruta):
+    """True si `ruta` está directamente en UPLOAD_FOLDER (los PDFs de prueba pueden estar fuera)"""
+    return os.path.dirname(os.path.abspath(ruta)) == os.path.abspath(app.config['UPLOAD_FOLDER'])
+
+def borrar_archivos_pdf(pdf_id, ruta_archivo):
+    """Borra el PDF original, sus imágenes y sus variantes en caché; devuelve los bytes liberados"""
+    liberados = 0
+    if ruta_archivo and ruta_en_subidas(ruta_archivo) and os.path.isfile(ruta_archivo):
+        liberados += os.path.getsize(ruta_archivo)
+        os.remove(ruta_archivo)
+    images_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'images', pdf_id)
+    liberados += tamano_directorio(images_dir)
+    shutil.rmtree(images_dir, ignore_errors=True)
+    liberados += obtener_cache_imagenes().borrar_pdf(pdf_id)
+    return liberados
+
+def borrar_pdf(conn, pdf_id, motivo):
+    """Borra un PDF con todas sus filas (en cascada) y después sus archivos
+
+    Devuelve los bytes liberados en disco, o None si el PDF no existía. Si
+    el proceso muere entre el commit y el borrado de los archivos, los
+    recoge recolectar_huerfanos.
+    """
+    c = conn.cursor()
+    c.execute('SELECT file_path FROM pdf_files WHERE id = ?', (pdf_id,))
+    pdf = c.fetchone()
+    if not pdf:
+        return None
+    c.execute('DELETE FROM pdf_files WHERE id = ?', (pdf_id,))
+    conn.commit()
+    
+    liberados = borrar_archivos_pdf(pdf_id, pdf['file_path'])
+    METRICA_PDFS_BORRADOS.incrementar(motivo=motivo)
+    registrar(logging.INFO, "PDF borrado", pdf_id=pdf_id, motivo=motivo, bytes_liberados=liberados)
+    return liberados
+
+def recalcular_estadisticas_pdfs(c):
+    """Rehace los totales de pdf_estadisticas a partir de los contadores de cada PDF"""
+    c.execute('''
+        INSERT OR REPLACE INTO pdf_estadisticas (nombre, valor)
+        SELECT 'pdfs', COUNT(*) FROM pdf_files
+        UNION ALL SELECT 'paginas_texto', COALESCE(SUM(paginas_texto), 0) FROM pdf_files
+        UNION ALL SELECT 'caracteres_texto', COALESCE(SUM(caracteres_texto), 0) FROM pdf_files
+        UNION ALL SELECT 'imagenes', COALESCE(SUM(imagenes), 0) FROM pdf_files
+    ''')
+
+def recolectar_huerfanos(conn):
+    """Reconcilia data/uploads con pdf_files y pdf_images; devuelve cuánto borró
+
+    Borra los PDFs cuya ingesta falló hace más de GC_GRACIA_SEGUNDOS y que
+    ya se reemplazaron con otra subida del mismo contenido, las filas hijas
+    sin PDF que quedaron de cuando no se cumplían las claves foráneas y los
+    archivos y directorios sin fila. Un PDF fallido sin reemplazo se
+    conserva hasta que lo borre el usuario, y una ingesta interrumpida la
+    vuelve a encolar liberar_trabajos_vencidos. Solo se tocan archivos más
+    viejos que la gracia, así no se borra una subida que aún no se confirmó
+    en la base.
+    """
+    c = conn.cursor()
+    borrados = {'ingestas_fallidas': 0, 'filas_huerfanas': 0, 'archivos_huerfanos': 0}
+    
+    # buscar_pdf_por_hash ya ignora estos PDFs: la subida más nueva los reemplazó
+    c.execute('''
+        SELECT pf.id FROM pdf_files pf
+        INNER JOIN pdf_jobs pj ON pj.id = (
+            SELECT id FROM pdf_jobs WHERE pdf_id = pf.id ORDER BY created_at DESC LIMIT 1
+        )
+        WHERE pj.estado = 'error' AND pj.updated_at < ?
+          AND EXISTS (
+              SELECT 1 FROM pdf_files otro
+              WHERE otro.content_hash = pf.content_hash AND otro.id != pf.id
+                AND otro.uploaded_at >= pf.uploaded_at
+          )
+    ''', ((datetime.now() - timedelta(seconds=GC_GRACIA_SEGUNDOS)).isoformat(),))
+    for (pdf_id,) in c.fetchall():
+        if borrar_pdf(conn, pdf_id, 'ingesta_fallida') is not None:
+            borrados['ingestas_fallidas'] += 1
+    
+    for tabla in TABLAS_DE_PDF:
+        c.execute(f'''
+            DELETE FROM {tabla}
+            WHERE NOT EXISTS (SELECT 1 FROM pdf_files pf WHERE pf.id = {tabla}.pdf_id)
+        ''')
+        borrados['filas_huerfanas'] += c.rowcount
+    if borrados['filas_huerfanas']:
+        # Los triggers descontaron de los totales filas que nunca se habían contado
+        recalcular_estadisticas_pdfs(c)
+    conn.commit()
+    
+    c.execute('SELECT id, file_path FROM pdf_files')
+    pdfs = c.fetchall()
+    ids = {pdf['id'] for pdf in pdfs}
+    rutas = {os.path.abspath(pdf['file_path']) for pdf in pdfs}
+    limite = time.time() - GC_GRACIA_SEGUNDOS
+    
+    # PDFs originales sin fila y temporales de subidas interrumpidas
+    for entrada in os.scandir(app.config['UPLOAD_FOLDER']):
+        if (entrada.is_file() and entrada.name.endswith(('.pdf', '.subida'))
+                and os.path.abspath(entrada.path) not in rutas and entrada.stat().st_mtime < limite):
+            os.remove(entrada.path)
+            borrados['archivos_huerfanos'] += 1
+    
+    # Imágenes renderizadas durante la ingesta y variantes en caché sin PDF
+    directorios = []
+    images_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'images')
+    if os.path.isdir(images_dir):
+        directorios.extend(entrada.path for entrada in os.scandir(images_dir) if entrada.is_dir())
+    cache = obtener_cache_imagenes()
+    directorios.extend(os.path.join(cache.directorio, pdf_id) for pdf_id in cache.pdf_ids())
+    for directorio in directorios:
+        if os.path.basename(directorio) not in ids and os.stat(directorio).st_mtime < limite:
+            if os.path.dirname(directorio) == cache.directorio:
+                cache.borrar_pdf(os.path.basename(directorio))
+            else:
+                shutil.rmtree(directorio, ignore_errors=True)
+            borrados['archivos_huerfanos'] += 1
+    
+    return borrados
+
+def uso_base_de_datos(c):
+    """(bytes con datos, fracción de páginas libres) del archivo SQLite"""
+    paginas = c.execute('PRAGMA page_count').fetchone()[0]
+    libres = c.execute('PRAGMA freelist_count').fetchone()[0]
+    tamano_pagina = c.execute('PRAGMA page_size').fetchone()[0]
+    return (paginas - libres) * tamano_pagina, (libres / paginas if paginas else 0.0)
+
+# Bytes que se estiman por fila de un PDF en la base, además de su texto
+BYTES_POR_FILA_ESTIMADOS = 100
+
+def aplicar_cuotas(conn):
+    """Borra los PDFs usados hace más tiempo mientras se supere CUOTA_DISCO_MB o CUOTA_BD_MB
+
+    Al superar una cuota se desaloja hasta bajar al 90% para no repetirlo en
+    cada ejecución. Para la base se estima antes cuánto ocupa cada PDF
+    (texto, índice FTS, fragmentos y resúmenes): si ni borrándolos todos se
+    cubre el exceso, este viene de otras tablas (mensajes, caché de
+    respuestas) y no se desaloja ningún PDF por esa cuota; tampoco se sigue
+    si un borrado no reduce el uso medido. Los PDFs con un trabajo pendiente
+    o en curso no se tocan. Devuelve cuántos PDFs se borraron.
+    """
+    if not CUOTA_DISCO_MB and not CUOTA_BD_MB:
+        return 0
+    c = conn.cursor()
+    cuota_disco = CUOTA_DISCO_MB * 1024 * 1024
+    cuota_bd = CUOTA_BD_MB * 1024 * 1024
+    disco = tamano_directorio(app.config['UPLOAD_FOLDER']) if cuota_disco else 0
+    uso_bd = uso_base_de_datos(c)[0] if cuota_bd else 0
+    exceso_disco = disco - cuota_disco * 0.9 if cuota_disco and disco > cuota_disco else 0
+    exceso_bd = uso_bd - cuota_bd * 0.9 if cuota_bd and uso_bd > cuota_bd else 0
+    if exceso_disco <= 0 and exceso_bd <= 0:
+        return 0
+    
+    # El texto cuenta dos veces: la fila de pdf_content y su entrada en el índice FTS
+    c.execute('''
+        SELECT pf.id,
+               pf.caracteres_texto * 2
+               + COALESCE((SELECT SUM(LENGTH(CAST(ch.texto AS BLOB))) FROM pdf_chunks ch
+                           WHERE ch.pdf_id = pf.id), 0)
+               + COALESCE((SELECT SUM(LENGTH(d.titulos) + LENGTH(d.palabras_clave) + LENGTH(d.resumen))
+                           FROM pdf_page_digests d WHERE d.pdf_id = pf.id), 0)
+               + (pf.paginas_texto * 2 + pf.imagenes) * ? AS bytes_bd
+        FROM pdf_files pf
+        WHERE NOT EXISTS (
+            SELECT 1 FROM pdf_jobs pj WHERE pj.pdf_id = pf.id AND pj.estado IN ('pendiente', 'procesando')
+        )
+        ORDER BY COALESCE(pf.ultimo_uso, CAST(strftime('%s', pf.uploaded_at) AS REAL)) ASC
+    ''', (BYTES_POR_FILA_ESTIMADOS,))
+    candidatos = c.fetchall()
+    
+    bytes_de_pdfs = sum(pdf['bytes_bd'] for pdf in candidatos)
+    if exceso_bd > bytes_de_pdfs:
+        registrar(logging.WARNING, "La base supera la cuota por datos que no son de PDFs, no se desalojan por ella",
+                  bd_bytes=uso_bd, bytes_de_pdfs=bytes_de_pdfs)
+        exceso_bd = 0
+    
+    desalojados = 0
+    for pdf in candidatos:
+        if exceso_disco <= 0 and exceso_bd <= 0:
+            break
+        if exceso_disco <= 0 and pdf['bytes_bd'] <= 0:
+            # Solo queda exceso en la base y este PDF no ocupa nada en ella
+            continue
+        liberados = borrar_pdf(conn, pdf['id'], 'cuota')
+        if liberados is None:
+            continue
+        desalojados += 1
+        exceso_disco -= liberados
+        if exceso_bd > 0:
+            uso_anterior, uso_bd = uso_bd, uso_base_de_datos(c)[0]
+            if uso_bd >= uso_anterior:
+                registrar(logging.WARNING, "Desalojar PDFs ya no reduce el uso de la base", bd_bytes=uso_bd)
+                exceso_bd = 0
+            else:
+                exceso_bd -= uso_anterior - uso_bd
+    
+    if exceso_disco > 0 or exceso_bd > 0:
+        registrar(logging.WARNING, "Se superan las cuotas y no quedan PDFs para desalojar",
+                  exceso_disco_bytes=max(0, exceso_disco), exceso_bd_bytes=max(0, exceso_bd))
+    return desalojados
+
+def compactar_indice_vectorial(conn):
+    """Reescribe el índice vectorial si más de FRACCION_COMPACTAR de sus filas ya no existen"""
+    indice = obtener_indice_vectorial()
+    filas = indice.contar_filas() if indice is not None else 0
+    if not filas:
+        return 0
+    c = conn.cursor()
+    # La secuencia se lee antes que los ids: un fragmento confirmado entre las
+    # dos lecturas queda por encima de ella y se conserva
+    fila = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pdf_chunks'").fetchone()
+    ultimo_id = fila[0] if fila else 0
+    ids = [fila[0] for fila in c.execute('SELECT id FROM pdf_chunks')]
+    if (filas - len(ids)) / filas < FRACCION_COMPACTAR:
+        return 0
+    return indice.compactar(ids, ultimo_id)
+
+def optimizar_base(conn):
+    """PRAGMA optimize y, si sobra espacio libre, VACUUM seguido de ANALYZE; True si compactó"""
+    c = conn.cursor()
+    if uso_base_de_datos(c)[1] < FRACCION_COMPACTAR:
+        c.execute('PRAGMA optimize')
+        return False
+    
+    # VACUUM no puede correr dentro de una transacción
+    conn.commit()
+    c.execute('VACUUM')
+    c.execute('ANALYZE')
+    conn.commit()
+    # En WAL, VACUUM copia la base entera al WAL: se vuelca y se trunca
+    c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return True
+
+def reclamar_tarea(conn, nombre, intervalo):
+    """True si a este proceso le toca la tarea: corre una vez por intervalo entre todos"""
+    ahora = time.time()
+    conn.execute('INSERT OR IGNORE INTO tareas_mantenimiento (nombre) VALUES (?)', (nombre,))
+    cursor = conn.execute('''
+        UPDATE tareas_mantenimiento SET ultima_ejecucion = ?
+        WHERE nombre = ? AND ultima_ejecucion <= ?
+    ''', (ahora, nombre, ahora - intervalo))
+    conn.commit()
+    return cursor.rowcount == 1
+
+def ejecutar_mantenimiento():
+    """Vuelca los usos, recoge huérfanos, aplica las cuotas y optimiza la base y el índice"""
+    cronometro = observabilidad.Cronometro()
+    conn = get_db()
+    guardar_usos_pdfs(conn)
+    with cronometro.etapa('huerfanos'):
+        borrados = recolectar_huerfanos(conn)
+    with cronometro.etapa('cuotas'):
+        desalojados = aplicar_cuotas(conn)
+    with cronometro.etapa('indice_vectorial'):
+        filas_compactadas = compactar_indice_vectorial(conn)
+    with cronometro.etapa('base_de_datos'):
+        compactada = optimizar_base(conn)
+    registrar(logging.INFO, "Mantenimiento terminado", desalojados=desalojados,
+              filas_vectoriales_quitadas=filas_compactadas, vacuum=compactada,
+              duracion_ms=round(cronometro.total * 1000, 1), etapas=cronometro.duraciones, **borrados)
+
+def bucle_mantenimiento():
+    """Hilo de fondo: vuelca los usos y corre el mantenimiento cuando le toca a este proceso"""
+    while True:
+        time.sleep(min(MANTENIMIENTO_INTERVALO, 300))
+        try:
+            conn = get_db()
+            # Cada proceso revisa las reservas vencidas; el UPDATE condicional evita repetirlas
+            for trabajo in liberar_trabajos_vencidos(conn):
+                encolar_trabajo(*trabajo)
+            if reclamar_tarea(conn, 'mantenimiento', MANTENIMIENTO_INTERVALO):
+                ejecutar_mantenimiento()
+            else:
+                guardar_usos_pdfs(conn)
+        except Exception:
+            registrar(logging.ERROR, "Error en el mantenimiento del almacenamiento", exc_info=True)
+            get_db().rollback()
+
+@app.cli.command('mantenimiento')
+def mantenimiento_comando():
+    """Corre el mantenimiento del almacenamiento una vez (flask --app app mantenimiento)"""
+    ejecutar_mantenimiento()
+
+# Palabras que no aportan al ranking de páginas
+PALABRAS_VACIAS = {
+    'que', 'qué', 'los', 'las', 'del', 'una', 'uno', 'unos', 'unas', 'por', 'para',
+    'con', 'sin', 'sobre', 'como', 'cómo', 'cual', 'cuál', 'cuales', 'cuáles', 'donde',
+    'dónde', 'cuando', 'cuándo', 'este', 'esta', 'esto', 'estos', 'estas', 'ese', 'esa',
+    'eso', 'hay', 'son', 'está', 'están', 'ser', 'tiene', 'pdf', 'documento', 'dime',
+    'explica', 'puedes', 'me', 'the', 'and', 'what', 'about',
+}
+
+def consulta_fts(mensaje):
+    """Convierte el mensaje del usuario en una consulta FTS5 de términos unidos con OR"""
+    terminos = []
+    for termino in re.findall(r'\w+', mensaje.lower()):
+        if len(termino) > 2 and termino not in PALABRAS_VACIAS and termino not in terminos:
+            terminos.append(termino)
+    # Las comillas evitan que FTS5 interprete los términos como operadores
+    return ' OR '.join(f'"{termino}"' for termino in terminos[:32])
+
+def buscar_paginas_relevantes(c, mensaje, limite=12):
+    """Devuelve las páginas que mejor responden al mensaje ordenadas por BM25"""
+    if not FTS_DISPONIBLE:
+        return []
+    consulta = consulta_fts(mensaje)
+    if not consulta:
+        return []
+    
+    c.execute('''
+        SELECT pc.pdf_id, pf.filename, pc.page_number,
+               snippet(pdf_content_fts, 0, '', '', '...', 64) AS fragmento,
+               bm25(pdf_content_fts) AS puntuacion
+        FROM pdf_content_fts
+        INNER JOIN pdf_content pc ON pc.fila = pdf_content_fts.rowid
+        INNER JOIN pdf_files pf ON pf.id = pc.pdf_id
+        WHERE pdf_content_fts MATCH ?
+        ORDER BY puntuacion
+        LIMIT ?
+    ''', (consulta, limite))
+    return c.fetchall()
+
+def buscar_fragmentos_semanticos(c, mensaje, limite=8):
+    """Devuelve los fragmentos más parecidos al mensaje según el índice vectorial"""
+    indice = obtener_indice_vectorial()
+    if indice is None:
+        return []
+    # Se piden de más por si alguno pertenece a un PDF ya borrado
+    resultados = indice.buscar(mensaje, k=limite * 2)
+    if not resultados:
+        return []
+    
+    ids = [id_fragmento for id_fragmento, _ in resultados]
+    c.execute(f'''
+        SELECT ch.id, ch.pdf_id, pf.filename, ch.page_number, ch.texto AS fragmento
+        FROM pdf_chunks ch
+        INNER JOIN pdf_files pf ON pf.id = ch.pdf_id
+        WHERE ch.id IN ({','.join('?' for _ in ids)})
+    ''', ids)
+    por_id = {fila['id']: fila for fila in c.fetchall()}
+    return [por_id[i] for i in ids if i in por_id][:limite]
+
+def fusionar_rankings(*rankings, k=60):
+    """Combina varios rankings con Reciprocal Rank Fusion, una entrada por página"""
+    puntuaciones = {}
+    filas = {}
+    for ranking in rankings:
+        for posicion, fila in enumerate(ranking):
+            clave = (fila['pdf_id'], fila['page_number'])
+            puntuaciones[clave] = puntuaciones.get(clave, 0) + 1 / (k + posicion + 1)
+            filas.setdefault(clave, fila)
+    return [filas[clave] for clave in sorted(puntuaciones, key=puntuaciones.get, reverse=True)]
+
+def titulos_de_paginas(c, claves):
+    """Mapa (pdf_id, page_number) -> títulos precalculados de esas páginas"""
+    if not claves:
+        return {}
+    condiciones = ' OR '.join('(pdf_id = ? AND page_number = ?)' for _ in claves)
+    c.execute(f'''
+        SELECT pdf_id, page_number, titulos FROM pdf_page_digests
+        WHERE titulos != '' AND ({condiciones})
+    ''', [valor for clave in claves for valor in clave])
+    return {(fila['pdf_id'], fila['page_number']): fila['titulos'] for fila in c.fetchall()}
+
+def etiqueta_pagina(page_number, titulos=None):
+    return f"Página {page_number} ({titulos})" if titulos else f"Página {page_number}"
+
+def construir_contexto_pdf(c, mensaje):
+    """Arma el contexto de PDFs para el mensaje y devuelve (contexto_pdf, imagenes_pdfs)
+
+    Las páginas se eligen por relevancia (BM25 y similitud vectorial) y sus
+    fragmentos llenan el presupuesto de LIMITE_CONTEXTO_PDF. Si no hay
+    coincidencias se usan el esquema y los resúmenes precalculados de las
+    primeras páginas de los PDFs más recientes.
+    """
+    paginas = fusionar_rankings(buscar_paginas_relevantes(c, mensaje),
+                                buscar_fragmentos_semanticos(c, mensaje))
+    
+    if paginas:
+        registrar_uso_pdfs({fila['pdf_id'] for fila in paginas})
+        # Imágenes de las páginas elegidas, en el mismo orden de relevancia
+        condiciones = ' OR '.join('(pi.pdf_id = ? AND pi.page_number = ?)' for _ in paginas[:10])
+        parametros = [valor for fila in paginas[:10] for valor in (fila['pdf_id'], fila['page_number'])]
+        c.execute(f'''
+            SELECT pi.pdf_id, pf.filename, pf.content_hash, pi.page_number, pi.image_name,
+                   pi.image_description
+            FROM pdf_images pi
+            INNER JOIN pdf_files pf ON pf.id = pi.pdf_id
+            WHERE {condiciones}
+        ''', parametros)
+        imagenes_pdfs = c.fetchall()
+        titulos = titulos_de_paginas(c, [(fila['pdf_id'], fila['page_number']) for fila in paginas[:20]])
+        fragmentos = [(fila['filename'],
+                       etiqueta_pagina(fila['page_number'], titulos.get((fila['pdf_id'], fila['page_number']))),
+                       fila['fragmento'])
+                      for fila in paginas]
+    else:
+        # Resúmenes de las primeras páginas de los PDFs más recientes, precedidos por su esquema
         c.execute('''
-            INSERT INTO chat_sessions (id, title, created_at, updated_at)
-            VALUES (?, ?, ?, ?)
-        ''', (id_sesion, mensaje[:50], datetime.now().isoformat(), datetime.now().isoformat()))
+            SELECT pf.filename, pf.esquema, d.page_number, d.titulos, d.palabras_clave, d.resumen
+            FROM pdf_files pf
+            INNER JOIN pdf_page_digests d ON d.pdf_id = pf.id
+            ORDER BY pf.uploaded_at DESC, d.page_number ASC
+            LIMIT 20
+        ''')
+        fragmentos = []
+        for fila in c.fetchall():
+            if not fragmentos or fragmentos[-1][0] != fila['filename']:
+                esquema = resumen_paginas.formatear_esquema(json.loads(fila['esquema'] or '[]'),
+                                                            LARGO_RESUMEN_PAGINA * 2)
+                fragmentos.append((fila['filename'], 'Esquema', esquema))
+            resumen = fila['resumen']
+            if fila['palabras_clave']:
+                resumen += f" [Claves: {fila['palabras_clave']}]"
+            fragmentos.append((fila['filename'], etiqueta_pagina(fila['page_number'], fila['titulos']), resumen))
+        
+        # Obtener imágenes de PDFs disponibles
+        c.execute('''
+            SELECT pf.id as pdf_id, pf.filename, pf.content_hash, pi.page_number, pi.image_name,
+                   pi.image_description
+            FROM pdf_files pf 
+            LEFT JOIN pdf_images pi ON pf.id = pi.pdf_id 
+            ORDER BY pf.uploaded_at DESC, pi.page_number ASC 
+            LIMIT 10
+        ''')
+        imagenes_pdfs = c.fetchall()
+    
+    # Agregar imágenes disponibles
+    seccion_imagenes = ""
+    if imagenes_pdfs:
+        seccion_imagenes = "\n\nImágenes extraídas del PDF:\n"
+        for img in imagenes_pdfs:
+            if img['image_name']:
+                imagen_url = url_imagen(img)
+                descripcion = img['image_description'] or f"Página {img['page_number']}"
+                seccion_imagenes += f"![{descripcion}]({imagen_url})\n"
+    
+    # Llenar el presupuesto con los fragmentos en orden de relevancia
+    presupuesto = LIMITE_CONTEXTO_PDF - len(seccion_imagenes)
+    por_archivo = {}
+    for filename, etiqueta, fragmento in fragmentos:
+        if not fragmento or not fragmento.strip():
+            continue
+        linea = f"{etiqueta}: {fragmento.strip()}\n"
+        costo = len(linea) + (0 if filename in por_archivo else len(filename) + 9)
+        if costo > presupuesto:
+            continue
+        presupuesto -= costo
+        por_archivo.setdefault(filename, []).append(linea)
     
-    # Guardar mensaje del usuario
-    id_mensaje = str(uuid.uuid4())
+    if not por_archivo:
+        return "", imagenes_pdfs
+    
+    contexto_pdf = "\n\nContenido de PDFs procesados:\n"
+    for filename, lineas in por_archivo.items():
+        contexto_pdf += f"\n--- {filename} ---\n" + ''.join(lineas)
+    
+    return contexto_pdf + seccion_imagenes, imagenes_pdfs
+
+# Imágenes en markdown y encabezado que agrega procesar_respuesta_con_imagenes
+_patron_imagen_markdown = re.compile(r'!\[[^\]]*\]\([^)]*\)|### 📄 \*\*Páginas del PDF:\*\*')
+_patron_token = re.compile(r'\w+|[^\w\s]')
+
+def estimar_tokens(texto):
+    """Estimación local de tokens: palabras y signos, con margen para subpalabras"""
+    return int(len(_patron_token.findall(texto)) * 1.3) + 1
+
+def limpiar_contenido_historial(contenido):
+    """Quita las imágenes insertadas en las respuestas, que el modelo no necesita"""
+    return re.sub(r'\n{3,}', '\n\n', _patron_imagen_markdown.sub('', contenido)).strip()
+
+def resumir_mensaje(role, contenido, max_caracteres=200):
+    """Resume un mensaje en una línea con sus primeras frases"""
+    texto = ' '.join(limpiar_contenido_historial(contenido).split())
+    if len(texto) > max_caracteres:
+        texto = texto[:max_caracteres].rsplit(' ', 1)[0] + '...'
+    autor = 'Usuario' if role == 'usuario' else 'Asistente'
+    return f"- {autor}: {texto}"
+
+def recortar_resumen(resumen, limite_tokens=None):
+    """Descarta las líneas más antiguas del resumen hasta que quepa en el límite"""
+    limite_tokens = limite_tokens or LIMITE_TOKENS_RESUMEN
+    lineas = resumen.split('\n')
+    while len(lineas) > 1 and estimar_tokens('\n'.join(lineas)) > limite_tokens:
+        lineas.pop(0)
+    return '\n'.join(lineas)
+
+def construir_historial(c, id_sesion):
+    """Arma los mensajes para el modelo con un tamaño acotado
+
+    Los últimos TURNOS_RECIENTES turnos van completos (sin imágenes). Los
+    anteriores se incorporan al resumen de la sesión guardado en
+    session_summaries, que se actualiza de forma incremental: solo se leen
+    los mensajes posteriores a lo ya resumido.
+    """
     c.execute('''
-        INSERT INTO messages (id, session_id, role, content, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (id_mensaje, id_sesion, 'usuario', mensaje, datetime.now().isoformat()))
+        SELECT resumen, resumido_hasta, mensajes_resumidos
+        FROM session_summaries
+        WHERE session_id = ?
+    ''', (id_sesion,))
+    fila_resumen = c.fetchone()
+    resumen = fila_resumen['resumen'] if fila_resumen else ''
+    resumido_hasta = fila_resumen['resumido_hasta'] if fila_resumen else None
+    mensajes_resumidos = fila_resumen['mensajes_resumidos'] if fila_resumen else 0
     
-    # Obtener historial de la conversación
     c.execute('''
-        SELECT role, content
+        SELECT role, content, created_at
         FROM messages
-        WHERE session_id = ?
+        WHERE session_id = ? AND created_at > ?
         ORDER BY created_at ASC
-    ''', (id_sesion,))
+    ''', (id_sesion, resumido_hasta or ''))
+    pendientes = [(fila['role'], limpiar_contenido_historial(fila['content']), fila['created_at'])
+                  for fila in c.fetchall()]
+    
+    # Pasar al resumen lo que excede los turnos recientes o el presupuesto de tokens
+    por_resumir = max(0, len(pendientes) - TURNOS_RECIENTES * 2)
+    tokens = sum(estimar_tokens(contenido) for _, contenido, _ in pendientes[por_resumir:])
+    while por_resumir < len(pendientes) - 1 and tokens > LIMITE_TOKENS_HISTORIAL:
+        tokens -= estimar_tokens(pendientes[por_resumir][1])
+        por_resumir += 1
+    
+    if por_resumir:
+        nuevas_lineas = [resumir_mensaje(role, contenido)
+                         for role, contenido, _ in pendientes[:por_resumir]]
+        resumen = recortar_resumen('\n'.join(filter(None, [resumen] + nuevas_lineas)))
+        resumido_hasta = pendientes[por_resumir - 1][2]
+        mensajes_resumidos += por_resumir
+        c.execute('''
+            INSERT INTO session_summaries (session_id, resumen, resumido_hasta, mensajes_resumidos, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                resumen = excluded.resumen,
+                resumido_hasta = excluded.resumido_hasta,
+                mensajes_resumidos = excluded.mensajes_resumidos,
+                updated_at = excluded.updated_at
+        ''', (id_sesion, resumen, resumido_hasta, mensajes_resumidos, datetime.now().isoformat()))
     
-    # Mapear roles para compatibilidad con Grok
     historial = []
-    for fila in c.fetchall():
-        role = fila['role']
+    if resumen:
+        historial.append({
+            'role': 'system',
+            'content': f"Resumen de los {mensajes_resumidos} mensajes anteriores de esta conversación:\n{resumen}"
+        })
+    
+    # Mapear roles para compatibilidad con Grok
+    for role, contenido, _ in pendientes[por_resumir:]:
         # Convertir roles a formato compatible con Grok
         if role == 'usuario':
             role = 'user'
         elif role == 'asistente':
             role = 'assistant'
-        historial.append({'role': role, 'content': fila['content']})
+        historial.append({'role': role, 'content': contenido})
     
-    # Obtener contenido de PDFs disponibles desde la base de datos
-    c.execute('''
-        SELECT pf.id as pdf_id, pf.filename, pc.page_number, pc.text_content 
-        FROM pdf_files pf 
-        LEFT JOIN pdf_content pc ON pf.id = pc.pdf_id 
-        ORDER BY pf.uploaded_at DESC, pc.page_number ASC 
-        LIMIT 20
-    ''')
-    contenido_pdfs = c.fetchall()
+    return historial
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+
+@app.after_request
+def medir_peticion(respuesta):
+    """Observa la duración hasta devolver la respuesta (en los streams, hasta el primer byte)"""
+    inicio = g.get('inicio_peticion')
+    if inicio is not None:
+        ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+        METRICA_PETICIONES.observar(time.perf_counter() - inicio, ruta=ruta,
+                                    metodo=request.method, codigo=respuesta.status_code)
+    return respuesta
+
+@app.route('/metrics')
+def metricas():
+    """Métricas en el formato de texto de Prometheus"""
+    return Response(observabilidad.exportar_metricas(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+class ArchivoSubidaConHash:
+    """Destino de un archivo subido: se escribe en UPLOAD_FOLDER mientras
+    llega y se calcula su SHA-256 al vuelo, sin releerlo después"""
+    
+    def __init__(self, directorio):
+        self.sha = hashlib.sha256()
+        descriptor, self.ruta = tempfile.mkstemp(dir=directorio, suffix='.subida')
+        self.archivo = os.fdopen(descriptor, 'w+b')
+    
+    def write(self, datos):
+        self.sha.update(datos)
+        return self.archivo.write(datos)
+    
+    def __getattr__(self, nombre):
+        return getattr(self.archivo, nombre)
+    
+    def guardar_como(self, ruta):
+        """Cierra el temporal, lo mueve a `ruta` y devuelve el hash hexadecimal"""
+        self.archivo.close()
+        os.replace(self.ruta, ruta)
+        self.ruta = ruta
+        return self.sha.hexdigest()
     
-    # Obtener imágenes de PDFs disponibles
+    def descartar(self):
+        self.archivo.close()
+        if self.ruta.endswith('.subida') and os.path.exists(self.ruta):
+            os.remove(self.ruta)
+
+class SolicitudConSubidas(Request):
+    """Request que vuelca los archivos de los formularios con ArchivoSubidaConHash"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return ArchivoSubidaConHash(app.config['UPLOAD_FOLDER'])
+    
+    @property
+    def max_content_length(self):
+        # La subida en lote trae muchos PDFs (o un .zip) en una sola petición
+        if self.endpoint == 'subir_pdfs':
+            return MAX_SUBIDA_LOTE_MB * 1024 * 1024
+        return super().max_content_length
+
+app.request_class = SolicitudConSubidas
+
+@app.teardown_request
+def descartar_subidas(error=None):
+    """Borra los temporales de las subidas que la petición no guardó"""
+    # Solo si la petición ya leyó el formulario; no hay que forzar su lectura aquí
+    archivos = request.__dict__.get('files')
+    if archivos is None:
+        return
+    # Un mismo campo puede traer varios archivos (subida en lote)
+    for _, archivo in archivos.items(multi=True):
+        if isinstance(archivo.stream, ArchivoSubidaConHash):
+            archivo.stream.descartar()
+
+def buscar_pdf_por_hash(c, content_hash):
+    """PDF ya subido con el mismo contenido y su último trabajo (None si no hay)
+
+    Se ignoran los PDFs cuyo procesamiento falló o quedó abandonado (en
+    'procesando' con la reserva vencida), para que se vuelvan a procesar.
+    """
     c.execute('''
-        SELECT pf.id as pdf_id, pf.filename, pi.page_number, pi.image_name, pi.image_description
-        FROM pdf_files pf 
-        LEFT JOIN pdf_images pi ON pf.id = pi.pdf_id 
-        ORDER BY pf.uploaded_at DESC, pi.page_number ASC 
-        LIMIT 10
-    ''')
-    imagenes_pdfs = c.fetchall()
+        SELECT pf.id, pf.filename, pf.file_path, pj.id AS job_id, pj.estado
+        FROM pdf_files pf
+        INNER JOIN pdf_jobs pj ON pj.id = (
+            SELECT id FROM pdf_jobs WHERE pdf_id = pf.id ORDER BY created_at DESC LIMIT 1
+        )
+        WHERE pf.content_hash = ? AND pj.estado != 'error'
+          AND NOT (pj.estado = 'procesando' AND pj.updated_at < ?)
+        ORDER BY pf.uploaded_at DESC
+    ''', (content_hash, vencimiento_reserva_trabajo()))
+    for pdf in c.fetchall():
+        if os.path.isfile(pdf['file_path']):
+            return pdf
+    return None
+
+def descartar_ingestas_abandonadas(c, content_hash):
+    """Marca con error las ingestas abandonadas de un contenido que se vuelve a subir
+
+    La copia nueva reemplaza a la vieja: esta pierde sus páginas a medias y
+    liberar_trabajos_vencidos ya no la reprocesa.
+    """
+    c.execute('''
+        SELECT pj.id, pj.pdf_id FROM pdf_jobs pj
+        INNER JOIN pdf_files pf ON pf.id = pj.pdf_id
+        WHERE pf.content_hash = ? AND pj.estado = 'procesando' AND pj.updated_at < ?
+    ''', (content_hash, vencimiento_reserva_trabajo()))
+    for trabajo in c.fetchall():
+        actualizar_trabajo(c, trabajo['id'], estado='error', fase=None,
+                           error='La ingesta se interrumpió y el PDF se volvió a subir')
+        borrar_paginas_de_pdf(c, trabajo['pdf_id'])
+
+@app.route('/api/subir-pdf', methods=['POST'])
+def subir_pdf():
+    """Guarda el PDF y encola su procesamiento
+
+    Si ya se subió un PDF con el mismo contenido se devuelve ese, con su
+    texto e imágenes ya extraídos, sin volver a procesarlo.
+    """
+    if 'archivo' not in request.files:
+        return jsonify({'error': 'No se proporcionó ningún archivo'}), 400
+    
+    archivo = request.files['archivo']
+    if archivo.filename == '':
+        return jsonify({'error': 'No se seleccionó ningún archivo'}), 400
+    
+    if not archivo.filename.endswith('.pdf'):
+        return jsonify({'error': 'El archivo debe ser un PDF'}), 400
+    
+    nombre_archivo = secure_filename(archivo.filename)
     
-    contexto_pdf = ""
-    if contenido_pdfs:
-        contexto_pdf = "\n\nContenido de PDFs procesados:\n"
-        pdf_actual = None
+    try:
+        conn = get_db()
+        c = conn.cursor()
         
-        for fila in contenido_pdfs:
-            if fila['filename'] != pdf_actual:
-                pdf_actual = fila['filename']
-                contexto_pdf += f"\n--- {pdf_actual} ---\n"
-            
-            if fila['text_content']:
-                contexto_pdf += f"Página {fila['page_number']}: {fila['text_content'][:500]}...\n"
-        
-        # Agregar imágenes disponibles
-        if imagenes_pdfs:
-            contexto_pdf += "\n\nImágenes extraídas del PDF:\n"
-            for img in imagenes_pdfs:
-                if img['image_name']:
-                    # Crear URL para la imagen
-                    imagen_url = f"https://prueba-7-tr52.onrender.com/api/imagen/{img['pdf_id']}/{img['image_name']}"
-                    descripcion = img['image_description'] or f"Página {img['page_number']}"
-                    contexto_pdf += f"![{descripcion}]({imagen_url})\n"
-        
-        # Limitar el contexto total
-        if len(contexto_pdf) > 4000:
-            contexto_pdf = contexto_pdf[:4000] + "...\n"
+        content_hash = archivo.stream.sha.hexdigest()
+        existente = buscar_pdf_por_hash(c, content_hash)
+        if existente:
+            registrar(logging.INFO, "PDF ya subido, no se reprocesa", muestrear=True,
+                      archivo=nombre_archivo, pdf_id=existente['id'])
+            return jsonify({
+                'exito': True,
+                'duplicado': True,
+                'pdfId': existente['id'],
+                'nombreArchivo': existente['filename'],
+                'jobId': existente['job_id'],
+                'estado': existente['estado'],
+                'urlEstado': f"/api/pdf/{existente['id']}/estado"
+            }), 200
+        
+        pdf_id = str(uuid.uuid4())
+        ruta_archivo = os.path.join(app.config['UPLOAD_FOLDER'], f'{pdf_id}_{nombre_archivo}')
+        archivo.stream.guardar_como(ruta_archivo)
+        
+        descartar_ingestas_abandonadas(c, content_hash)
+        c.execute('''
+            INSERT INTO pdf_files (id, filename, file_path, content_hash)
+            VALUES (?, ?, ?, ?)
+        ''', (pdf_id, nombre_archivo, ruta_archivo, content_hash))
+        
+        job_id = str(uuid.uuid4())
+        c.execute('''
+            INSERT INTO pdf_jobs (id, pdf_id, estado, created_at, updated_at)
+            VALUES (?, ?, 'pendiente', ?, ?)
+        ''', (job_id, pdf_id, datetime.now().isoformat(), datetime.now().isoformat()))
+        
+        conn.commit()
+        
+        # El texto y las imágenes se extraen en segundo plano
+        encolar_trabajo(job_id, pdf_id, ruta_archivo)
+        
+        return jsonify({
+            'exito': True,
+            'pdfId': pdf_id,
+            'nombreArchivo': nombre_archivo,
+            'jobId': job_id,
+            'estado': 'pendiente',
+            'urlEstado': f'/api/pdf/{pdf_id}/estado'
+        }), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def pdfs_de_la_subida(archivos):
+    """Produce (nombre, ArchivoSubidaConHash, error) por cada PDF de una subida en lote
+
+    Los .zip se recorren miembro a miembro: cada PDF se copia por bloques a
+    un temporal de UPLOAD_FOLDER mientras se calcula su hash, sin
+    descomprimir el zip entero ni cargar un PDF completo en memoria.
+    """
+    limite_archivo = app.config['MAX_CONTENT_LENGTH']
+    for archivo in archivos:
+        if archivo.filename.lower().endswith('.pdf'):
+            yield archivo.filename, archivo.stream, None
+            continue
+        if not archivo.filename.lower().endswith('.zip'):
+            yield archivo.filename, None, 'El archivo debe ser un PDF o un .zip con PDFs'
+            continue
+        
+        try:
+            zip_subido = zipfile.ZipFile(archivo.stream)
+        except (zipfile.BadZipFile, OSError) as e:
+            yield archivo.filename, None, f'No se pudo leer el .zip: {e}'
+            continue
+        with zip_subido:
+            for miembro in zip_subido.infolist():
+                nombre = os.path.basename(miembro.filename)
+                # Carpetas, metadatos de macOS y archivos ocultos
+                if miembro.is_dir() or not nombre or nombre.startswith('.') or '__MACOSX' in miembro.filename:
+                    continue
+                if not nombre.lower().endswith('.pdf'):
+                    yield nombre, None, 'El archivo debe ser un PDF'
+                    continue
+                if miembro.file_size > limite_archivo:
+                    yield nombre, None, 'El PDF supera el tamaño máximo'
+                    continue
+                
+                destino = ArchivoSubidaConHash(app.config['UPLOAD_FOLDER'])
+                try:
+                    with zip_subido.open(miembro) as origen:
+                        copiados = 0
+                        for bloque in iter(lambda: origen.read(1024 * 1024), b''):
+                            # file_size sale del zip y puede mentir
+                            copiados += len(bloque)
+                            if copiados > limite_archivo:
+                                raise ValueError('El PDF supera el tamaño máximo')
+                            destino.write(bloque)
+                except (zipfile.BadZipFile, RuntimeError, NotImplementedError, ValueError, OSError, EOFError) as e:
+                    destino.descartar()
+                    yield nombre, None, f'No se pudo extraer del .zip: {e}'
+                    continue
+                yield nombre, destino, None
+
+def registrar_pdfs_subidos(c, nuevos):
+    """Inserta en una sola transacción los PDFs nuevos de la subida y sus trabajos"""
+    ahora = datetime.now().isoformat()
+    for nuevo in nuevos:
+        descartar_ingestas_abandonadas(c, nuevo['hash'])
+    c.executemany('''
+        INSERT INTO pdf_files (id, filename, file_path, content_hash)
+        VALUES (?, ?, ?, ?)
+    ''', [(nuevo['pdfId'], nuevo['nombreArchivo'], nuevo['ruta'], nuevo['hash']) for nuevo in nuevos])
+    c.executemany('''
+        INSERT INTO pdf_jobs (id, pdf_id, estado, created_at, updated_at)
+        VALUES (?, ?, 'pendiente', ?, ?)
+    ''', [(nuevo['jobId'], nuevo['pdfId'], ahora, ahora) for nuevo in nuevos])
+
+def linea_ndjson(datos):
+    return json.dumps(datos, ensure_ascii=False) + '\n'
+
+@app.route('/api/subir-pdfs', methods=['POST'])
+def subir_pdfs():
+    """Sube varios PDFs (o .zip con PDFs) en una petición y los procesa en una sola pasada
+
+    Los archivos van en el campo 'archivos'. La respuesta es NDJSON: una
+    línea por archivo en cuanto queda registrado o rechazado, con los mismos
+    campos que /api/subir-pdf, y una última línea con el resumen. Los PDFs
+    nuevos se registran en transacciones de hasta ARCHIVOS_POR_GRUPO_LOTE
+    archivos y pasan todos por una misma ingesta en lote (procesar_lote_pdfs).
+    Si la subida se corta por un error, la última línea lleva también 'error'.
+    """
+    archivos = [archivo for archivo in request.files.getlist('archivos') if archivo.filename]
+    if not archivos:
+        return jsonify({'error': 'No se proporcionó ningún archivo'}), 400
     
-    # Agregar contexto del PDF al primer mensaje si hay PDFs
-    if contexto_pdf and historial:
-        # Modificar el último mensaje del usuario para incluir contexto
-        ultimo_mensaje = historial[-1]
-        if ultimo_mensaje['role'] == 'user':
-            ultimo_mensaje['content'] += contexto_pdf
+    def generar():
+        conn = get_db()
+        c = conn.cursor()
+        trabajos = None
+        destino = None
+        por_hash = {}
+        grupo = []
+        resumen = {'nuevos': 0, 'duplicados': 0, 'errores': 0}
+        
+        def descartar_nuevos(nuevos, error):
+            """Borra los PDFs guardados que no se llegaron a registrar y los informa como error"""
+            for resultado in nuevos:
+                if os.path.exists(resultado['ruta']):
+                    os.remove(resultado['ruta'])
+                archivo = resultado['archivo']
+                resultado.clear()
+                resultado.update(exito=False, archivo=archivo, error=error)
+        
+        def confirmar_grupo():
+            nuevos = [resultado for resultado in grupo if resultado.get('ruta')]
+            try:
+                if nuevos:
+                    registrar_pdfs_subidos(c, nuevos)
+                    conn.commit()
+            except Exception as e:
+                conn.rollback()
+                registrar(logging.ERROR, "Error registrando PDFs de una subida en lote", exc_info=True)
+                descartar_nuevos(nuevos, str(e))
+            else:
+                for resultado in nuevos:
+                    trabajos.put((resultado['jobId'], resultado['pdfId'], resultado['ruta']))
+            
+            lineas = []
+            for resultado in grupo:
+                resultado.pop('ruta', None)
+                resultado.pop('hash', None)
+                if not resultado['exito']:
+                    resumen['errores'] += 1
+                elif resultado.get('duplicado'):
+                    resumen['duplicados'] += 1
+                else:
+                    resumen['nuevos'] += 1
+                lineas.append(linea_ndjson(resultado))
+            grupo.clear()
+            return ''.join(lineas)
+        
+        try:
+            trabajos = queue.Queue()
+            obtener_ejecutor_lotes().submit(procesar_lote_pdfs, trabajos)
+            ultimo_envio = time.monotonic()
+            
+            for posicion, (nombre, destino, error) in enumerate(pdfs_de_la_subida(archivos)):
+                nombre_archivo = secure_filename(nombre) or 'documento.pdf'
+                if posicion >= MAX_ARCHIVOS_LOTE:
+                    if destino is not None:
+                        destino.descartar()
+                    grupo.append({'exito': False, 'archivo': nombre,
+                                  'error': f'Se superó el máximo de {MAX_ARCHIVOS_LOTE} archivos por subida; '
+                                           'no se procesó este ni los siguientes'})
+                    break
+                if error:
+                    grupo.append({'exito': False, 'archivo': nombre, 'error': error})
+                else:
+                    content_hash = destino.sha.hexdigest()
+                    existente = por_hash.get(content_hash) or buscar_pdf_por_hash(c, content_hash)
+                    if existente:
+                        # Repetido dentro de la subida o ya subido antes: no se vuelve a procesar
+                        destino.descartar()
+                        grupo.append({
+                            'exito': True,
+                            'duplicado': True,
+                            'archivo': nombre,
+                            'pdfId': existente['id'],
+                            'nombreArchivo': existente['filename'],
+                            'jobId': existente['job_id'],
+                            'estado': existente['estado'],
+                            'urlEstado': f"/api/pdf/{existente['id']}/estado"
+                        })
+                    else:
+                        pdf_id = str(uuid.uuid4())
+                        ruta_archivo = os.path.join(app.config['UPLOAD_FOLDER'], f'{pdf_id}_{nombre_archivo}')
+                        destino.guardar_como(ruta_archivo)
+                        resultado = {
+                            'exito': True,
+                            'archivo': nombre,
+                            'pdfId': pdf_id,
+                            'nombreArchivo': nombre_archivo,
+                            'jobId': str(uuid.uuid4()),
+                            'estado': 'pendiente',
+                            'urlEstado': f'/api/pdf/{pdf_id}/estado',
+                            'ruta': ruta_archivo,
+                            'hash': content_hash
+                        }
+                        grupo.append(resultado)
+                        por_hash[content_hash] = {'id': pdf_id, 'filename': nombre_archivo,
+                                                  'job_id': resultado['jobId'], 'estado': 'pendiente'}
+                
+                destino = None
+                
+                # Se responde por grupos: cada ARCHIVOS_POR_GRUPO_LOTE archivos o cada segundo
+                if len(grupo) >= ARCHIVOS_POR_GRUPO_LOTE or time.monotonic() - ultimo_envio >= 1:
+                    yield confirmar_grupo()
+                    ultimo_envio = time.monotonic()
             
-        # Agregar instrucciones específicas para respuestas más directas
-        instrucciones = """
+            if grupo:
+                yield confirmar_grupo()
+            yield linea_ndjson({'fin': True, **resumen})
+        except Exception as e:
+            registrar(logging.ERROR, "Error en una subida en lote", exc_info=True, archivos=len(archivos))
+            conn.rollback()
+            # El PDF que se estaba revisando no llegó al grupo
+            if destino is not None:
+                destino.descartar()
+            # Lo ya aceptado del grupo pendiente se informa; los PDFs nuevos no se registraron
+            descartar_nuevos([resultado for resultado in grupo if resultado.get('ruta')],
+                             'No se registró porque la subida se interrumpió')
+            if grupo:
+                yield confirmar_grupo()
+            yield linea_ndjson({'fin': True, 'error': str(e), **resumen})
+        finally:
+            # Sin este aviso la ingesta en lote esperaría más trabajos para siempre
+            if trabajos is not None:
+                trabajos.put(None)
+    
+    respuesta = Response(stream_with_context(generar()), mimetype='application/x-ndjson')
+    # Que los proxies entreguen cada línea en cuanto se escribe
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+@app.route('/api/pdf/<pdf_id>/estado', methods=['GET'])
+def estado_pdf(pdf_id):
+    """Devolver el progreso del procesamiento de un PDF"""
+    conn = get_db()
+    c = conn.cursor()
+    
+    c.execute('''
+        SELECT id, estado, fase, paginas_total, paginas_procesadas, error, created_at, updated_at
+        FROM pdf_jobs
+        WHERE pdf_id = ?
+        ORDER BY created_at DESC
+        LIMIT 1
+    ''', (pdf_id,))
+    trabajo = c.fetchone()
+    
+    if not trabajo:
+        return jsonify({'error': 'No hay procesamiento registrado para este PDF'}), 404
+    
+    return jsonify({
+        'pdfId': pdf_id,
+        'jobId': trabajo['id'],
+        'estado': trabajo['estado'],
+        'fase': trabajo['fase'],
+        'paginasTotal': trabajo['paginas_total'],
+        'paginasProcesadas': trabajo['paginas_procesadas'],
+        'error': trabajo['error'],
+        'creadoEn': trabajo['created_at'],
+        'actualizadoEn': trabajo['updated_at']
+    })
+
+@app.route('/api/pdf/<pdf_id>', methods=['DELETE'])
+def eliminar_pdf(pdf_id):
+    """Borra un PDF con su texto, imágenes, fragmentos y archivos en disco
+
+    Un PDF en proceso solo se puede borrar si su reserva venció, es decir,
+    si la ingesta quedó abandonada.
+    """
+    conn = get_db()
+    c = conn.cursor()
+    
+    c.execute('''
+        SELECT estado, updated_at FROM pdf_jobs WHERE pdf_id = ? ORDER BY created_at DESC LIMIT 1
+    ''', (pdf_id,))
+    trabajo = c.fetchone()
+    if (trabajo and trabajo['estado'] == 'procesando'
+            and trabajo['updated_at'] >= vencimiento_reserva_trabajo()):
+        return jsonify({'error': 'El PDF se está procesando, intenta cuando termine'}), 409
+    
+    liberados = borrar_pdf(conn, pdf_id, 'api')
+    if liberados is None:
+        return jsonify({'error': 'PDF no encontrado'}), 404
+    
+    return jsonify({'exito': True, 'pdfId': pdf_id, 'bytesLiberados': liberados})
+
+@app.route('/api/pdf/<pdf_id>/imagenes', methods=['GET'])
+def manifiesto_imagenes(pdf_id):
+    """Manifiesto paginado de las imágenes de un PDF
+
+    Acepta ?limite= y ?despues=<página>. El ETag sale del hash del PDF, de
+    su contador de imágenes y de la página pedida, así que una revalidación
+    sin cambios se responde con 304 tras una sola lectura por clave primaria.
+    """
+    despues = request.args.get('despues', '0')
+    try:
+        limite = limite_solicitado(request.args)
+        if not despues.isdigit():
+            raise ValueError(f"Página inválida: {despues}")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    despues = int(despues)
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    c.execute('SELECT id, filename, content_hash, imagenes FROM pdf_files WHERE id = ?', (pdf_id,))
+    pdf = c.fetchone()
+    if not pdf:
+        return jsonify({'error': 'PDF no encontrado'}), 404
+    
+    etag = f"{version_imagen(pdf['content_hash']) or 'sin-hash'}-{pdf['imagenes']}-{despues}-{limite}"
+    if request.if_none_match.contains(etag):
+        respuesta = Response(status=304)
+    else:
+        c.execute('''
+            SELECT page_number, image_name, image_description
+            FROM pdf_images
+            WHERE pdf_id = ? AND page_number > ?
+            ORDER BY page_number ASC
+            LIMIT ?
+        ''', (pdf_id, despues, limite + 1))
+        filas = c.fetchall()
+        hay_mas = len(filas) > limite
+        filas = filas[:limite]
+        
+        imagenes = []
+        for fila in filas:
+            img = {'pdf_id': pdf_id, 'image_name': fila['image_name'], 'content_hash': pdf['content_hash']}
+            imagenes.append({
+                'pagina': fila['page_number'],
+                'nombreImagen': fila['image_name'],
+                'descripcion': fila['image_description'],
+                'url': url_imagen(img, absoluta=False),
+                'urlMiniatura': url_imagen(img, absoluta=False, w=400, fmt='webp')
+            })
+        
+        respuesta = jsonify({
+            'pdfId': pdf_id,
+            'nombreArchivo': pdf['filename'],
+            'totalImagenes': pdf['imagenes'],
+            'imagenes': imagenes,
+            'siguiente': filas[-1]['page_number'] if hay_mas else None
+        })
+    
+    respuesta.set_etag(etag)
+    # Mientras se procesa el PDF el manifiesto crece: el navegador revalida siempre
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
+
+def normalizar_pregunta(mensaje):
+    """Normaliza la pregunta para que variaciones triviales compartan caché
+
+    Ignora mayúsculas, tildes, signos de puntuación y espacios repetidos.
+    """
+    texto = unicodedata.normalize('NFKD', mensaje.casefold())
+    texto = ''.join(caracter for caracter in texto if not unicodedata.combining(caracter))
+    texto = re.sub(r'[^\w\s]', ' ', texto)
+    return ' '.join(texto.split())
+
+def clave_cache_respuesta(mensaje, contexto_pdf):
+    """Clave de caché: pregunta normalizada, huella del contexto recuperado y modelo
+
+    Si cambian las páginas que se recuperan para la pregunta cambia la
+    huella, y con ella la clave: no hace falta invalidar al escribir PDFs.
+    """
+    huella_contexto = hashlib.sha256(contexto_pdf.encode('utf-8')).hexdigest()
+    return hashlib.sha256('\0'.join(
+        [normalizar_pregunta(mensaje), huella_contexto, MODEL_NAME]).encode('utf-8')).hexdigest()
+
+def contar_cache(c, nombre, cantidad=1):
+    """Incrementa un contador de la caché (compartido entre procesos)"""
+    c.execute('''
+        INSERT INTO cache_estadisticas (nombre, valor) VALUES (?, ?)
+        ON CONFLICT(nombre) DO UPDATE SET valor = valor + excluded.valor
+    ''', (nombre, cantidad))
+
+def obtener_respuesta_cacheada(c, clave):
+    """Devuelve la respuesta guardada para la clave si sigue vigente"""
+    ahora = time.time()
+    c.execute('''
+        SELECT respuesta FROM respuestas_cache
+        WHERE clave = ? AND creada_en > ?
+    ''', (clave, ahora - RESPUESTAS_CACHE_TTL))
+    fila = c.fetchone()
+    if fila is None:
+        contar_cache(c, 'fallos')
+        return None
+    
+    c.execute('''
+        UPDATE respuestas_cache SET ultimo_uso = ?, aciertos = aciertos + 1
+        WHERE clave = ?
+    ''', (ahora, clave))
+    contar_cache(c, 'aciertos')
+    return fila['respuesta']
+
+def guardar_respuesta_cacheada(c, clave, respuesta):
+    """Guarda una respuesta y descarta las vencidas y las menos usadas (LRU)"""
+    ahora = time.time()
+    c.execute('''
+        INSERT OR REPLACE INTO respuestas_cache (clave, respuesta, creada_en, ultimo_uso)
+        VALUES (?, ?, ?, ?)
+    ''', (clave, respuesta, ahora, ahora))
+    
+    c.execute('DELETE FROM respuestas_cache WHERE creada_en <= ?', (ahora - RESPUESTAS_CACHE_TTL,))
+    c.execute('''
+        DELETE FROM respuestas_cache WHERE clave IN (
+            SELECT clave FROM respuestas_cache
+            ORDER BY ultimo_uso DESC
+            LIMIT -1 OFFSET ?
+        )
+    ''', (RESPUESTAS_CACHE_MAX,))
+    if c.rowcount > 0:
+        contar_cache(c, 'desalojos', c.rowcount)
+
+# Agregar instrucciones específicas para respuestas más directas
+INSTRUCCIONES_RESPUESTA = """
 INSTRUCCIONES IMPORTANTES:
 - Responde en lenguaje natural, como una conversación normal
 - NO uses emojis, asteriscos, negritas, o formato especial
@@ -418,157 +2580,712 @@ INSTRUCCIONES IMPORTANTES:
 - Si hablas de páginas específicas, menciona el número de página claramente
 - Mantén las respuestas concisas y naturales
 - Habla como si fueras una persona explicando el contenido del documento"""
+
+def reservar_turno(conn, id_sesion, titulo):
+    """Reserva la sesión para un turno; False si otro turno la ocupa más de ESPERA_TURNO_SESION
+
+    La reserva es un vencimiento en chat_sessions.turno_hasta: vale entre
+    hilos y entre procesos, y vence sola si el proceso que la tomó muere.
+    Crea la sesión si no existe (también si el cliente trae un id que ya no
+    está) y confirma la reserva enseguida, así el lock de escritura no queda
+    tomado durante la búsqueda de contexto.
+    """
+    limite_espera = time.monotonic() + ESPERA_TURNO_SESION
+    c = conn.cursor()
+    while True:
+        ahora = time.time()
+        # Leer sin transacción: la espera no toma el lock de escritura
+        c.execute('SELECT turno_hasta FROM chat_sessions WHERE id = ?', (id_sesion,))
+        fila = c.fetchone()
+        if fila is None or fila['turno_hasta'] is None or fila['turno_hasta'] < ahora:
+            c.execute('''
+                INSERT OR IGNORE INTO chat_sessions (id, title, created_at, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', (id_sesion, titulo[:50], datetime.now().isoformat(), datetime.now().isoformat()))
+            c.execute('''
+                UPDATE chat_sessions SET turno_hasta = ?
+                WHERE id = ? AND (turno_hasta IS NULL OR turno_hasta < ?)
+            ''', (ahora + RESERVA_TURNO_SEGUNDOS, id_sesion, ahora))
+            if c.rowcount == 1:
+                conn.commit()
+                return True
+            # Otro proceso la reservó entre la lectura y la escritura
+            conn.rollback()
+        if time.monotonic() >= limite_espera:
+            return False
+        time.sleep(0.1)
+
+def liberar_turno(conn, id_sesion):
+    """Quita la reserva de un turno que terminó sin guardar respuesta
+
+    Si la sesión la había creado este mismo turno se queda sin mensajes
+    y se borra, para no dejar conversaciones vacías en el historial.
+    """
+    try:
+        conn.rollback()
+        conn.execute('UPDATE chat_sessions SET turno_hasta = NULL WHERE id = ?', (id_sesion,))
+        conn.execute('''
+            DELETE FROM chat_sessions
+            WHERE id = ? AND NOT EXISTS (SELECT 1 FROM messages WHERE session_id = ?)
+        ''', (id_sesion, id_sesion))
+        conn.commit()
+    except sqlite3.Error as e:
+        registrar(logging.WARNING, "No se pudo liberar el turno", sesion=id_sesion, error=str(e))
+
+def rechazar_turno(motivo, mensaje_error, id_sesion=None):
+    """Respuesta 429 con Retry-After para un turno que no se puede atender ahora"""
+    METRICA_CHAT_RECHAZOS.incrementar(motivo=motivo)
+    registrar(logging.INFO, "Turno de chat rechazado", muestrear=True, motivo=motivo, sesion=id_sesion)
+    respuesta = jsonify({'error': mensaje_error, 'motivo': motivo, 'idSesion': id_sesion,
+                         'reintentarEn': REINTENTAR_TRAS_SEGUNDOS})
+    respuesta.status_code = 429
+    respuesta.headers['Retry-After'] = str(REINTENTAR_TRAS_SEGUNDOS)
+    return respuesta
+
+def rechazar_sesion_ocupada(id_sesion):
+    return rechazar_turno('sesion_ocupada',
+                          'Esta conversación todavía está respondiendo la pregunta anterior', id_sesion)
+
+def rechazar_llm_saturado(id_sesion):
+    return rechazar_turno('llm_saturado',
+                          'Hay demasiadas preguntas en curso, intenta de nuevo en unos segundos', id_sesion)
+
+def preparar_turno(c, mensaje, id_sesion, cronometro):
+    """Guarda el mensaje del usuario y arma los mensajes para el modelo
+
+    La sesión ya debe estar reservada con reservar_turno. El contexto se
+    busca antes de escribir el mensaje, fuera de la transacción, para no
+    retener el lock de escritura durante la búsqueda. Devuelve (id_sesion,
+    historial, contexto_pdf, imagenes_pdfs) y mide las etapas 'contexto' e
+    'historial'.
+    """
+    with cronometro.etapa('contexto'):
+        contexto_pdf, imagenes_pdfs = construir_contexto_pdf(c, mensaje)
+    
+    with cronometro.etapa('historial'):
+        # Guardar mensaje del usuario
+        id_mensaje = str(uuid.uuid4())
+        c.execute('''
+            INSERT INTO messages (id, session_id, role, content, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (id_mensaje, id_sesion, 'usuario', mensaje, datetime.now().isoformat()))
         
-        ultimo_mensaje['content'] += instrucciones
+        # Obtener historial de la conversación (reciente + resumen de lo anterior)
+        historial = construir_historial(c, id_sesion)
+    
+    # Agregar contexto del PDF al primer mensaje si hay PDFs
+    if contexto_pdf and historial:
+        # Modificar el último mensaje del usuario para incluir contexto
+        ultimo_mensaje = historial[-1]
+        if ultimo_mensaje['role'] == 'user':
+            ultimo_mensaje['content'] += contexto_pdf
+        
+        ultimo_mensaje['content'] += INSTRUCCIONES_RESPUESTA
+    
+    return id_sesion, historial, contexto_pdf, imagenes_pdfs
+
+def guardar_respuesta(c, id_sesion, respuesta_final):
+    """Guarda la respuesta del asistente, actualiza la fecha de la sesión y libera el turno"""
+    id_respuesta = str(uuid.uuid4())
+    c.execute('''
+        INSERT INTO messages (id, session_id, role, content, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (id_respuesta, id_sesion, 'asistente', respuesta_final, datetime.now().isoformat()))
+    
+    c.execute('''
+        UPDATE chat_sessions
+        SET updated_at = ?, turno_hasta = NULL
+        WHERE id = ?
+    ''', (datetime.now().isoformat(), id_sesion))
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    datos = request.json
+    mensaje = datos.get('mensaje')
+    id_sesion = datos.get('idSesion') or str(uuid.uuid4())
+    
+    if not mensaje:
+        return jsonify({'error': 'Se requiere un mensaje'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    cronometro = observabilidad.Cronometro(METRICA_CHAT_ETAPAS, modo='completo')
+    
+    with cronometro.etapa('espera_sesion'):
+        reservado = reservar_turno(conn, id_sesion, mensaje)
+    if not reservado:
+        return rechazar_sesion_ocupada(id_sesion)
     
-    # Llamar a la API de OpenRouter
+    admitido = False
     try:
-        print(f"API Key disponible: {bool(OPENROUTER_API_KEY)}")
-        print(f"Modelo: {MODEL_NAME}")
-        print(f"Historial: {historial}")
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": MODEL_NAME,
-            "messages": historial,
-            "temperature": 0.7,
-            "max_tokens": 2000
-        }
-        
-        print(f"Enviando petición a OpenRouter...")
-        respuesta = requests.post(API_URL, headers=headers, json=data, timeout=30)
-        print(f"Código de respuesta: {respuesta.status_code}")
-        
-        if respuesta.status_code != 200:
-            print(f"Error en API: {respuesta.text}")
-            respuesta_asistente = f"Error en la API: {respuesta.status_code} - {respuesta.text[:200]}"
-        else:
+        id_sesion, historial, contexto_pdf, imagenes_pdfs = preparar_turno(c, mensaje, id_sesion, cronometro)
+        
+        # La caché solo aplica a la primera pregunta: después la respuesta depende del historial
+        with cronometro.etapa('cache'):
+            clave_cache = clave_cache_respuesta(mensaje, contexto_pdf) if len(historial) == 1 else None
+            respuesta_asistente = obtener_respuesta_cacheada(c, clave_cache) if clave_cache else None
+        desde_cache = respuesta_asistente is not None
+        
+        if not desde_cache:
+            admitido = limite_llm.adquirir()
+            if not admitido:
+                # Sin lugar para llamar al modelo: se descarta el mensaje, se libera la reserva
+                # y, si la sesión era nueva, también se borra
+                liberar_turno(conn, id_sesion)
+                return rechazar_llm_saturado(id_sesion)
+        
+        # Confirmar el mensaje antes de llamar al modelo, para no
+        # retener el lock de escritura de la base durante la llamada
+        conn.commit()
+        
+        # Llamar a la API de OpenRouter
+        if not desde_cache:
+            inicio_llm = time.perf_counter()
+            resultado_llm = 'ok'
             try:
-                datos_respuesta = respuesta.json()
-                print(f"Respuesta de API: {datos_respuesta}")
-                if 'choices' in datos_respuesta and len(datos_respuesta['choices']) > 0:
-                    respuesta_asistente = datos_respuesta['choices'][0]['message']['content']
-                else:
-                    respuesta_asistente = "No se pudo obtener una respuesta del asistente."
-            except ValueError as ve:
-                print(f"Error al parsear JSON: {ve}")
-                respuesta_asistente = "Error al procesar la respuesta del asistente."
+                respuesta_asistente = cliente_llm.completar(historial, MODEL_NAME, temperature=0.7, max_tokens=2000)
+            except ErrorLLM as error_api:
+                resultado_llm = 'error'
+                registrar(logging.WARNING, "Error en API", status=error_api.status,
+                          detalle=str(error_api.detalle or error_api)[:500])
+                respuesta_asistente = str(error_api)
+            finally:
+                limite_llm.liberar()
+                admitido = False
+            duracion_llm = time.perf_counter() - inicio_llm
+            cronometro.registrar('llm', duracion_llm)
+            METRICA_LLM.observar(duracion_llm, modo='completo', resultado=resultado_llm)
         
         # Post-procesar respuesta para insertar imágenes automáticamente
-        respuesta_final = procesar_respuesta_con_imagenes(respuesta_asistente, imagenes_pdfs)
+        with cronometro.etapa('imagenes'):
+            respuesta_final = procesar_respuesta_con_imagenes(respuesta_asistente, imagenes_pdfs)
         
         # Guardar respuesta del asistente
-        id_respuesta = str(uuid.uuid4())
-        c.execute('''
-            INSERT INTO messages (id, session_id, role, content, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (id_respuesta, id_sesion, 'asistente', respuesta_final, datetime.now().isoformat()))
+        with cronometro.etapa('guardado'):
+            if clave_cache and not desde_cache and resultado_llm == 'ok':
+                guardar_respuesta_cacheada(c, clave_cache, respuesta_asistente)
+            guardar_respuesta(c, id_sesion, respuesta_final)
+            conn.commit()
         
-        c.execute('''
-            UPDATE chat_sessions
-            SET updated_at = ?
-            WHERE id = ?
-        ''', (datetime.now().isoformat(), id_sesion))
-        
-        conn.commit()
-        conn.close()
+        registrar(logging.INFO, "Turno de chat", muestrear=True, modo='completo', sesion=id_sesion,
+                  mensajes_historial=len(historial), cache=desde_cache,
+                  duracion_ms=round(cronometro.total * 1000, 1), etapas=cronometro.duraciones)
         
         return jsonify({
             'respuesta': respuesta_final,
             'idSesion': id_sesion
         })
     except Exception as e:
-        print(f"Error en chat: {str(e)}")
-        if 'conn' in locals():
-            conn.close()
+        registrar(logging.ERROR, "Error en chat", exc_info=True, sesion=id_sesion)
+        if admitido:
+            limite_llm.liberar()
+        liberar_turno(conn, id_sesion)
         return jsonify({'error': f'Error interno: {str(e)}'}), 500
 
-@app.route('/api/historial', methods=['GET'])
-def historial():
-    id_sesion = request.args.get('idSesion')
+def evento_sse(evento, datos):
+    """Serializa un evento de Server-Sent Events"""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+# Caracteres tras los cuales un fragmento de la respuesta se considera completo
+_patron_limite_frase = re.compile(r'[.,;:!?\n]')
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Variante de /api/chat que envía la respuesta token a token por Server-Sent Events
+
+    Eventos: 'sesion' (idSesion), 'token' (texto), 'imagen' (página mencionada
+    con imagen disponible), 'error' y 'fin' (respuesta final ya guardada).
+    El lugar en el cupo del modelo y la reserva de la sesión se liberan al
+    cerrar la respuesta, también si el cliente se desconecta a mitad.
+    """
+    datos = request.json
+    mensaje = datos.get('mensaje')
+    id_sesion = datos.get('idSesion') or str(uuid.uuid4())
+    
+    if not mensaje:
+        return jsonify({'error': 'Se requiere un mensaje'}), 400
+    
     conn = get_db()
     c = conn.cursor()
+    cronometro = observabilidad.Cronometro(METRICA_CHAT_ETAPAS, modo='stream')
     
-    if id_sesion:
+    with cronometro.etapa('espera_sesion'):
+        reservado = reservar_turno(conn, id_sesion, mensaje)
+    if not reservado:
+        return rechazar_sesion_ocupada(id_sesion)
+    
+    admitido = False
+    try:
+        id_sesion, historial, contexto_pdf, imagenes_pdfs = preparar_turno(c, mensaje, id_sesion, cronometro)
+        
+        # La caché solo aplica a la primera pregunta: después la respuesta depende del historial
+        with cronometro.etapa('cache'):
+            clave_cache = clave_cache_respuesta(mensaje, contexto_pdf) if len(historial) == 1 else None
+            respuesta_cacheada = obtener_respuesta_cacheada(c, clave_cache) if clave_cache else None
+        
+        if respuesta_cacheada is None:
+            admitido = limite_llm.adquirir()
+            if not admitido:
+                liberar_turno(conn, id_sesion)
+                return rechazar_llm_saturado(id_sesion)
+        
+        # Confirmar antes de empezar para no bloquear la base durante el stream
+        conn.commit()
+    except Exception as e:
+        registrar(logging.ERROR, "Error en chat", exc_info=True, sesion=id_sesion)
+        if admitido:
+            limite_llm.liberar()
+        liberar_turno(conn, id_sesion)
+        return jsonify({'error': f'Error interno: {str(e)}'}), 500
+    
+    imagenes_por_pagina = mapa_imagenes_por_pagina(imagenes_pdfs)
+    miniaturas_por_pagina = mapa_imagenes_por_pagina(imagenes_pdfs, w=400, fmt='webp')
+    turno = {'admitido': admitido, 'guardado': False}
+    
+    def liberar_llm():
+        if turno['admitido']:
+            turno['admitido'] = False
+            limite_llm.liberar()
+    
+    def terminar_turno():
+        liberar_llm()
+        if not turno['guardado']:
+            liberar_turno(get_db(), id_sesion)
+    
+    def generar():
+        yield evento_sse('sesion', {'idSesion': id_sesion})
+        
+        partes = []
+        texto = ''
+        revisado_hasta = 0
+        paginas_enviadas = set()
+        
+        error_en_respuesta = False
+        inicio_llm = time.perf_counter()
+        try:
+            if respuesta_cacheada is not None:
+                fragmentos = [respuesta_cacheada]
+            else:
+                fragmentos = cliente_llm.completar_stream(historial, MODEL_NAME, temperature=0.7, max_tokens=2000)
+            
+            for fragmento in fragmentos:
+                if not partes and respuesta_cacheada is None:
+                    METRICA_LLM_PRIMER_TOKEN.observar(time.perf_counter() - inicio_llm)
+                partes.append(fragmento)
+                texto += fragmento
+                yield evento_sse('token', {'texto': fragmento})
+                
+                # Buscar páginas solo en la parte ya completa de la respuesta;
+                # el solapamiento cubre menciones como "pág. 3" partidas en dos
+                limite = max((m.end() for m in _patron_limite_frase.finditer(fragmento)), default=None)
+                if limite is None:
+                    continue
+                fin_revision = len(texto) - len(fragmento) + limite
+                for pagina in paginas_mencionadas(texto[max(0, revisado_hasta - 20):fin_revision]):
+                    if (pagina in imagenes_por_pagina and pagina not in paginas_enviadas
+                            and len(paginas_enviadas) < MAX_IMAGENES_RESPUESTA):
+                        paginas_enviadas.add(pagina)
+                        yield evento_sse('imagen', {
+                            'pagina': pagina,
+                            'url': imagenes_por_pagina[pagina],
+                            'urlMiniatura': miniaturas_por_pagina[pagina]
+                        })
+                revisado_hasta = fin_revision
+        except ErrorLLM as error_api:
+            registrar(logging.WARNING, "Error en API", status=error_api.status,
+                      detalle=str(error_api.detalle or error_api)[:500])
+            error_en_respuesta = True
+            partes.append(str(error_api))
+            yield evento_sse('error', {'error': partes[-1]})
+        except Exception as e:
+            registrar(logging.ERROR, "Error en chat", exc_info=True, sesion=id_sesion)
+            error_en_respuesta = True
+            partes.append(f"Error interno: {str(e)}")
+            yield evento_sse('error', {'error': partes[-1]})
+        # El modelo ya terminó: su lugar queda libre aunque falte guardar
+        liberar_llm()
+        
+        # Incluye el tiempo de envío al cliente, que marca el ritmo del stream
+        duracion_llm = time.perf_counter() - inicio_llm
+        if respuesta_cacheada is None:
+            cronometro.registrar('llm', duracion_llm)
+            METRICA_LLM.observar(duracion_llm, modo='stream',
+                                 resultado='error' if error_en_respuesta else 'ok')
+        
+        respuesta_asistente = ''.join(partes) or "No se pudo obtener una respuesta del asistente."
+        with cronometro.etapa('imagenes'):
+            respuesta_final = procesar_respuesta_con_imagenes(respuesta_asistente, imagenes_pdfs)
+        
+        # Guardar la respuesta completa al terminar el stream
+        with cronometro.etapa('guardado'):
+            conn = get_db()
+            c = conn.cursor()
+            guardar_respuesta(c, id_sesion, respuesta_final)
+            if clave_cache and respuesta_cacheada is None and not error_en_respuesta and partes:
+                guardar_respuesta_cacheada(c, clave_cache, respuesta_asistente)
+            conn.commit()
+            turno['guardado'] = True
+        
+        registrar(logging.INFO, "Turno de chat", muestrear=True, modo='stream', sesion=id_sesion,
+                  mensajes_historial=len(historial), cache=respuesta_cacheada is not None,
+                  duracion_ms=round(cronometro.total * 1000, 1), etapas=cronometro.duraciones)
+        
+        yield evento_sse('fin', {'respuesta': respuesta_final, 'idSesion': id_sesion})
+    
+    respuesta = Response(stream_with_context(generar()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Evita que nginx/Render acumulen el stream antes de enviarlo
+        'X-Accel-Buffering': 'no'
+    })
+    # Se ejecuta al cerrar la respuesta, aunque el generador no llegue a terminar
+    respuesta.call_on_close(terminar_turno)
+    return respuesta
+
+@app.route('/api/cache/estadisticas', methods=['GET'])
+def estadisticas_cache():
+    """Devolver aciertos, fallos y ocupación de la caché de respuestas"""
+    conn = get_db()
+    c = conn.cursor()
+    
+    c.execute('SELECT nombre, valor FROM cache_estadisticas')
+    contadores = {fila['nombre']: fila['valor'] for fila in c.fetchall()}
+    c.execute('SELECT COUNT(*) AS entradas, COALESCE(SUM(LENGTH(respuesta)), 0) AS bytes FROM respuestas_cache')
+    ocupacion = c.fetchone()
+    
+    aciertos = contadores.get('aciertos', 0)
+    fallos = contadores.get('fallos', 0)
+    return jsonify({
+        'aciertos': aciertos,
+        'fallos': fallos,
+        'tasaAciertos': aciertos / (aciertos + fallos) if aciertos + fallos else 0.0,
+        'desalojos': contadores.get('desalojos', 0),
+        'entradas': ocupacion['entradas'],
+        'bytes': ocupacion['bytes'],
+        'maxEntradas': RESPUESTAS_CACHE_MAX,
+        'ttlSegundos': RESPUESTAS_CACHE_TTL
+    })
+
+# Tamaño de página del historial y largo de la vista previa del último mensaje
+LIMITE_HISTORIAL = 50
+LIMITE_HISTORIAL_MAX = 200
+LARGO_VISTA_PREVIA = 120
+
+def codificar_cursor(fecha, id_fila):
+    """Cursor opaco con la fecha y el id de la última fila de una página"""
+    return base64.urlsafe_b64encode(f"{fecha}|{id_fila}".encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor):
+    """Devuelve (fecha, id) del cursor o lanza ValueError"""
+    try:
+        fecha, id_fila = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+    return fecha, id_fila
+
+def limite_solicitado(args):
+    """Lee ?limite= y lo acota a LIMITE_HISTORIAL_MAX"""
+    limite = args.get('limite', str(LIMITE_HISTORIAL))
+    if not limite.isdigit() or int(limite) < 1:
+        raise ValueError(f"Límite inválido: {limite}")
+    return min(int(limite), LIMITE_HISTORIAL_MAX)
+
+def pagina_mensajes(c, id_sesion, limite, antes=None, despues=None):
+    """Página de mensajes de una sesión, siempre en orden cronológico
+
+    Sin cursor devuelve los más recientes. 'anterior' y 'siguiente' son los
+    cursores para pedir la página contigua, o None si no hay más mensajes
+    en esa dirección.
+    """
+    if despues:
         c.execute('''
             SELECT id, role, content, created_at
             FROM messages
-            WHERE session_id = ?
-            ORDER BY created_at ASC
-        ''', (id_sesion,))
-        
-        mensajes = [dict(fila) for fila in c.fetchall()]
-        conn.close()
-        return jsonify({'mensajes': mensajes})
+            WHERE session_id = ? AND (created_at, id) > (?, ?)
+            ORDER BY created_at ASC, id ASC
+            LIMIT ?
+        ''', (id_sesion, *despues, limite + 1))
+        filas = c.fetchall()
+        hay_mas = len(filas) > limite
+        filas = filas[:limite]
+        siguiente = filas[-1] if hay_mas else None
+        anterior = None
+        if filas:
+            # El cursor pudo quedar antes del primer mensaje: solo hay página anterior si queda alguno
+            c.execute('''
+                SELECT 1 FROM messages
+                WHERE session_id = ? AND (created_at, id) < (?, ?)
+                LIMIT 1
+            ''', (id_sesion, filas[0]['created_at'], filas[0]['id']))
+            if c.fetchone():
+                anterior = filas[0]
     else:
-        c.execute('SELECT id, title, created_at, updated_at FROM chat_sessions ORDER BY updated_at DESC')
-        sesiones = [dict(fila) for fila in c.fetchall()]
-        conn.close()
-        return jsonify({'sesiones': sesiones})
+        condicion_cursor = 'AND (created_at, id) < (?, ?)' if antes else ''
+        c.execute(f'''
+            SELECT id, role, content, created_at
+            FROM messages
+            WHERE session_id = ? {condicion_cursor}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (id_sesion, *(antes or ()), limite + 1))
+        filas = c.fetchall()
+        hay_mas = len(filas) > limite
+        filas = filas[:limite][::-1]
+        anterior = filas[0] if hay_mas else None
+        siguiente = filas[-1] if antes and filas else None
+    
+    return {
+        'mensajes': [dict(fila) for fila in filas],
+        'anterior': codificar_cursor(anterior['created_at'], anterior['id']) if anterior else None,
+        'siguiente': codificar_cursor(siguiente['created_at'], siguiente['id']) if siguiente else None
+    }
 
-@app.route('/api/debug-pdfs', methods=['GET'])
-def debug_pdfs():
-    """Ruta de debug para verificar PDFs procesados"""
+def pagina_sesiones(c, limite, antes=None):
+    """Página de sesiones de la más reciente a la más antigua, con el número
+    de mensajes y una vista previa del último"""
+    condicion_cursor = 'WHERE (s.updated_at, s.id) < (?, ?)' if antes else ''
+    c.execute(f'''
+        SELECT s.id, s.title, s.created_at, s.updated_at,
+               (SELECT COUNT(*) FROM messages m WHERE m.session_id = s.id) AS mensajes,
+               (SELECT substr(m.content, 1, 400) FROM messages m WHERE m.session_id = s.id
+                ORDER BY m.created_at DESC, m.id DESC LIMIT 1) AS ultimo_mensaje
+        FROM chat_sessions s
+        {condicion_cursor}
+        ORDER BY s.updated_at DESC, s.id DESC
+        LIMIT ?
+    ''', (*(antes or ()), limite + 1))
+    filas = c.fetchall()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    
+    sesiones = []
+    for fila in filas:
+        sesion = dict(fila)
+        vista_previa = limpiar_contenido_historial(sesion.pop('ultimo_mensaje') or '')
+        if len(vista_previa) > LARGO_VISTA_PREVIA:
+            vista_previa = vista_previa[:LARGO_VISTA_PREVIA].rsplit(' ', 1)[0] + '...'
+        sesion['vistaPrevia'] = vista_previa
+        sesiones.append(sesion)
+    
+    ultima = filas[-1] if hay_mas else None
+    return {
+        'sesiones': sesiones,
+        'siguiente': codificar_cursor(ultima['updated_at'], ultima['id']) if ultima else None
+    }
+
+@app.route('/api/historial', methods=['GET'])
+def historial():
+    """Historial paginado por cursor
+
+    Sin idSesion lista las sesiones; con idSesion devuelve sus mensajes.
+    Acepta ?limite=, ?antes=<cursor> y, para los mensajes, ?despues=<cursor>.
+    """
+    id_sesion = request.args.get('idSesion')
+    try:
+        limite = limite_solicitado(request.args)
+        antes = decodificar_cursor(request.args['antes']) if request.args.get('antes') else None
+        despues = decodificar_cursor(request.args['despues']) if request.args.get('despues') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     conn = get_db()
     c = conn.cursor()
     
-    # Verificar PDFs subidos
-    c.execute('SELECT * FROM pdf_files ORDER BY uploaded_at DESC')
-    pdfs = [dict(fila) for fila in c.fetchall()]
+    if id_sesion:
+        return jsonify(pagina_mensajes(c, id_sesion, limite, antes, despues))
+    else:
+        return jsonify(pagina_sesiones(c, limite, antes))
+
+def pagina_pdfs(c, limite, antes=None):
+    """Página de PDFs del más reciente al más antiguo con sus contadores y
+    el estado de su último procesamiento"""
+    condicion_cursor = 'WHERE (pf.uploaded_at, pf.id) < (?, ?)' if antes else ''
+    c.execute(f'''
+        SELECT pf.id, pf.filename, pf.uploaded_at, pf.content_hash,
+               pf.paginas_texto, pf.caracteres_texto, pf.imagenes,
+               (SELECT j.estado FROM pdf_jobs j WHERE j.pdf_id = pf.id
+                ORDER BY j.created_at DESC LIMIT 1) AS estado
+        FROM pdf_files pf
+        {condicion_cursor}
+        ORDER BY pf.uploaded_at DESC, pf.id DESC
+        LIMIT ?
+    ''', (*(antes or ()), limite + 1))
+    filas = c.fetchall()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
     
-    # Verificar contenido procesado
-    c.execute('''
-        SELECT pf.filename, pc.page_number, LENGTH(pc.text_content) as text_length
-        FROM pdf_files pf 
-        LEFT JOIN pdf_content pc ON pf.id = pc.pdf_id 
-        ORDER BY pf.uploaded_at DESC, pc.page_number ASC
-    ''')
-    contenido = [dict(fila) for fila in c.fetchall()]
+    ultima = filas[-1] if hay_mas else None
+    return {
+        'pdfs': [dict(fila) for fila in filas],
+        'siguiente': codificar_cursor(ultima['uploaded_at'], ultima['id']) if ultima else None
+    }
+
+@app.route('/api/debug-pdfs', methods=['GET'])
+def debug_pdfs():
+    """Ruta de debug para verificar PDFs procesados
+
+    Los totales salen de pdf_estadisticas, que mantienen los triggers, y la
+    lista de PDFs se pagina con ?limite= y ?antes=<cursor>.
+    """
+    try:
+        limite = limite_solicitado(request.args)
+        antes = decodificar_cursor(request.args['antes']) if request.args.get('antes') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Verificar imágenes (si las hay)
-    c.execute('SELECT * FROM pdf_images ORDER BY created_at DESC')
-    imagenes = [dict(fila) for fila in c.fetchall()]
+    conn = get_db()
+    c = conn.cursor()
     
-    conn.close()
+    c.execute('SELECT nombre, valor FROM pdf_estadisticas')
+    totales = dict(c.fetchall())
     
     return jsonify({
-        'pdfs_subidos': len(pdfs),
-        'pdfs': pdfs,
-        'contenido_procesado': len(contenido),
-        'contenido': contenido,
-        'imagenes': len(imagenes),
-        'imagenes_detalle': imagenes
+        'pdfs_subidos': totales.get('pdfs', 0),
+        'contenido_procesado': totales.get('paginas_texto', 0),
+        'caracteres_procesados': totales.get('caracteres_texto', 0),
+        'imagenes': totales.get('imagenes', 0),
+        **pagina_pdfs(c, limite, antes)
     })
 
+# Anchos permitidos para las variantes; limitar las opciones acota la caché
+ANCHOS_IMAGEN = (200, 400, 800, 1200)
+TAMANOS_IMAGEN = {'miniatura': 200, 'mediana': 800}
+FORMATOS_IMAGEN = {'png': 'image/png', 'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+_patron_nombre_imagen = re.compile(r'page_(\d+)\.png')
+_cache_imagenes = None
+_cache_imagenes_lock = threading.Lock()
+
+def obtener_cache_imagenes():
+    """Crea la caché de imágenes renderizadas la primera vez que se necesita"""
+    global _cache_imagenes
+    with _cache_imagenes_lock:
+        if _cache_imagenes is None:
+            _cache_imagenes = CacheImagenes(os.path.join(app.config['UPLOAD_FOLDER'], 'cache'),
+                                            CACHE_IMAGENES_MAX_MB * 1024 * 1024)
+        return _cache_imagenes
+
+def variante_solicitada(args):
+    """Devuelve (ancho, formato) pedidos con ?w=, ?tam= y ?fmt=
+
+    El ancho se ajusta al menor de ANCHOS_IMAGEN que lo cubra; None es el
+    tamaño completo.
+    """
+    ancho = TAMANOS_IMAGEN.get(args.get('tam', ''))
+    if args.get('w', '').isdigit():
+        pedido = int(args['w'])
+        ancho = next((permitido for permitido in ANCHOS_IMAGEN if permitido >= pedido), None)
+    formato = args.get('fmt', 'png').lower()
+    if formato not in FORMATOS_IMAGEN:
+        raise ValueError(f"Formato no soportado: {formato}")
+    return ancho, 'jpeg' if formato == 'jpg' else formato
+
+# Con ?v= igual al hash del PDF la imagen no puede cambiar; sin él hay que revalidar
+CACHE_CONTROL_INMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_CONTROL_REVALIDAR = 'public, no-cache'
+
+def enviar_imagen(ruta, mimetype, etag, cache_control):
+    """Envía una imagen en disco con su ETag, respetando If-None-Match y Range
+
+    Con IMAGENES_OFFLOAD el worker solo responde las cabeceras y el servidor
+    web (Apache/lighttpd con X-Sendfile, nginx con X-Accel-Redirect) envía
+    los bytes.
+    """
+    if IMAGENES_OFFLOAD == 'x-accel':
+        relativa = os.path.relpath(ruta, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        respuesta = Response(mimetype=mimetype)
+        respuesta.headers['X-Accel-Redirect'] = IMAGENES_ACCEL_PREFIJO.rstrip('/') + '/' + relativa
+        if etag:
+            respuesta.set_etag(etag)
+    else:
+        # send_file responde 304 y 206 por sí mismo (conditional=True)
+        respuesta = send_file(ruta, mimetype=mimetype, etag=etag or True, conditional=True)
+    respuesta.headers['Cache-Control'] = cache_control
+    return respuesta
+
 @app.route('/api/imagen/<pdf_id>/<image_name>')
 def servir_imagen(pdf_id, image_name):
-    """Servir imágenes extraídas de PDFs"""
+    """Servir imágenes de páginas de PDFs, renderizándolas la primera vez que se piden
+
+    Acepta ?w=<ancho>, ?tam=miniatura|mediana, ?fmt=png|jpeg|webp y ?v=<hash>.
+    El ETag es fuerte y sale del hash del PDF y la variante, así que una
+    revalidación se responde con 304 sin renderizar ni leer la imagen.
+    """
     try:
-        images_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'images', pdf_id)
-        return send_from_directory(images_dir, image_name)
-    except Exception as e:
+        ancho, formato = variante_solicitada(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    coincidencia = _patron_nombre_imagen.fullmatch(image_name)
+    if not coincidencia:
+        return jsonify({'error': 'Imagen no encontrada'}), 404
+    pagina = int(coincidencia.group(1))
+    
+    ruta_original = os.path.join(app.config['UPLOAD_FOLDER'], 'images', secure_filename(pdf_id), image_name)
+    original = ancho is None and formato == 'png' and os.path.isfile(ruta_original)
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT file_path, content_hash FROM pdf_files WHERE id = ?', (pdf_id,))
+    pdf = c.fetchone()
+    
+    if pdf:
+        registrar_uso_pdfs((pdf_id,))
+    
+    version = version_imagen(pdf['content_hash']) if pdf else None
+    nombre_variante = image_name if original else f"page_{pagina}_{ancho or 'completa'}.{formato}"
+    etag = f"{version}-{nombre_variante}" if version else None
+    if version and request.args.get('v') == version:
+        cache_control = CACHE_CONTROL_INMUTABLE
+    else:
+        cache_control = CACHE_CONTROL_REVALIDAR
+    
+    if etag and request.if_none_match.contains_weak(etag):
+        respuesta = Response(status=304)
+        respuesta.set_etag(etag)
+        respuesta.headers['Cache-Control'] = cache_control
+        return respuesta
+    
+    # Imágenes renderizadas durante la ingesta (tamaño completo, PNG)
+    if original:
+        return enviar_imagen(ruta_original, 'image/png', etag, cache_control)
+    
+    if not pdf or not os.path.isfile(pdf['file_path']):
+        return jsonify({'error': 'Imagen no encontrada'}), 404
+    
+    try:
+        ruta = obtener_cache_imagenes().obtener(
+            pdf_id, nombre_variante,
+            lambda: extraccion.renderizar_variante(pdf['file_path'], pagina, ancho, formato))
+    except IndexError as e:
         return jsonify({'error': f'Imagen no encontrada: {str(e)}'}), 404
+    
+    return enviar_imagen(ruta, FORMATOS_IMAGEN[formato], etag, cache_control)
 
 @app.route('/api/imagenes-disponibles', methods=['GET'])
 def imagenes_disponibles():
-    """Devolver lista de imágenes disponibles en la base de datos"""
+    """Imágenes de los PDFs más recientes (se mantiene por compatibilidad)
+
+    Devuelve a lo sumo ?limite= imágenes; para recorrer todas las de un
+    documento está /api/pdf/<pdf_id>/imagenes.
+    """
+    try:
+        limite = limite_solicitado(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     conn = get_db()
     c = conn.cursor()
     
     c.execute('''
-        SELECT pf.id as pdf_id, pf.filename, pi.page_number, pi.image_name, pi.image_description
+        SELECT pf.id as pdf_id, pf.filename, pf.content_hash, pi.page_number, pi.image_name,
+               pi.image_description
         FROM pdf_files pf 
         INNER JOIN pdf_images pi ON pf.id = pi.pdf_id 
-        ORDER BY pf.uploaded_at DESC, pi.page_number ASC
-    ''')
+        ORDER BY pf.uploaded_at DESC, pf.id DESC, pi.page_number ASC
+        LIMIT ?
+    ''', (limite,))
     imagenes = c.fetchall()
     
-    conn.close()
-    
     # Convertir a formato JSON amigable
     resultado = []
     for img in imagenes:
@@ -578,10 +3295,27 @@ def imagenes_disponibles():
             'page_number': img['page_number'],
             'image_name': img['image_name'],
             'description': img['image_description'],
-            'url': f"/api/imagen/{img['pdf_id']}/{img['image_name']}"
+            'url': url_imagen(img, absoluta=False),
+            'urlMiniatura': url_imagen(img, absoluta=False, w=400, fmt='webp')
         })
     
     return jsonify(resultado)
 
+def crear_app():
+    """Prepara este proceso para atender peticiones y devuelve la aplicación
+
+    Es el punto de entrada de gunicorn ('app:crear_app()'). Importar el
+    módulo no toca el disco ni carga PyMuPDF: el esquema se crea en el build
+    (flask --app app inicializar-bd) y aquí solo se comprueba su versión;
+    si el despliegue no lo migró, se migra ahora.
+    """
+    inicio = time.perf_counter()
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    if not esquema_al_dia():
+        preparar_base_de_datos()
+    registrar(logging.INFO, "Aplicación inicializada correctamente",
+              ms=round((time.perf_counter() - inicio) * 1000, 2))
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    crear_app().run(debug=True)
\ No newline at end of file
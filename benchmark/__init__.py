@@ -0,0 +1,7 @@
+"""Benchmarks de ingesta, recuperación y servicio de la aplicación
+
+Se ejecuta con `python -m benchmark` desde la raíz del repositorio. Todo
+corre en un directorio temporal (base de datos, subidas e índice vectorial)
+y el modelo se sustituye por fake_openrouter, así que no toca los datos
+reales ni necesita red. Ver `python -m benchmark --help`.
+"""
@@ -0,0 +1,293 @@
+"""Benchmark de ingesta, recuperación y servicio con un OpenRouter falso
+
+Uso:
+    python -m benchmark --paginas 10,100 --concurrencia 8 --peticiones 200 --salida actual.json
+    python -m benchmark --comparar base.json --tolerancia 0.2
+
+Mide:
+- arranque: importar la aplicación y llamar a crear_app() en un proceso nuevo
+- ingesta: procesar_pdf_completo sobre PDFs sintéticos de cada tamaño
+- recuperación: construir_contexto_pdf para preguntas variadas
+- chat e historial: /api/chat y /api/historial por HTTP con la concurrencia indicada
+
+Imprime (o guarda) un JSON con p50/p95/p99 y memoria residente. Con
+--comparar sale con código 1 si algún p95 (o la velocidad de ingesta o el
+pico de memoria) empeora más que la tolerancia respecto del archivo base.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+from benchmark.carga import ejecutar_carga, resumen, rss_mb, rss_pico_mb
+from benchmark.pdfs import generar_pdf, preguntas_de_prueba
+
+
+def preparar_aplicacion(directorio, url_llm):
+    """Importa la aplicación usando `directorio` para la base de datos, las subidas y los vectores"""
+    os.chdir(directorio)
+    os.environ['OPENROUTER_API_URL'] = url_llm
+    os.environ.setdefault('LOG_NIVEL', 'WARNING')
+    # Se miden latencias con toda la concurrencia pedida, no los rechazos por cupo
+    os.environ.setdefault('LLM_MAX_EN_CURSO', '0')
+    import app as aplicacion
+    aplicacion.app.config['UPLOAD_FOLDER'] = os.path.join(directorio, 'data', 'uploads')
+    aplicacion.crear_app()
+    return aplicacion
+
+
+# Se ejecuta en un intérprete nuevo, como un worker de gunicorn recién creado
+CODIGO_ARRANQUE = (
+    "import sys, time\n"
+    "inicio = time.perf_counter()\n"
+    "import app\n"
+    "app.crear_app()\n"
+    "print((time.perf_counter() - inicio) * 1000, 'fitz' in sys.modules, 'PIL' in sys.modules)\n"
+)
+
+
+def medir_arranque(directorio, repeticiones):
+    """Milisegundos de importar la aplicación y llamar a crear_app() con el esquema ya creado
+
+    También indica si el arranque cargó PyMuPDF o Pillow, que solo deberían
+    cargarse al ingerir o renderizar.
+    """
+    entorno = dict(os.environ, PYTHONPATH=RAIZ, LOG_NIVEL='WARNING')
+    tiempos, carga_pdf = [], False
+    for _ in range(repeticiones):
+        salida = subprocess.run([sys.executable, '-c', CODIGO_ARRANQUE], cwd=directorio, env=entorno,
+                                capture_output=True, text=True, check=True).stdout.split()
+        tiempos.append(float(salida[0]))
+        carga_pdf = carga_pdf or 'True' in salida[1:]
+    return {'repeticiones': repeticiones, 'ms': resumen(tiempos), 'carga_pymupdf_o_pillow': carga_pdf}
+
+
+def medir_ingesta(aplicacion, tamanos, repeticiones, renderizar, directorio_pdfs):
+    """Segundos y páginas por segundo de procesar_pdf_completo para cada tamaño de PDF"""
+    aplicacion.RENDERIZADO_DIFERIDO = not renderizar
+    conn = aplicacion.get_db()
+    resultados = {}
+    for paginas in tamanos:
+        segundos, velocidades = [], []
+        for repeticion in range(repeticiones):
+            ruta = generar_pdf(os.path.join(directorio_pdfs, f'sintetico_{paginas}_{repeticion}.pdf'),
+                               paginas, semilla=paginas * 1000 + repeticion)
+            pdf_id = str(uuid.uuid4())
+            # Igual que una subida: el hash ya viene calculado
+            conn.execute('''
+                INSERT INTO pdf_files (id, filename, file_path, content_hash)
+                VALUES (?, ?, ?, ?)
+            ''', (pdf_id, os.path.basename(ruta), ruta, aplicacion.calcular_hash_archivo(ruta)))
+            conn.commit()
+
+            inicio = time.perf_counter()
+            if not aplicacion.procesar_pdf_completo(pdf_id, ruta):
+                raise RuntimeError(f"Falló la ingesta del PDF sintético de {paginas} páginas")
+            duracion = time.perf_counter() - inicio
+            segundos.append(duracion)
+            velocidades.append(paginas / duracion)
+
+        resultados[str(paginas)] = {
+            'repeticiones': repeticiones,
+            'segundos': resumen(segundos, 4),
+            'paginas_por_segundo': resumen(velocidades),
+            'rss_mb': rss_mb(),
+        }
+    return resultados
+
+
+def medir_recuperacion(aplicacion, preguntas):
+    """Latencia en ms de armar el contexto de PDFs para cada pregunta"""
+    c = aplicacion.get_db().cursor()
+    latencias = []
+    for pregunta in preguntas:
+        inicio = time.perf_counter()
+        aplicacion.construir_contexto_pdf(c, pregunta)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+    return {'consultas': len(preguntas), 'ms': resumen(latencias)}
+
+
+def iniciar_servidor_http(aplicacion):
+    """Sirve la aplicación con el servidor multihilo de Werkzeug; devuelve (servidor, url)"""
+    from werkzeug.serving import make_server
+    # El log de acceso de cada petición distorsiona la medición
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    servidor = make_server('127.0.0.1', 0, aplicacion.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_port}"
+
+
+def medir_servicio(aplicacion, peticiones, concurrencia, turnos_por_sesion, timeout):
+    """Carga HTTP sobre /api/chat y luego sobre /api/historial (sesiones y mensajes)"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    servidor, url = iniciar_servidor_http(aplicacion)
+    cliente = requests.Session()
+    cliente.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrencia))
+    preguntas = preguntas_de_prueba(peticiones, semilla=7)
+
+    # Cada hilo mantiene su conversación para que el historial crezca como en el uso real
+    conversacion = threading.local()
+
+    def pedir_chat(indice):
+        if getattr(conversacion, 'turnos', 0) >= turnos_por_sesion:
+            conversacion.id_sesion, conversacion.turnos = None, 0
+        respuesta = cliente.post(f"{url}/api/chat", timeout=timeout, json={
+            'mensaje': preguntas[indice],
+            'idSesion': getattr(conversacion, 'id_sesion', None),
+        })
+        if respuesta.status_code != 200:
+            return False
+        datos = respuesta.json()
+        conversacion.id_sesion = datos.get('idSesion')
+        conversacion.turnos = getattr(conversacion, 'turnos', 0) + 1
+        return 'respuesta' in datos
+
+    resultados = {'chat': ejecutar_carga(pedir_chat, peticiones, concurrencia)}
+
+    c = aplicacion.get_db().cursor()
+    c.execute('SELECT id FROM chat_sessions')
+    sesiones = [fila['id'] for fila in c.fetchall()]
+
+    def pedir_sesiones(indice):
+        respuesta = cliente.get(f"{url}/api/historial", params={'limite': 20}, timeout=timeout)
+        return respuesta.status_code == 200
+
+    def pedir_mensajes(indice):
+        respuesta = cliente.get(f"{url}/api/historial", timeout=timeout,
+                                params={'idSesion': sesiones[indice % len(sesiones)], 'limite': 50})
+        return respuesta.status_code == 200
+
+    resultados['historial_sesiones'] = ejecutar_carga(pedir_sesiones, peticiones, concurrencia)
+    if sesiones:
+        resultados['historial_mensajes'] = ejecutar_carga(pedir_mensajes, peticiones, concurrencia)
+
+    servidor.shutdown()
+    return resultados
+
+
+def _hojas(datos, ruta=()):
+    for clave, valor in datos.items():
+        if isinstance(valor, dict):
+            yield from _hojas(valor, ruta + (clave,))
+        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            yield ruta + (clave,), valor
+
+
+def comparar(actual, base, tolerancia):
+    """Lista de regresiones de `actual` frente a `base` con la tolerancia relativa dada"""
+    valores_base = dict(_hojas(base))
+    regresiones = []
+    for ruta, valor in _hojas(actual):
+        anterior = valores_base.get(ruta)
+        if anterior is None or anterior <= 0:
+            continue
+        if 'paginas_por_segundo' in ruta:
+            # En la velocidad lo malo es bajar; se compara la mediana
+            if ruta[-1] != 'p50':
+                continue
+            empeoro = valor < anterior * (1 - tolerancia)
+        elif ruta[-1] == 'p95' or ruta[-1] == 'rss_pico_mb':
+            empeoro = valor > anterior * (1 + tolerancia)
+        else:
+            continue
+        if empeoro:
+            regresiones.append({'metrica': '.'.join(ruta), 'base': anterior, 'actual': valor,
+                                'cambio': f"{(valor / anterior - 1) * 100:+.1f}%"})
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--arranques', type=int, default=5, help='procesos nuevos para medir el arranque')
+    parser.add_argument('--paginas', default='10,100', help='tamaños de PDF a ingerir, separados por comas')
+    parser.add_argument('--repeticiones', type=int, default=3, help='PDFs por tamaño')
+    parser.add_argument('--renderizar', action='store_true',
+                        help='renderizar las imágenes durante la ingesta (por defecto es diferido)')
+    parser.add_argument('--consultas', type=int, default=200, help='preguntas para medir la recuperación')
+    parser.add_argument('--peticiones', type=int, default=200, help='peticiones por endpoint HTTP')
+    parser.add_argument('--concurrencia', type=int, default=8)
+    parser.add_argument('--turnos', type=int, default=6, help='turnos por conversación antes de abrir otra')
+    parser.add_argument('--latencia-llm', type=float, default=0.2, help='segundos que tarda el modelo falso')
+    parser.add_argument('--latencia-token', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=120.0, help='timeout de cada petición HTTP')
+    parser.add_argument('--salida', help='archivo donde guardar el JSON (por defecto se imprime)')
+    parser.add_argument('--comparar', help='JSON de una ejecución anterior para detectar regresiones')
+    parser.add_argument('--tolerancia', type=float, default=0.2, help='empeoramiento relativo permitido')
+    parser.add_argument('--conservar', action='store_true', help='no borrar el directorio de trabajo')
+    args = parser.parse_args()
+
+    import fake_openrouter
+
+    directorio = tempfile.mkdtemp(prefix='benchmark-pdf-chat-')
+    directorio_pdfs = os.path.join(directorio, 'pdfs')
+    os.makedirs(os.path.join(directorio, 'data'))
+    os.makedirs(directorio_pdfs)
+    directorio_original = os.getcwd()
+
+    config_llm = fake_openrouter.ConfiguracionFalsa(latencia=args.latencia_llm,
+                                                    latencia_token=args.latencia_token)
+    servidor_llm, _, url_llm = fake_openrouter.iniciar_servidor(config=config_llm)
+
+    try:
+        aplicacion = preparar_aplicacion(directorio, url_llm)
+        rss_inicial = rss_mb()
+
+        tamanos = [int(paginas) for paginas in args.paginas.split(',') if paginas.strip()]
+        resultados = {
+            'configuracion': {k: v for k, v in vars(args).items() if k not in ('salida', 'comparar', 'conservar')},
+            'entorno': {
+                'python': platform.python_version(),
+                'plataforma': platform.platform(),
+                'cpus': os.cpu_count(),
+                'render_workers': aplicacion.RENDER_WORKERS,
+            },
+            'rss_inicial_mb': rss_inicial,
+        }
+        resultados['arranque'] = medir_arranque(directorio, args.arranques)
+        resultados['ingesta'] = medir_ingesta(aplicacion, tamanos, args.repeticiones, args.renderizar,
+                                              directorio_pdfs)
+        resultados['recuperacion'] = medir_recuperacion(aplicacion, preguntas_de_prueba(args.consultas))
+        resultados.update(medir_servicio(aplicacion, args.peticiones, args.concurrencia, args.turnos,
+                                         args.timeout))
+        resultados['llamadas_llm'] = config_llm.peticiones
+        resultados['rss_final_mb'] = rss_mb()
+        resultados['rss_pico_mb'] = rss_pico_mb()
+    finally:
+        servidor_llm.shutdown()
+        os.chdir(directorio_original)
+        if not args.conservar:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+    texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            archivo.write(texto + '\n')
+    else:
+        print(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as archivo:
+            regresiones = comparar(resultados, json.load(archivo), args.tolerancia)
+        for regresion in regresiones:
+            print(f"Regresión en {regresion['metrica']}: {regresion['base']} -> {regresion['actual']} "
+                  f"({regresion['cambio']})", file=sys.stderr)
+        if regresiones:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
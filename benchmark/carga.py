@@ -0,0 +1,85 @@
+"""Generación de carga concurrente, percentiles y memoria del proceso"""
+import os
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) con interpolación lineal entre las muestras ordenadas"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    posicion = (len(ordenados) - 1) * p / 100
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicion - inferior)
+
+
+def resumen(valores, decimales=2):
+    """p50, p95, p99, media, mínimo y máximo de una lista de valores"""
+    if not valores:
+        return {'p50': None, 'p95': None, 'p99': None, 'media': None, 'min': None, 'max': None}
+    return {
+        'p50': round(percentil(valores, 50), decimales),
+        'p95': round(percentil(valores, 95), decimales),
+        'p99': round(percentil(valores, 99), decimales),
+        'media': round(sum(valores) / len(valores), decimales),
+        'min': round(min(valores), decimales),
+        'max': round(max(valores), decimales),
+    }
+
+
+def rss_mb():
+    """Memoria residente actual del proceso en MB (Linux)"""
+    try:
+        with open('/proc/self/statm') as archivo:
+            paginas_residentes = int(archivo.read().split()[1])
+        return round(paginas_residentes * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def rss_pico_mb():
+    """Memoria residente máxima que alcanzó el proceso en MB"""
+    # En Linux ru_maxrss viene en KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def ejecutar_carga(operacion, total, concurrencia):
+    """Llama `operacion(indice)` `total` veces con `concurrencia` hilos
+
+    `operacion` devuelve True si la petición salió bien. Devuelve un dict con
+    el resumen de latencias en ms, errores y peticiones por segundo.
+    """
+    latencias = []
+    errores = []
+    lock = threading.Lock()
+
+    def medir(indice):
+        inicio = time.perf_counter()
+        try:
+            correcto = operacion(indice)
+            detalle = None if correcto else 'respuesta no válida'
+        except Exception as e:
+            correcto, detalle = False, str(e)
+        duracion = (time.perf_counter() - inicio) * 1000
+        with lock:
+            latencias.append(duracion)
+            if not correcto:
+                errores.append(detalle)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        list(ejecutor.map(medir, range(total)))
+    segundos = time.perf_counter() - inicio
+
+    return {
+        'peticiones': total,
+        'concurrencia': concurrencia,
+        'errores': len(errores),
+        'primer_error': errores[0] if errores else None,
+        'peticiones_por_segundo': round(total / segundos, 2) if segundos else None,
+        'ms': resumen(latencias),
+    }
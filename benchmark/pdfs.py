@@ -0,0 +1,69 @@
+"""PDFs sintéticos con texto en español, títulos y figuras simples"""
+import random
+
+import fitz  # PyMuPDF
+
+VOCABULARIO = (
+    "valle cauca turismo aves migratorias río montaña reserva natural sendero cascada "
+    "gastronomía cultura fiesta salsa historia hacienda café caña azúcar clima temperatura "
+    "municipio capital parque museo iglesia colonial artesanía mercado playa pacífico "
+    "ballena jorobada avistamiento biodiversidad bosque niebla orquídea mariposa ecoturismo "
+    "transporte aeropuerto terminal hotel alojamiento ruta recorrido guía mapa temporada "
+    "lluvia verano invierno precio entrada horario visita familia comunidad tradición"
+).split()
+
+
+def _parrafo(azar, palabras):
+    texto = ' '.join(azar.choice(VOCABULARIO) for _ in range(palabras))
+    return texto.capitalize() + '.'
+
+
+def generar_pdf(ruta, paginas, palabras_por_pagina=250, semilla=0):
+    """Escribe en `ruta` un PDF de `paginas` páginas y devuelve la ruta
+
+    Cada página tiene un título numerado, varios párrafos y un par de
+    figuras, para que la extracción y el renderizado hagan trabajo real.
+    """
+    azar = random.Random(semilla)
+    documento = fitz.open()
+    for numero in range(1, paginas + 1):
+        pagina = documento.new_page()
+        pagina.insert_text((72, 72), f"Capítulo {numero}: {azar.choice(VOCABULARIO).title()}",
+                           fontsize=16)
+        caja = fitz.Rect(72, 100, pagina.rect.width - 72, pagina.rect.height - 220)
+        parrafos = []
+        restantes = palabras_por_pagina
+        while restantes > 0:
+            largo = min(restantes, azar.randint(40, 90))
+            parrafos.append(_parrafo(azar, largo))
+            restantes -= largo
+        pagina.insert_textbox(caja, '\n\n'.join(parrafos), fontsize=10)
+        for _ in range(2):
+            x = azar.uniform(72, pagina.rect.width - 200)
+            y = azar.uniform(pagina.rect.height - 200, pagina.rect.height - 120)
+            color = (azar.random(), azar.random(), azar.random())
+            pagina.draw_rect(fitz.Rect(x, y, x + 120, y + 80), color=color, fill=color)
+    documento.save(ruta)
+    documento.close()
+    return ruta
+
+
+def preguntas_de_prueba(cantidad, semilla=0):
+    """Preguntas variadas sobre el vocabulario de los PDFs sintéticos"""
+    azar = random.Random(semilla)
+    plantillas = (
+        "¿Qué dice el documento sobre {} y {}?",
+        "Explica la sección de {} en la página {}",
+        "¿Dónde se habla de {} cerca de {}?",
+        "Resume lo relacionado con {} y {}",
+    )
+    preguntas = []
+    for indice in range(cantidad):
+        plantilla = azar.choice(plantillas)
+        if 'página' in plantilla:
+            pregunta = plantilla.format(azar.choice(VOCABULARIO), azar.randint(1, 50))
+        else:
+            pregunta = plantilla.format(azar.choice(VOCABULARIO), azar.choice(VOCABULARIO))
+        # El número evita que dos preguntas iguales se respondan desde la caché
+        preguntas.append(f"{pregunta} (#{indice})")
+    return preguntas
@@ -1,7 +1,7 @@
 #!/bin/bash
-# build.sh
+# build.sh: se ejecuta una vez por despliegue, no en cada arranque
+set -e
 pip install --upgrade pip
-pip install python-dotenv==1.0.0
-pip install requests==2.31.0
-pip install PyPDF2==3.0.1
+pip install -r requirements.txt
 echo "Dependencias instaladas correctamente"
+flask --app app inicializar-bd
@@ -0,0 +1,118 @@
+"""Caché en disco, con tamaño acotado, de las imágenes de página generadas bajo demanda
+
+Cada variante (PDF, página, ancho y formato) se guarda una vez en su propio
+archivo. Al servirla se actualiza su mtime, que hace de marca de último uso;
+cuando el total supera el máximo se borran las menos usadas (LRU) hasta
+quedar en el 90% del límite.
+"""
+import os
+import shutil
+import tempfile
+import threading
+
+
+class CacheImagenes:
+    def __init__(self, directorio, max_bytes):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        os.makedirs(directorio, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Un lock por variante evita renderizar la misma imagen dos veces a la vez
+        self._locks_variantes = {}
+        self._bytes_estimados = None
+
+    def ruta(self, pdf_id, nombre):
+        return os.path.join(self.directorio, pdf_id, nombre)
+
+    def obtener(self, pdf_id, nombre, generar):
+        """Devuelve la ruta de la variante, generándola con `generar()` si no existe"""
+        ruta = self.ruta(pdf_id, nombre)
+        if self._tocar(ruta):
+            return ruta
+
+        with self._lock_variante(ruta):
+            if self._tocar(ruta):
+                return ruta
+            contenido = generar()
+            self._escribir(ruta, contenido)
+
+        self._registrar_bytes(len(contenido))
+        return ruta
+
+    def pdf_ids(self):
+        """Ids de los PDFs que tienen variantes guardadas"""
+        return [entrada.name for entrada in os.scandir(self.directorio) if entrada.is_dir()]
+
+    def borrar_pdf(self, pdf_id):
+        """Borra todas las variantes de un PDF y devuelve los bytes liberados"""
+        directorio = os.path.join(self.directorio, pdf_id)
+        with self._lock:
+            liberados = 0
+            for raiz, _, archivos in os.walk(directorio):
+                for nombre in archivos:
+                    try:
+                        liberados += os.path.getsize(os.path.join(raiz, nombre))
+                    except OSError:
+                        pass
+            shutil.rmtree(directorio, ignore_errors=True)
+            if self._bytes_estimados is not None:
+                self._bytes_estimados = max(0, self._bytes_estimados - liberados)
+        return liberados
+
+    def _tocar(self, ruta):
+        """Marca la variante como recién usada; False si no existe"""
+        try:
+            os.utime(ruta)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _lock_variante(self, ruta):
+        with self._lock:
+            return self._locks_variantes.setdefault(ruta, threading.Lock())
+
+    def _escribir(self, ruta, contenido):
+        # Escritura atómica: otros procesos nunca ven un archivo a medias
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        descriptor, ruta_tmp = tempfile.mkstemp(dir=os.path.dirname(ruta), suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as archivo:
+            archivo.write(contenido)
+        os.replace(ruta_tmp, ruta)
+
+    def _registrar_bytes(self, cantidad):
+        with self._lock:
+            if self._bytes_estimados is None:
+                self._bytes_estimados = sum(tamano for _, tamano, _ in self._archivos())
+            else:
+                self._bytes_estimados += cantidad
+            if self._bytes_estimados > self.max_bytes:
+                self._bytes_estimados = self._desalojar()
+            # Los locks de variantes ya generadas no hacen falta
+            self._locks_variantes = {ruta: lock for ruta, lock in self._locks_variantes.items()
+                                     if lock.locked()}
+
+    def _archivos(self):
+        """(ruta, tamaño, mtime) de todas las variantes guardadas"""
+        for entrada_pdf in os.scandir(self.directorio):
+            if not entrada_pdf.is_dir():
+                continue
+            for entrada in os.scandir(entrada_pdf.path):
+                if entrada.is_file() and not entrada.name.endswith('.tmp'):
+                    info = entrada.stat()
+                    yield entrada.path, info.st_size, info.st_mtime
+
+    def _desalojar(self):
+        """Borra las variantes menos usadas hasta el 90% del máximo y devuelve el total"""
+        archivos = sorted(self._archivos(), key=lambda archivo: archivo[2])
+        total = sum(tamano for _, tamano, _ in archivos)
+        objetivo = self.max_bytes * 0.9
+        for ruta, tamano, _ in archivos:
+            if total <= objetivo:
+                break
+            try:
+                os.remove(ruta)
+                total -= tamano
+            except FileNotFoundError:
+                pass
+        return total
@@ -0,0 +1,244 @@
+"""Cliente HTTP para la API de chat de OpenRouter
+
+Reutiliza conexiones con una sesión de requests, aplica timeouts de
+conexión, lectura y total, reintenta los errores transitorios (429/5xx y
+fallos de red) con backoff exponencial y jitter, y corta las llamadas con
+un circuit breaker cuando la API está degradada.
+"""
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Códigos que indican un error transitorio del lado de la API
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class ErrorLLM(Exception):
+    """Error al obtener una respuesta del modelo"""
+
+    def __init__(self, mensaje, status=None, detalle=''):
+        super().__init__(mensaje)
+        self.status = status
+        self.detalle = detalle
+
+
+class CircuitoAbierto(ErrorLLM):
+    """La API falló demasiadas veces seguidas y se rechaza la llamada sin intentarla"""
+
+
+class CircuitBreaker:
+    """Circuit breaker de tres estados: cerrado, abierto y semiabierto
+
+    Tras `umbral` fallos seguidos se abre durante `enfriamiento` segundos.
+    Pasado ese tiempo deja pasar una sola llamada de prueba: si sale bien se
+    cierra y si falla vuelve a abrirse.
+    """
+
+    def __init__(self, umbral=5, enfriamiento=30.0):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self._fallos = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self._fallos < self.umbral:
+                return 'cerrado'
+            return 'abierto' if time.monotonic() < self._abierto_hasta else 'semiabierto'
+
+    def permitir(self):
+        """Indica si se puede intentar una llamada ahora"""
+        with self._lock:
+            if self._fallos < self.umbral:
+                return True
+            if time.monotonic() < self._abierto_hasta or self._prueba_en_curso:
+                return False
+            self._prueba_en_curso = True
+            return True
+
+    def registrar_exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._prueba_en_curso = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos += 1
+            self._prueba_en_curso = False
+            if self._fallos >= self.umbral:
+                self._abierto_hasta = time.monotonic() + self.enfriamiento
+
+
+class LimiteConcurrencia:
+    """Cupo de llamadas simultáneas al modelo; quien no consigue lugar se rechaza
+
+    Rechazar enseguida (o tras una espera corta) en lugar de encolar deja
+    libres los hilos del servidor para las peticiones baratas mientras el
+    modelo está lento. Con `maximo` <= 0 no hay límite.
+    """
+
+    def __init__(self, maximo, espera=0.0):
+        self.maximo = maximo
+        self.espera = espera
+        self._semaforo = threading.BoundedSemaphore(maximo) if maximo > 0 else None
+        self._en_curso = 0
+        self._lock = threading.Lock()
+
+    @property
+    def en_curso(self):
+        with self._lock:
+            return self._en_curso
+
+    def adquirir(self):
+        """Ocupa un lugar; devuelve False si no se liberó ninguno dentro de `espera`"""
+        if self._semaforo is not None:
+            if self.espera > 0:
+                obtenido = self._semaforo.acquire(timeout=self.espera)
+            else:
+                obtenido = self._semaforo.acquire(blocking=False)
+            if not obtenido:
+                return False
+        with self._lock:
+            self._en_curso += 1
+        return True
+
+    def liberar(self):
+        with self._lock:
+            self._en_curso -= 1
+        if self._semaforo is not None:
+            self._semaforo.release()
+
+
+class ClienteLLM:
+    """Cliente de chat completions con pool de conexiones, reintentos y circuit breaker"""
+
+    def __init__(self, url, api_key, timeout_conexion=5.0, timeout_lectura=30.0,
+                 timeout_total=60.0, reintentos=2, backoff_base=0.5, backoff_max=8.0,
+                 umbral_circuito=5, enfriamiento_circuito=30.0, tamano_pool=10):
+        self.url = url
+        self.api_key = api_key
+        self.timeout_conexion = timeout_conexion
+        self.timeout_lectura = timeout_lectura
+        self.timeout_total = timeout_total
+        self.reintentos = reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuito = CircuitBreaker(umbral_circuito, enfriamiento_circuito)
+
+        # Una sola sesión mantiene vivas las conexiones TLS entre turnos
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=tamano_pool, max_retries=0)
+        self.sesion.mount('https://', adaptador)
+        self.sesion.mount('http://', adaptador)
+        self.sesion.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+
+    def completar(self, mensajes, modelo, **opciones):
+        """Devuelve el texto de la respuesta completa del modelo"""
+        datos = {"model": modelo, "messages": mensajes, **opciones}
+        respuesta = self._enviar(datos, stream=False)
+        try:
+            datos_respuesta = respuesta.json()
+        except ValueError as ve:
+            raise ErrorLLM("Error al procesar la respuesta del asistente.", respuesta.status_code) from ve
+        if datos_respuesta.get('choices'):
+            return datos_respuesta['choices'][0]['message']['content']
+        raise ErrorLLM("No se pudo obtener una respuesta del asistente.", respuesta.status_code)
+
+    def completar_stream(self, mensajes, modelo, **opciones):
+        """Produce los fragmentos de texto de la respuesta a medida que llegan
+
+        Solo se reintenta antes de recibir el primer byte; un corte a mitad
+        del stream se propaga como ErrorLLM.
+        """
+        datos = {"model": modelo, "messages": mensajes, "stream": True, **opciones}
+        respuesta = self._enviar(datos, stream=True)
+        inicio = time.monotonic()
+        try:
+            for fragmento in leer_stream(respuesta):
+                if time.monotonic() - inicio > self.timeout_total:
+                    raise ErrorLLM("La respuesta del modelo superó el tiempo máximo")
+                yield fragmento
+        except requests.RequestException as e:
+            self.circuito.registrar_fallo()
+            raise ErrorLLM(f"Se interrumpió la respuesta del modelo: {e}") from e
+        finally:
+            respuesta.close()
+
+    def _enviar(self, datos, stream):
+        """POST con reintentos; devuelve la respuesta 200 o lanza ErrorLLM"""
+        if not self.circuito.permitir():
+            raise CircuitoAbierto("La API del modelo no está disponible en este momento, intenta más tarde")
+
+        limite = time.monotonic() + self.timeout_total
+        intento = 0
+        while True:
+            espera = None
+            try:
+                respuesta = self.sesion.post(self.url, json=datos, stream=stream,
+                                             timeout=(self.timeout_conexion, self.timeout_lectura))
+            except requests.RequestException as e:
+                error = ErrorLLM(f"Error de conexión con la API: {e}")
+            else:
+                if respuesta.status_code == 200:
+                    self.circuito.registrar_exito()
+                    return respuesta
+
+                detalle = respuesta.text
+                respuesta.close()
+                error = ErrorLLM(f"Error en la API: {respuesta.status_code} - {detalle[:200]}",
+                                 respuesta.status_code, detalle)
+                if respuesta.status_code not in CODIGOS_REINTENTABLES:
+                    # Un error del cliente (4xx) no indica que la API esté caída
+                    self.circuito.registrar_exito()
+                    raise error
+                espera = _segundos_retry_after(respuesta.headers.get('Retry-After'))
+
+            if espera is None:
+                # Backoff exponencial con jitter completo
+                espera = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** intento))
+            intento += 1
+            if intento > self.reintentos or time.monotonic() + espera > limite:
+                self.circuito.registrar_fallo()
+                raise error
+            time.sleep(espera)
+
+
+def _segundos_retry_after(valor):
+    """Interpreta la cabecera Retry-After en segundos (None si no es numérica)"""
+    try:
+        return max(0.0, float(valor))
+    except (TypeError, ValueError):
+        return None
+
+
+def leer_stream(respuesta):
+    """Produce los fragmentos de texto de una respuesta SSE de chat completions"""
+    # El stream es UTF-8 aunque el Content-Type no lo diga
+    respuesta.encoding = 'utf-8'
+    for linea in respuesta.iter_lines(decode_unicode=True):
+        # Las líneas que empiezan con ':' son comentarios de keep-alive
+        if not linea or not linea.startswith('data:'):
+            continue
+        carga = linea[len('data:'):].strip()
+        if carga == '[DONE]':
+            break
+        try:
+            datos = json.loads(carga)
+        except ValueError:
+            continue
+        if 'error' in datos:
+            raise ErrorLLM(datos['error'].get('message', 'Error en el stream de la API'))
+        for opcion in datos.get('choices', []):
+            texto = (opcion.get('delta') or {}).get('content')
+            if texto:
+                yield texto
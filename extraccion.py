@@ -0,0 +1,134 @@
+"""Extracción de texto e imágenes de PDFs en una sola pasada
+
+Este módulo solo depende de PyMuPDF para que los procesos del pool de
+renderizado arranquen rápido y no carguen la aplicación Flask. PyMuPDF
+(y Pillow para WebP) se importan dentro de cada función: los workers que
+solo atienden el chat nunca los cargan.
+"""
+import logging
+import os
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+# Escala 2x para mejor calidad
+ESCALA_RENDER = 2
+
+
+def contar_paginas(ruta_archivo):
+    """Devuelve el número de páginas del PDF sin extraer nada"""
+    import fitz  # PyMuPDF
+    with fitz.open(ruta_archivo) as pdf_document:
+        return len(pdf_document)
+
+
+def nombre_imagen(page_number):
+    """Nombre con el que se publica la imagen de una página"""
+    return f"page_{page_number}.png"
+
+
+def extraer_paginas(ruta_archivo, inicio=0, fin=None, renderizar=True):
+    """Abre el documento una sola vez y produce (page_number, texto, pixmap) por página
+
+    Es un generador: cada pixmap se libera en cuanto el consumidor pasa a la
+    siguiente página, así que la memoria no crece con el tamaño del PDF.
+    Con renderizar=False solo se extrae el texto y el pixmap es None.
+    """
+    import fitz  # PyMuPDF
+    with fitz.open(ruta_archivo) as pdf_document:
+        fin = len(pdf_document) if fin is None else min(fin, len(pdf_document))
+        mat = fitz.Matrix(ESCALA_RENDER, ESCALA_RENDER)
+
+        for page_num in range(inicio, fin):
+            page = pdf_document[page_num]
+            texto = page.get_text()
+            if not renderizar:
+                yield page_num + 1, texto, None
+                continue
+            try:
+                pix = page.get_pixmap(matrix=mat)
+            except Exception as img_error:
+                # Continuar aunque falle el renderizado de la página
+                logger.warning("Error renderizando página", extra={'campos': {
+                    'pagina': page_num + 1, 'error': str(img_error)}})
+                pix = None
+            yield page_num + 1, texto, pix
+
+
+def guardar_pagina(page_number, texto, pix, images_dir):
+    """Guarda el pixmap como PNG y devuelve (page_number, texto, image_name, image_path)"""
+    if pix is None:
+        return page_number, texto, None, None
+
+    image_name = nombre_imagen(page_number)
+    image_path = os.path.join(images_dir, image_name)
+    try:
+        pix.save(image_path)
+    except Exception as img_error:
+        logger.warning("Error guardando imagen de la página", extra={'campos': {
+            'pagina': page_number, 'error': str(img_error)}})
+        return page_number, texto, None, None
+    return page_number, texto, image_name, image_path
+
+
+def procesar_paginas(ruta_archivo, images_dir, inicio=0, fin=None, renderizar=True):
+    """Extrae y guarda las páginas [inicio, fin) una a una
+
+    Con renderizar=False la imagen de cada página se registra sin ruta y se
+    genera más tarde, cuando alguien la pide (ver renderizar_variante).
+    """
+    for page_number, texto, pix in extraer_paginas(ruta_archivo, inicio, fin, renderizar):
+        if not renderizar:
+            yield page_number, texto, nombre_imagen(page_number), ''
+        else:
+            yield guardar_pagina(page_number, texto, pix, images_dir)
+
+
+def procesar_rango(ruta_archivo, images_dir, inicio, fin):
+    """Procesa un rango de páginas en un proceso del pool con su propia copia del documento"""
+    return list(procesar_paginas(ruta_archivo, images_dir, inicio, fin))
+
+
+def agrupar_en_lotes(iterable, tamano):
+    """Agrupa un iterable en listas de como máximo `tamano` elementos"""
+    iterador = iter(iterable)
+    while True:
+        lote = list(islice(iterador, tamano))
+        if not lote:
+            return
+        yield lote
+
+
+def dividir_paginas(total_paginas, tamano_rango):
+    """Divide el rango de páginas en rangos contiguos de como máximo `tamano_rango` páginas"""
+    tamano_rango = max(1, tamano_rango)
+    return [(inicio, min(inicio + tamano_rango, total_paginas))
+            for inicio in range(0, total_paginas, tamano_rango)]
+
+
+def renderizar_variante(ruta_archivo, page_number, ancho=None, formato='png', calidad=80):
+    """Renderiza una página a `ancho` píxeles (o a ESCALA_RENDER) y devuelve los bytes
+
+    PNG y JPEG los codifica PyMuPDF; WebP necesita Pillow.
+    """
+    import fitz  # PyMuPDF
+    with fitz.open(ruta_archivo) as pdf_document:
+        if not 1 <= page_number <= len(pdf_document):
+            raise IndexError(f"El PDF no tiene página {page_number}")
+        page = pdf_document[page_number - 1]
+        escala = ancho / page.rect.width if ancho else ESCALA_RENDER
+        # Nunca por encima de la escala de referencia
+        escala = min(escala, ESCALA_RENDER)
+        pix = page.get_pixmap(matrix=fitz.Matrix(escala, escala), alpha=False)
+
+    if formato == 'png':
+        return pix.tobytes('png')
+    if formato == 'jpeg':
+        return pix.tobytes('jpeg', jpg_quality=calidad)
+
+    from PIL import Image
+    import io
+    imagen = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    salida = io.BytesIO()
+    imagen.save(salida, format=formato.upper(), quality=calidad)
+    return salida.getvalue()
@@ -0,0 +1,150 @@
+"""Servidor local que imita la API de chat completions de OpenRouter
+
+Sirve para probar sin red la latencia y los fallos del chat. Responde a
+POST /api/v1/chat/completions en modo normal y en modo stream (SSE) y
+permite inyectar:
+
+- latencia antes de la respuesta y entre tokens
+- una proporción de errores con un código dado (por ejemplo 429 o 503)
+- una secuencia de códigos para las próximas peticiones
+
+Uso:
+    python fake_openrouter.py --puerto 8765 --latencia 0.5 --tasa-error 0.1
+    OPENROUTER_API_URL=http://127.0.0.1:8765/api/v1/chat/completions gunicorn 'app:crear_app()' -c gunicorn.conf.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPUESTA_POR_DEFECTO = ("Según el documento, en la página 1 se presenta el tema principal "
+                         "y en la página 2 se amplían los detalles.")
+
+
+class ConfiguracionFalsa:
+    """Comportamiento del servidor; se puede cambiar mientras está corriendo"""
+
+    def __init__(self, latencia=0.0, latencia_token=0.0, tasa_error=0.0, codigo_error=503,
+                 respuesta=RESPUESTA_POR_DEFECTO, retry_after=None):
+        self.latencia = latencia
+        self.latencia_token = latencia_token
+        self.tasa_error = tasa_error
+        self.codigo_error = codigo_error
+        self.respuesta = respuesta
+        self.retry_after = retry_after
+        self.codigos_siguientes = []
+        self.peticiones = 0
+        self._lock = threading.Lock()
+
+    def encolar_codigos(self, *codigos):
+        """Las próximas peticiones responderán con estos códigos, en orden"""
+        with self._lock:
+            self.codigos_siguientes.extend(codigos)
+
+    def siguiente_codigo(self):
+        with self._lock:
+            self.peticiones += 1
+            if self.codigos_siguientes:
+                return self.codigos_siguientes.pop(0)
+        if self.tasa_error and random.random() < self.tasa_error:
+            return self.codigo_error
+        return 200
+
+
+def _crear_manejador(config):
+    class Manejador(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            largo = int(self.headers.get('Content-Length', 0))
+            try:
+                datos = json.loads(self.rfile.read(largo) or b'{}')
+            except ValueError:
+                datos = {}
+
+            time.sleep(config.latencia)
+            codigo = config.siguiente_codigo()
+            if codigo != 200:
+                cabeceras = {'Retry-After': str(config.retry_after)} if config.retry_after is not None else {}
+                self._json(codigo, {'error': {'message': f'Error simulado {codigo}', 'code': codigo}}, cabeceras)
+                return
+
+            if datos.get('stream'):
+                self._stream(datos)
+            else:
+                self._json(200, {
+                    'id': 'gen-falso',
+                    'model': datos.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': config.respuesta},
+                                 'finish_reason': 'stop'}]
+                })
+
+        def _json(self, codigo, cuerpo, cabeceras=None):
+            contenido = json.dumps(cuerpo).encode('utf-8')
+            self.send_response(codigo)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(contenido)))
+            for nombre, valor in (cabeceras or {}).items():
+                self.send_header(nombre, valor)
+            self.end_headers()
+            self.wfile.write(contenido)
+
+        def _stream(self, datos):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+
+            self.wfile.write(b': OPENROUTER PROCESSING\n\n')
+            for token in config.respuesta.split(' '):
+                time.sleep(config.latencia_token)
+                evento = {'choices': [{'index': 0, 'delta': {'content': token + ' '}}]}
+                self.wfile.write(f"data: {json.dumps(evento)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+
+    return Manejador
+
+
+def iniciar_servidor(puerto=0, config=None, host='127.0.0.1'):
+    """Arranca el servidor en un hilo y devuelve (servidor, config, url)
+
+    Con puerto=0 el sistema elige uno libre.
+    """
+    config = config or ConfiguracionFalsa()
+    servidor = ThreadingHTTPServer((host, puerto), _crear_manejador(config))
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    url = f"http://{host}:{servidor.server_address[1]}/api/v1/chat/completions"
+    return servidor, config, url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--latencia', type=float, default=0.0, help='segundos antes de responder')
+    parser.add_argument('--latencia-token', type=float, default=0.0, help='segundos entre tokens del stream')
+    parser.add_argument('--tasa-error', type=float, default=0.0, help='proporción de peticiones que fallan')
+    parser.add_argument('--codigo-error', type=int, default=503)
+    parser.add_argument('--retry-after', type=int, default=None)
+    args = parser.parse_args()
+
+    config = ConfiguracionFalsa(args.latencia, args.latencia_token, args.tasa_error,
+                                args.codigo_error, retry_after=args.retry_after)
+    servidor = ThreadingHTTPServer(('127.0.0.1', args.puerto), _crear_manejador(config))
+    print(f"OpenRouter falso escuchando en http://127.0.0.1:{args.puerto}/api/v1/chat/completions")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
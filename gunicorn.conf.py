@@ -0,0 +1,25 @@
+"""Configuración de gunicorn para servir la aplicación
+
+Workers con hilos (gthread): mientras unos hilos esperan al modelo, los
+demás siguen atendiendo subidas, imágenes e historial. Con workers
+síncronos cada llamada lenta a OpenRouter bloqueaba un proceso entero.
+
+El cupo de llamadas al modelo (LLM_MAX_EN_CURSO) es por proceso y debe
+quedar por debajo de GUNICORN_HILOS, así siempre sobran hilos para las
+peticiones baratas; el resto de los turnos recibe 429 con Retry-After.
+Con el plan gratuito de Render (512 MB) conviene un solo worker: el
+renderizado de páginas ya usa su propio pool de procesos.
+
+Uso: gunicorn 'app:crear_app()' -c gunicorn.conf.py
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+threads = int(os.getenv('GUNICORN_HILOS', '8'))
+
+# Una respuesta en stream puede durar lo que el timeout total del modelo
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
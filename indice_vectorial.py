@@ -0,0 +1,252 @@
+"""Índice vectorial local para recuperar fragmentos de páginas por similitud
+
+Los fragmentos se vectorizan con TF hasheado (sin modelos ni red) y se
+guardan en una matriz float32 de solo anexado que se lee con np.memmap, de
+modo que los workers de gunicorn comparten la caché de páginas del sistema
+operativo en lugar de cargar la matriz en su heap. Junto a la matriz hay:
+
+- ids.i64: id de pdf_chunks de cada fila de la matriz
+- df.npy: frecuencia de documento por dimensión, para pesar la consulta con IDF
+
+Los fragmentos borrados dejan de existir en pdf_chunks y se descartan al
+resolver los resultados; sus filas siguen en la matriz hasta que
+`compactar` la reescribe con solo los ids vigentes.
+"""
+import fcntl
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+# Dimensiones del vector hasheado
+DIMENSIONES = int(os.getenv("VECTORES_DIMENSIONES", "256"))
+
+# Tamaño y solapamiento de los fragmentos, en palabras
+PALABRAS_POR_FRAGMENTO = 120
+SOLAPAMIENTO_FRAGMENTO = 30
+
+_patron_palabra = re.compile(r'\w+')
+
+
+def dividir_en_fragmentos(texto, tamano=PALABRAS_POR_FRAGMENTO, solapamiento=SOLAPAMIENTO_FRAGMENTO):
+    """Divide un texto en fragmentos de `tamano` palabras que se solapan"""
+    palabras = texto.split()
+    if not palabras:
+        return []
+    paso = max(1, tamano - solapamiento)
+    fragmentos = []
+    for inicio in range(0, len(palabras), paso):
+        fragmentos.append(' '.join(palabras[inicio:inicio + tamano]))
+        if inicio + tamano >= len(palabras):
+            break
+    return fragmentos
+
+
+def _terminos(texto):
+    """Palabras y bigramas en minúsculas usados como rasgos"""
+    palabras = [p for p in _patron_palabra.findall(texto.lower()) if len(p) > 1]
+    return palabras + [f"{a} {b}" for a, b in zip(palabras, palabras[1:])]
+
+
+def vectorizar(texto, dimensiones=DIMENSIONES):
+    """Vector TF sublineal hasheado y normalizado (L2)
+
+    Se usa crc32 y no hash() porque debe ser estable entre procesos.
+    """
+    vector = np.zeros(dimensiones, dtype=np.float32)
+    for termino in _terminos(texto):
+        h = zlib.crc32(termino.encode('utf-8'))
+        # El bit alto decide el signo para repartir las colisiones
+        vector[h % dimensiones] += 1.0 if h & 0x80000000 else -1.0
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norma = np.linalg.norm(vector)
+    if norma > 0:
+        vector /= norma
+    return vector.astype(np.float32)
+
+
+class IndiceVectorial:
+    """Matriz de vectores en disco con búsqueda por coseno"""
+
+    def __init__(self, directorio, dimensiones=DIMENSIONES):
+        self.directorio = directorio
+        self.dimensiones = dimensiones
+        self.ruta_vectores = os.path.join(directorio, 'vectores.f32')
+        self.ruta_ids = os.path.join(directorio, 'ids.i64')
+        self.ruta_df = os.path.join(directorio, 'df.npy')
+        self.ruta_lock = os.path.join(directorio, '.lock')
+        os.makedirs(directorio, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._identidad_mapeada = None
+        self._vectores = None
+        self._ids = None
+        self._idf = None
+        self._df_mtime = None
+
+    def agregar(self, ids, textos, omitir_existentes=False):
+        """Vectoriza los textos y los anexa al índice con sus ids de pdf_chunks
+
+        Con `omitir_existentes` no se anexan los ids que ya tienen fila; se
+        comprueba bajo el flock, así una reparación no duplica filas.
+        """
+        if not ids:
+            return
+        matriz = np.vstack([vectorizar(texto, self.dimensiones) for texto in textos])
+
+        # Un flock protege el anexado frente a otros hilos y procesos
+        with open(self.ruta_lock, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if omitir_existentes:
+                    nuevos = ~np.isin(np.asarray(ids, dtype=np.int64), self._ids_indexados())
+                    matriz = matriz[nuevos]
+                    ids = [id_fragmento for id_fragmento, nuevo in zip(ids, nuevos) if nuevo]
+                    if not ids:
+                        return
+                # Primero los vectores y luego los ids: un id siempre tiene su fila completa
+                with open(self.ruta_vectores, 'ab') as f:
+                    f.write(matriz.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                with open(self.ruta_ids, 'ab') as f:
+                    f.write(np.asarray(ids, dtype=np.int64).tobytes())
+
+                df = self._leer_df()
+                df[:-1] += (matriz != 0).sum(axis=0)
+                df[-1] += len(ids)
+                ruta_tmp = self.ruta_df + '.tmp.npy'
+                np.save(ruta_tmp, df)
+                os.replace(ruta_tmp, self.ruta_df)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def buscar(self, texto, k=10):
+        """Devuelve [(id_fragmento, similitud)] de los k fragmentos más parecidos"""
+        vectores, ids, idf = self._mapear()
+        if vectores is None or not len(ids):
+            return []
+
+        consulta = vectorizar(texto, self.dimensiones) * idf
+        norma = np.linalg.norm(consulta)
+        if norma == 0:
+            return []
+        consulta /= norma
+
+        puntuaciones = vectores @ consulta
+        k = min(k, len(puntuaciones))
+        mejores = np.argpartition(-puntuaciones, k - 1)[:k]
+        mejores = mejores[np.argsort(-puntuaciones[mejores])]
+        return [(int(ids[i]), float(puntuaciones[i])) for i in mejores if puntuaciones[i] > 0]
+
+    def _leer_df(self):
+        if os.path.exists(self.ruta_df):
+            return np.load(self.ruta_df)
+        # La última posición guarda el total de fragmentos
+        return np.zeros(self.dimensiones + 1, dtype=np.int64)
+
+    def compactar(self, ids_vigentes, ultimo_id_leido=None, filas_por_bloque=65536):
+        """Reescribe la matriz con solo las filas de `ids_vigentes` y devuelve cuántas quitó
+
+        Las filas con id mayor que `ultimo_id_leido` también se conservan: son
+        fragmentos agregados después de leer `ids_vigentes`. Se recorre por
+        bloques para no cargar la matriz entera en memoria, y los archivos
+        nuevos reemplazan a los anteriores bajo el mismo flock que `agregar`.
+        """
+        vigentes = np.fromiter(ids_vigentes, dtype=np.int64)
+        with open(self.ruta_lock, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(self.ruta_ids):
+                    return 0
+                filas = self._identidad()[0]
+                vectores = np.memmap(self.ruta_vectores, dtype=np.float32, mode='r',
+                                     shape=(filas, self.dimensiones)) if filas else None
+                ids = np.memmap(self.ruta_ids, dtype=np.int64, mode='r', shape=(filas,)) if filas else None
+
+                df = np.zeros(self.dimensiones + 1, dtype=np.int64)
+                quedan = 0
+                ruta_vectores_tmp = self.ruta_vectores + '.tmp'
+                ruta_ids_tmp = self.ruta_ids + '.tmp'
+                with open(ruta_vectores_tmp, 'wb') as f_vectores, open(ruta_ids_tmp, 'wb') as f_ids:
+                    for inicio in range(0, filas, filas_por_bloque):
+                        bloque_ids = np.asarray(ids[inicio:inicio + filas_por_bloque])
+                        mascara = np.isin(bloque_ids, vigentes)
+                        if ultimo_id_leido is not None:
+                            mascara |= bloque_ids > ultimo_id_leido
+                        bloque = np.asarray(vectores[inicio:inicio + filas_por_bloque])[mascara]
+                        f_vectores.write(bloque.tobytes())
+                        f_ids.write(bloque_ids[mascara].tobytes())
+                        df[:-1] += (bloque != 0).sum(axis=0)
+                        quedan += len(bloque)
+                    f_vectores.flush()
+                    os.fsync(f_vectores.fileno())
+                    f_ids.flush()
+                    os.fsync(f_ids.fileno())
+                df[-1] = quedan
+                del vectores, ids
+
+                os.replace(ruta_vectores_tmp, self.ruta_vectores)
+                os.replace(ruta_ids_tmp, self.ruta_ids)
+                ruta_tmp = self.ruta_df + '.tmp.npy'
+                np.save(ruta_tmp, df)
+                os.replace(ruta_tmp, self.ruta_df)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return filas - quedan
+
+    def ids_faltantes(self, ids):
+        """Los ids de `ids` que todavía no tienen fila en la matriz"""
+        ids = np.fromiter(ids, dtype=np.int64)
+        return ids[~np.isin(ids, self._ids_indexados())].tolist()
+
+    def _ids_indexados(self):
+        if not os.path.exists(self.ruta_ids):
+            return np.empty(0, dtype=np.int64)
+        return np.fromfile(self.ruta_ids, dtype=np.int64, count=self._identidad()[0])
+
+    def contar_filas(self):
+        """Filas completas que hay hoy en la matriz"""
+        return self._identidad()[0] if os.path.exists(self.ruta_ids) else 0
+
+    def _identidad(self):
+        """(filas, inodo de la matriz, inodo de los ids): cambia al anexar y al compactar"""
+        info_vectores = os.stat(self.ruta_vectores)
+        info_ids = os.stat(self.ruta_ids)
+        filas = min(info_vectores.st_size // (self.dimensiones * 4), info_ids.st_size // 8)
+        return filas, info_vectores.st_ino, info_ids.st_ino
+
+    def _mapear(self):
+        """Vuelve a mapear los archivos solo cuando crecieron o se compactaron"""
+        if not os.path.exists(self.ruta_ids):
+            return None, None, None
+
+        with self._lock:
+            if self._identidad() != self._identidad_mapeada:
+                # Con el flock compartido no se mapea una matriz a medio reemplazar
+                with open(self.ruta_lock, 'w') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                    try:
+                        identidad = self._identidad()
+                        filas = identidad[0]
+                        if filas:
+                            self._vectores = np.memmap(self.ruta_vectores, dtype=np.float32, mode='r',
+                                                       shape=(filas, self.dimensiones))
+                            self._ids = np.memmap(self.ruta_ids, dtype=np.int64, mode='r', shape=(filas,))
+                        self._identidad_mapeada = identidad
+                    finally:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+
+            if not self._identidad_mapeada[0]:
+                return None, None, None
+
+            df_mtime = os.path.getmtime(self.ruta_df) if os.path.exists(self.ruta_df) else None
+            if self._idf is None or df_mtime != self._df_mtime:
+                df = self._leer_df()
+                total = max(int(df[-1]), 1)
+                self._idf = np.log((1 + total) / (1 + df[:-1])).astype(np.float32) + 1.0
+                self._df_mtime = df_mtime
+
+            return self._vectores, self._ids, self._idf
@@ -0,0 +1,224 @@
+"""Métricas, tiempos por etapa y logging estructurado
+
+Las métricas viven en memoria de cada proceso y se exportan en el formato
+de texto de Prometheus. Con varios workers de gunicorn cada uno responde
+con sus propias series; las que se calculan al exportar (como la cola de
+ingesta) salen de la base de datos y son iguales en todos.
+
+El logging escribe una línea JSON por evento. Los eventos marcados para
+muestrear (los de cada petición) se conservan solo en la proporción
+indicada; las advertencias y errores se registran siempre.
+"""
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Límites de los buckets en segundos, de 5 ms a 1 minuto
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metricas = []
+_metricas_lock = threading.Lock()
+
+
+def _formatear_etiquetas(nombres, valores, **extra):
+    pares = list(zip(nombres, valores)) + list(extra.items())
+    if not pares:
+        return ''
+    texto = ','.join(f'{nombre}="{_escapar(valor)}"' for nombre, valor in pares)
+    return '{' + texto + '}'
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatear_numero(valor):
+    if valor == float('inf'):
+        return '+Inf'
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+        with _metricas_lock:
+            _metricas.append(self)
+
+    def _clave(self, etiquetas):
+        return tuple(str(etiquetas.get(nombre, '')) for nombre in self.etiquetas)
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for clave, valor in series:
+            lineas.extend(self._lineas_serie(clave, valor))
+        return lineas
+
+    def _lineas_serie(self, clave, valor):
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, clave)} {_formatear_numero(valor)}"]
+
+
+class Contador(_Metrica):
+    """Valor que solo crece"""
+    tipo = 'counter'
+
+    def incrementar(self, cantidad=1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._series[clave] = self._series.get(clave, 0) + cantidad
+
+
+class Medidor(_Metrica):
+    """Valor que sube y baja; con `calcular` se obtiene en cada exportación
+
+    `calcular()` devuelve {valores de etiquetas (tupla): valor}.
+    """
+    tipo = 'gauge'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), calcular=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.calcular = calcular
+
+    def fijar(self, valor, **etiquetas):
+        with self._lock:
+            self._series[self._clave(etiquetas)] = valor
+
+    def exportar(self):
+        if self.calcular:
+            try:
+                series = self.calcular()
+            except Exception as e:
+                logging.getLogger(__name__).warning(
+                    'metrica_no_calculada', extra={'campos': {'metrica': self.nombre, 'error': str(e)}})
+                series = {}
+            with self._lock:
+                self._series = {tuple(str(v) for v in clave): valor for clave, valor in series.items()}
+        return super().exportar()
+
+
+class Histograma(_Metrica):
+    """Distribución de observaciones en buckets acumulados, con suma y total"""
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        # Primer bucket cuyo límite cubre el valor; más allá del último solo cuenta en +Inf
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * len(self.buckets), 0.0, 0]
+            if indice < len(self.buckets):
+                serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def _lineas_serie(self, clave, serie):
+        conteos, suma, total = serie
+        lineas = []
+        acumulado = 0
+        for limite, conteo in zip(self.buckets, conteos):
+            acumulado += conteo
+            etiquetas = _formatear_etiquetas(self.etiquetas, clave, le=_formatear_numero(float(limite)))
+            lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+        etiquetas = _formatear_etiquetas(self.etiquetas, clave, le='+Inf')
+        lineas.append(f"{self.nombre}_bucket{etiquetas} {total}")
+        etiquetas = _formatear_etiquetas(self.etiquetas, clave)
+        lineas.append(f"{self.nombre}_sum{etiquetas} {_formatear_numero(suma)}")
+        lineas.append(f"{self.nombre}_count{etiquetas} {total}")
+        return lineas
+
+
+def exportar_metricas():
+    """Todas las métricas registradas en el formato de texto de Prometheus"""
+    with _metricas_lock:
+        metricas = list(_metricas)
+    lineas = []
+    for metrica in metricas:
+        lineas.extend(metrica.exportar())
+    return '\n'.join(lineas) + '\n'
+
+
+class Cronometro:
+    """Mide las etapas de una operación y las observa en un histograma
+
+    Las duraciones quedan además en `duraciones` (en ms) para el log del evento.
+    """
+
+    def __init__(self, histograma=None, **etiquetas):
+        self.histograma = histograma
+        self.etiquetas = etiquetas
+        self.inicio = time.perf_counter()
+        self.duraciones = {}
+
+    @contextmanager
+    def etapa(self, nombre):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nombre, time.perf_counter() - inicio)
+
+    def registrar(self, nombre, segundos):
+        """Suma a la etapa `nombre` una duración medida por fuera del cronómetro"""
+        self.duraciones[nombre] = round(self.duraciones.get(nombre, 0) + segundos * 1000, 2)
+        if self.histograma:
+            self.histograma.observar(segundos, etapa=nombre, **self.etiquetas)
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.inicio
+
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por registro, con los campos pasados en extra={'campos': {...}}"""
+
+    def format(self, registro):
+        datos = {
+            'ts': round(registro.created, 3),
+            'nivel': registro.levelname.lower(),
+            'logger': registro.name,
+            'evento': registro.getMessage(),
+        }
+        datos.update(getattr(registro, 'campos', None) or {})
+        if registro.exc_info:
+            datos['excepcion'] = self.formatException(registro.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class FiltroMuestreo(logging.Filter):
+    """Deja pasar solo una proporción de los registros marcados con muestrear=True"""
+
+    def __init__(self, proporcion):
+        super().__init__()
+        self.proporcion = proporcion
+
+    def filter(self, registro):
+        if registro.levelno >= logging.WARNING or not getattr(registro, 'muestrear', False):
+            return True
+        return random.random() < self.proporcion
+
+
+def configurar_logging(nivel='INFO', muestreo=1.0):
+    """Configura el logger raíz con salida JSON y muestreo de los eventos por petición"""
+    manejador = logging.StreamHandler()
+    manejador.setFormatter(FormatoJSON())
+    manejador.addFilter(FiltroMuestreo(muestreo))
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [manejador]
+    raiz.setLevel(nivel.upper())
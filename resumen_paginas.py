@@ -0,0 +1,140 @@
+"""Resúmenes compactos de cada página y esquema de cada documento
+
+Se calculan una sola vez durante la ingesta, así el contexto del chat se
+arma con textos cortos ya preparados en lugar de recortar el texto completo
+de cada página en cada pregunta. Todo es extractivo y local: títulos
+detectados por la forma de las líneas, palabras clave por frecuencia y las
+oraciones que más palabras clave concentran.
+"""
+import re
+from collections import Counter
+
+# Artículos, preposiciones y verbos comunes que no sirven como palabras clave
+PALABRAS_VACIAS = frozenset('''
+    para pero como cómo sobre entre desde hasta hacia según sino también tanto
+    este esta esto estos estas ese esa eso esos esas aquel aquella aquellos
+    cual cuál cuales cuáles cuando cuándo donde dónde quien quién quienes
+    porque aunque mientras además sólo solo cada todo toda todos todas otro
+    otra otros otras mismo misma mismos mismas muy más menos mucho mucha
+    muchos muchas poco algo alguno alguna algunos algunas ningún ninguna
+    está están estaba estar sido será serán sería tiene tienen tenía tener
+    hace hacen hacer puede pueden poder debe deben haber había hemos han
+    ellos ellas nosotros usted ustedes suyo suya sus nuestro nuestra
+    that this with from have were their there which what when where about
+    page página pág
+'''.split())
+
+_patron_palabra = re.compile(r'[^\W\d_]{4,}')
+_patron_oracion = re.compile(r'(?<=[.!?])\s+')
+_patron_titulo_numerado = re.compile(
+    r'^(?:\d+(?:\.\d+)*\.?\s|[IVXLC]+\.\s|(?:cap[ií]tulo|secci[oó]n|parte|anexo|tema|unidad|chapter|section)\b)',
+    re.IGNORECASE)
+
+LARGO_MAXIMO_TITULO = 80
+
+
+def es_titulo(linea, primera=False):
+    """True si la línea parece un título: numerada, en mayúsculas o la primera y corta"""
+    if len(linea) > LARGO_MAXIMO_TITULO or len(_patron_palabra.findall(linea)) == 0:
+        return False
+    if linea[-1] in '.,;':
+        return False
+    if _patron_titulo_numerado.match(linea):
+        return True
+    letras = [caracter for caracter in linea if caracter.isalpha()]
+    if len(letras) >= 3 and all(caracter.isupper() for caracter in letras):
+        return True
+    return primera and linea[0].isupper() and len(linea.split()) <= 10
+
+
+def _cuerpo(lineas):
+    """Une las líneas en un solo texto, reparando las palabras cortadas con guion"""
+    partes = []
+    for linea in lineas:
+        if partes and partes[-1].endswith('-'):
+            partes[-1] = partes[-1][:-1] + linea
+        else:
+            partes.append(linea)
+    return ' '.join(partes)
+
+
+def _recortar(texto, largo):
+    return texto if len(texto) <= largo else texto[:largo - 1].rstrip() + '…'
+
+
+def resumir_pagina(texto, largo_maximo=300, max_palabras_clave=8, max_titulos=3):
+    """Devuelve {'titulos', 'palabras_clave', 'resumen'} del texto de una página
+
+    `resumen` son las oraciones con más peso de palabras clave, en su orden
+    original y sin pasar de `largo_maximo` caracteres.
+    """
+    lineas = [linea.strip() for linea in (texto or '').splitlines() if linea.strip()]
+    titulos, resto = [], []
+    for posicion, linea in enumerate(lineas):
+        if len(titulos) < max_titulos and es_titulo(linea, primera=posicion == 0):
+            titulos.append(linea)
+        else:
+            resto.append(linea)
+    cuerpo = _cuerpo(resto)
+
+    oraciones = [oracion for oracion in _patron_oracion.split(cuerpo) if len(oracion) >= 20]
+    # Cada oración se separa en palabras una sola vez: sirven para contar y para puntuar
+    palabras_por_oracion = [_patron_palabra.findall(oracion.lower()) for oracion in oraciones]
+    frecuencias = Counter(palabra for palabra in _patron_palabra.findall(' '.join(titulos).lower())
+                          if palabra not in PALABRAS_VACIAS)
+    for palabras in palabras_por_oracion:
+        frecuencias.update(palabra for palabra in palabras if palabra not in PALABRAS_VACIAS)
+    palabras_clave = [palabra for palabra, _ in frecuencias.most_common(max_palabras_clave)]
+
+    puntuaciones = []
+    for posicion, palabras in enumerate(palabras_por_oracion):
+        peso = sum(frecuencias.get(palabra, 0) for palabra in palabras) / (len(palabras) or 1)
+        # Leve preferencia por el comienzo de la página, donde suele estar la idea principal
+        puntuaciones.append((peso * (1.2 if posicion == 0 else 1.0), posicion))
+
+    elegidas = []
+    disponible = largo_maximo
+    for _, posicion in sorted(puntuaciones, reverse=True):
+        oracion = oraciones[posicion]
+        if len(oracion) + 1 > disponible:
+            if not elegidas:
+                # La mejor oración no cabe entera: se recorta y no se agrega otra
+                elegidas.append((posicion, _recortar(oracion, largo_maximo)))
+                break
+            continue
+        elegidas.append((posicion, oracion))
+        disponible -= len(oracion) + 1
+    resumen = ' '.join(oracion for _, oracion in sorted(elegidas))
+    if not resumen:
+        resumen = _recortar(cuerpo, largo_maximo)
+
+    return {'titulos': titulos, 'palabras_clave': palabras_clave, 'resumen': resumen}
+
+
+def esquema_documento(titulos_por_pagina, total_paginas, max_entradas=40):
+    """Lista [(página, título)] del documento sin los encabezados que se repiten en cada página"""
+    repeticiones = Counter(titulo for _, titulo in titulos_por_pagina)
+    limite_repeticiones = max(2, total_paginas // 3)
+    esquema = []
+    for pagina, titulo in titulos_por_pagina:
+        if repeticiones[titulo] > limite_repeticiones:
+            continue
+        if esquema and esquema[-1][1] == titulo:
+            continue
+        esquema.append((pagina, titulo))
+        if len(esquema) >= max_entradas:
+            break
+    return esquema
+
+
+def formatear_esquema(esquema, largo_maximo=600):
+    """Texto de una línea con las entradas del esquema, sin pasar de `largo_maximo`"""
+    entradas = []
+    largo = 0
+    for pagina, titulo in esquema:
+        entrada = f"p. {pagina} {titulo}"
+        if largo + len(entrada) + 2 > largo_maximo:
+            break
+        entradas.append(entrada)
+        largo += len(entrada) + 2
+    return '; '.join(entradas)
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos de la aplicación están en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def aplicacion(tmp_path, monkeypatch):
+    """Módulo app con una base y una carpeta de subidas propias de la prueba
+
+    No reanuda la cola ni arranca el mantenimiento en segundo plano.
+    """
+    monkeypatch.chdir(tmp_path)
+    import app as modulo
+
+    def cerrar_conexion():
+        conn = getattr(modulo._conexiones, 'conn', None)
+        if conn is not None:
+            conn.close()
+            modulo._conexiones.conn = None
+
+    cerrar_conexion()
+    monkeypatch.setitem(modulo.app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(modulo, '_trabajos_reanudados', True)
+    monkeypatch.setattr(modulo, '_indice_vectorial', None)
+    monkeypatch.setattr(modulo, '_cache_imagenes', None)
+    modulo.crear_app()
+    yield modulo
+    cerrar_conexion()
+
+
+@pytest.fixture
+def cliente(aplicacion):
+    return aplicacion.app.test_client()
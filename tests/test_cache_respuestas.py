@@ -0,0 +1,78 @@
+"""Caché de respuestas del modelo: aciertos, fallos, vigencia y desalojo LRU"""
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def c(aplicacion):
+    return aplicacion.get_db().cursor()
+
+
+def contadores(c):
+    c.execute('SELECT nombre, valor FROM cache_estadisticas')
+    return dict(c.fetchall())
+
+
+def claves(c):
+    c.execute('SELECT clave FROM respuestas_cache ORDER BY clave')
+    return [fila['clave'] for fila in c.fetchall()]
+
+
+def usar_en(c, clave, momento):
+    c.execute('UPDATE respuestas_cache SET ultimo_uso = ? WHERE clave = ?', (momento, clave))
+
+
+def test_acierto(aplicacion, c):
+    aplicacion.guardar_respuesta_cacheada(c, 'clave', 'respuesta')
+    assert aplicacion.obtener_respuesta_cacheada(c, 'clave') == 'respuesta'
+    assert contadores(c) == {'aciertos': 1}
+    c.execute("SELECT aciertos FROM respuestas_cache WHERE clave = 'clave'")
+    assert c.fetchone()['aciertos'] == 1
+
+
+def test_fallo(aplicacion, c):
+    aplicacion.guardar_respuesta_cacheada(c, 'clave', 'respuesta')
+    assert aplicacion.obtener_respuesta_cacheada(c, 'otra') is None
+    assert contadores(c) == {'fallos': 1}
+
+
+def test_clave(aplicacion):
+    clave = aplicacion.clave_cache_respuesta('¿Qué es el ÍNDICE?', 'contexto')
+    # Variaciones triviales de la pregunta comparten la entrada
+    assert aplicacion.clave_cache_respuesta('que es el indice', 'contexto') == clave
+    # Otro contexto recuperado es otra entrada
+    assert aplicacion.clave_cache_respuesta('que es el indice', 'contexto nuevo') != clave
+
+
+def test_vencida_no_se_devuelve(aplicacion, c, monkeypatch):
+    aplicacion.guardar_respuesta_cacheada(c, 'vieja', 'respuesta')
+    c.execute("UPDATE respuestas_cache SET creada_en = creada_en - 100 WHERE clave = 'vieja'")
+    monkeypatch.setattr(aplicacion, 'RESPUESTAS_CACHE_TTL', 50)
+    assert aplicacion.obtener_respuesta_cacheada(c, 'vieja') is None
+
+    # Guardar otra entrada limpia las vencidas
+    aplicacion.guardar_respuesta_cacheada(c, 'nueva', 'respuesta')
+    assert claves(c) == ['nueva']
+
+
+def test_desaloja_la_menos_usada(aplicacion, c, monkeypatch):
+    monkeypatch.setattr(aplicacion, 'RESPUESTAS_CACHE_MAX', 2)
+    aplicacion.guardar_respuesta_cacheada(c, 'a', 'respuesta a')
+    aplicacion.guardar_respuesta_cacheada(c, 'b', 'respuesta b')
+    usar_en(c, 'a', 2000)
+    usar_en(c, 'b', 1000)
+
+    aplicacion.guardar_respuesta_cacheada(c, 'c', 'respuesta c')
+    assert claves(c) == ['a', 'c']
+    assert contadores(c) == {'desalojos': 1}
+
+
+def test_escribir_paginas_no_vacia_la_cache(aplicacion, c):
+    aplicacion.guardar_respuesta_cacheada(c, 'clave', 'respuesta')
+    c.execute("INSERT INTO pdf_files (id, filename, file_path) VALUES ('pdf', 'doc.pdf', 'doc.pdf')")
+    c.execute("INSERT INTO pdf_content (id, pdf_id, page_number, text_content) VALUES (?, 'pdf', 1, 'texto')",
+              (str(uuid.uuid4()),))
+    c.execute("UPDATE pdf_content SET text_content = 'otro texto'")
+    c.execute('DELETE FROM pdf_content')
+    assert claves(c) == ['clave']
@@ -0,0 +1,35 @@
+"""Turnos de chat rechazados por falta de lugar en el cupo del modelo"""
+import pytest
+
+
+@pytest.fixture
+def modelo_saturado(aplicacion, monkeypatch):
+    monkeypatch.setattr(aplicacion.limite_llm, 'adquirir', lambda: False)
+
+
+def sesiones(cliente):
+    return [sesion['id'] for sesion in cliente.get('/api/historial').get_json()['sesiones']]
+
+
+@pytest.mark.parametrize('ruta', ['/api/chat', '/api/chat/stream'])
+def test_saturado_no_deja_sesion_nueva_vacia(cliente, modelo_saturado, ruta):
+    respuesta = cliente.post(ruta, json={'mensaje': 'hola', 'idSesion': 'nueva'})
+    assert respuesta.status_code == 429
+    assert respuesta.get_json()['motivo'] == 'llm_saturado'
+    assert sesiones(cliente) == []
+
+
+@pytest.mark.parametrize('ruta', ['/api/chat', '/api/chat/stream'])
+def test_saturado_conserva_sesion_existente(aplicacion, cliente, modelo_saturado, ruta):
+    conn = aplicacion.get_db()
+    conn.execute("INSERT INTO chat_sessions (id, title) VALUES ('vieja', 'vieja')")
+    conn.execute("INSERT INTO messages (id, session_id, role, content) VALUES ('m', 'vieja', 'user', 'antes')")
+    conn.commit()
+
+    respuesta = cliente.post(ruta, json={'mensaje': 'hola', 'idSesion': 'vieja'})
+    assert respuesta.status_code == 429
+    assert sesiones(cliente) == ['vieja']
+    mensajes = cliente.get('/api/historial?idSesion=vieja').get_json()['mensajes']
+    assert [mensaje['content'] for mensaje in mensajes] == ['antes']
+    turno_hasta = conn.execute("SELECT turno_hasta FROM chat_sessions WHERE id = 'vieja'").fetchone()[0]
+    assert turno_hasta is None
@@ -0,0 +1,192 @@
+"""Reintentos, backoff, circuit breaker y cupo del cliente LLM contra el OpenRouter falso"""
+import threading
+import time
+
+import pytest
+
+import cliente_llm
+import fake_openrouter
+from cliente_llm import CircuitoAbierto, CircuitBreaker, ClienteLLM, ErrorLLM, LimiteConcurrencia
+
+MENSAJES = [{'role': 'user', 'content': 'hola'}]
+
+
+@pytest.fixture
+def servidor():
+    servidor, config, url = fake_openrouter.iniciar_servidor()
+    yield config, url
+    servidor.shutdown()
+    servidor.server_close()
+
+
+def crear_cliente(url, **opciones):
+    opciones = {'reintentos': 2, 'backoff_base': 0.01, 'backoff_max': 0.05, 'timeout_total': 10.0,
+                **opciones}
+    return ClienteLLM(url, 'clave-de-prueba', **opciones)
+
+
+def test_respuesta_sin_errores(servidor):
+    config, url = servidor
+    assert crear_cliente(url).completar(MENSAJES, 'modelo') == fake_openrouter.RESPUESTA_POR_DEFECTO
+    assert config.peticiones == 1
+
+
+@pytest.mark.parametrize('codigo', [429, 500, 502, 503, 504])
+def test_reintenta_errores_transitorios(servidor, codigo):
+    config, url = servidor
+    config.encolar_codigos(codigo, codigo)
+    assert crear_cliente(url, reintentos=2).completar(MENSAJES, 'modelo') == fake_openrouter.RESPUESTA_POR_DEFECTO
+    assert config.peticiones == 3
+
+
+def test_agota_los_reintentos(servidor):
+    config, url = servidor
+    config.encolar_codigos(503, 503, 503, 503)
+    with pytest.raises(ErrorLLM) as error:
+        crear_cliente(url, reintentos=2).completar(MENSAJES, 'modelo')
+    assert error.value.status == 503
+    assert config.peticiones == 3
+
+
+def test_no_reintenta_errores_del_cliente(servidor):
+    config, url = servidor
+    config.encolar_codigos(400)
+    cliente = crear_cliente(url, umbral_circuito=1)
+    with pytest.raises(ErrorLLM) as error:
+        cliente.completar(MENSAJES, 'modelo')
+    assert error.value.status == 400
+    assert config.peticiones == 1
+    # Un 4xx no cuenta como fallo de la API
+    assert cliente.circuito.estado == 'cerrado'
+
+
+def test_backoff_exponencial_con_jitter(servidor, monkeypatch):
+    config, url = servidor
+    config.encolar_codigos(503, 503, 503, 503)
+    topes = []
+
+    def uniform(minimo, maximo):
+        topes.append((minimo, maximo))
+        return maximo
+
+    monkeypatch.setattr(cliente_llm.random, 'uniform', uniform)
+    with pytest.raises(ErrorLLM):
+        crear_cliente(url, reintentos=3, backoff_base=0.01, backoff_max=0.03).completar(MENSAJES, 'modelo')
+    # Jitter completo entre 0 y base * 2^intento, acotado por backoff_max
+    assert topes == [(0, 0.01), (0, 0.02), (0, 0.03), (0, 0.03)]
+    assert config.peticiones == 4
+
+
+def test_retry_after_reemplaza_al_backoff(servidor, monkeypatch):
+    config, url = servidor
+    config.retry_after = 0
+    config.encolar_codigos(429)
+    monkeypatch.setattr(cliente_llm.random, 'uniform', lambda *_: pytest.fail('no debía usar backoff'))
+    assert crear_cliente(url).completar(MENSAJES, 'modelo') == fake_openrouter.RESPUESTA_POR_DEFECTO
+    assert config.peticiones == 2
+
+
+def test_no_reintenta_si_supera_el_timeout_total(servidor):
+    config, url = servidor
+    config.retry_after = 5
+    config.encolar_codigos(429, 429)
+    with pytest.raises(ErrorLLM):
+        crear_cliente(url, reintentos=5, timeout_total=1.0).completar(MENSAJES, 'modelo')
+    assert config.peticiones == 1
+
+
+def test_circuito_se_abre_y_falla_rapido(servidor):
+    config, url = servidor
+    config.encolar_codigos(503, 503)
+    cliente = crear_cliente(url, reintentos=0, umbral_circuito=2, enfriamiento_circuito=30.0)
+    for _ in range(2):
+        with pytest.raises(ErrorLLM):
+            cliente.completar(MENSAJES, 'modelo')
+    assert cliente.circuito.estado == 'abierto'
+
+    inicio = time.monotonic()
+    with pytest.raises(CircuitoAbierto):
+        cliente.completar(MENSAJES, 'modelo')
+    assert time.monotonic() - inicio < 0.5
+    # La llamada rechazada no llegó a la API
+    assert config.peticiones == 2
+
+
+def test_circuito_se_recupera_tras_el_enfriamiento(servidor):
+    config, url = servidor
+    config.encolar_codigos(503, 503)
+    cliente = crear_cliente(url, reintentos=0, umbral_circuito=2, enfriamiento_circuito=0.2)
+    for _ in range(2):
+        with pytest.raises(ErrorLLM):
+            cliente.completar(MENSAJES, 'modelo')
+    assert cliente.circuito.estado == 'abierto'
+
+    time.sleep(0.25)
+    assert cliente.circuito.estado == 'semiabierto'
+    assert cliente.completar(MENSAJES, 'modelo') == fake_openrouter.RESPUESTA_POR_DEFECTO
+    assert cliente.circuito.estado == 'cerrado'
+
+
+def test_prueba_fallida_vuelve_a_abrir_el_circuito(servidor):
+    config, url = servidor
+    config.encolar_codigos(503, 503, 503)
+    cliente = crear_cliente(url, reintentos=0, umbral_circuito=2, enfriamiento_circuito=0.2)
+    for _ in range(2):
+        with pytest.raises(ErrorLLM):
+            cliente.completar(MENSAJES, 'modelo')
+
+    time.sleep(0.25)
+    with pytest.raises(ErrorLLM) as error:
+        cliente.completar(MENSAJES, 'modelo')
+    assert not isinstance(error.value, CircuitoAbierto)
+    assert cliente.circuito.estado == 'abierto'
+    with pytest.raises(CircuitoAbierto):
+        cliente.completar(MENSAJES, 'modelo')
+    assert config.peticiones == 3
+
+
+def test_semiabierto_deja_pasar_una_sola_prueba():
+    circuito = CircuitBreaker(umbral=1, enfriamiento=0.0)
+    circuito.registrar_fallo()
+    assert circuito.estado == 'semiabierto'
+    assert circuito.permitir()
+    assert not circuito.permitir()
+    circuito.registrar_exito()
+    assert circuito.estado == 'cerrado'
+    assert circuito.permitir()
+
+
+def test_stream_produce_los_tokens(servidor):
+    _, url = servidor
+    texto = ''.join(crear_cliente(url).completar_stream(MENSAJES, 'modelo'))
+    assert texto.strip() == fake_openrouter.RESPUESTA_POR_DEFECTO
+
+
+def test_limite_rechaza_sin_lugar():
+    limite = LimiteConcurrencia(2)
+    assert limite.adquirir()
+    assert limite.adquirir()
+    assert not limite.adquirir()
+    assert limite.en_curso == 2
+
+    limite.liberar()
+    assert limite.en_curso == 1
+    assert limite.adquirir()
+
+
+def test_limite_espera_un_lugar_antes_de_rechazar():
+    limite = LimiteConcurrencia(1, espera=0.1)
+    assert limite.adquirir()
+    inicio = time.monotonic()
+    assert not limite.adquirir()
+    assert time.monotonic() - inicio >= 0.1
+
+    threading.Timer(0.05, limite.liberar).start()
+    limite.espera = 2.0
+    assert limite.adquirir()
+
+
+def test_limite_cero_no_limita():
+    limite = LimiteConcurrencia(0)
+    assert all(limite.adquirir() for _ in range(50))
+    assert limite.en_curso == 50
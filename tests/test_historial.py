@@ -0,0 +1,127 @@
+"""Paginación por cursor del historial de mensajes y de sesiones"""
+import base64
+
+import pytest
+
+
+def crear_sesion(aplicacion, id_sesion, fechas, actualizada='2024-01-01T00:00:00'):
+    """Crea la sesión con un mensaje por fecha; el id del mensaje es su posición ('m00', 'm01', ...)
+
+    Fuera de la sesión 's' el id lleva delante el de la sesión para no repetirse.
+    """
+    prefijo = '' if id_sesion == 's' else f'{id_sesion}-'
+    conn = aplicacion.get_db()
+    conn.execute('INSERT INTO chat_sessions (id, title, updated_at) VALUES (?, ?, ?)',
+                 (id_sesion, id_sesion, actualizada))
+    conn.executemany('INSERT INTO messages (id, session_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)',
+                     [(f'{prefijo}m{posicion:02d}', id_sesion, 'usuario', f'mensaje {posicion}', fecha)
+                      for posicion, fecha in enumerate(fechas)])
+    conn.commit()
+
+
+def ids(pagina):
+    return [mensaje['id'] for mensaje in pagina['mensajes']]
+
+
+def test_cursor_ida_y_vuelta(aplicacion):
+    cursor = aplicacion.codificar_cursor('2024-01-01T10:00:00', 'id|con|barras')
+    assert aplicacion.decodificar_cursor(cursor) == ('2024-01-01T10:00:00', 'id|con|barras')
+
+
+@pytest.mark.parametrize('cursor', [
+    'no es base64!',
+    base64.urlsafe_b64encode(b'sin separador').decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe|x').decode(),
+])
+def test_cursor_manipulado(aplicacion, cursor):
+    with pytest.raises(ValueError):
+        aplicacion.decodificar_cursor(cursor)
+
+
+@pytest.mark.parametrize('parametro', ['antes', 'despues'])
+def test_cursor_manipulado_responde_400(cliente, parametro):
+    respuesta = cliente.get(f'/api/historial?idSesion=s&{parametro}=basura!')
+    assert respuesta.status_code == 400
+    assert 'Cursor inválido' in respuesta.get_json()['error']
+
+
+def test_limite_invalido_responde_400(cliente):
+    assert cliente.get('/api/historial?limite=0').status_code == 400
+    assert cliente.get('/api/historial?limite=abc').status_code == 400
+
+
+def test_sin_cursor_devuelve_los_mas_recientes(aplicacion):
+    crear_sesion(aplicacion, 's', [f'2024-01-01T10:00:{segundo:02d}' for segundo in range(5)])
+    pagina = aplicacion.pagina_mensajes(aplicacion.get_db().cursor(), 's', 2)
+    assert ids(pagina) == ['m03', 'm04']
+    assert pagina['anterior'] is not None
+    assert pagina['siguiente'] is None
+
+
+def test_recorre_hacia_atras_y_hacia_adelante(aplicacion):
+    crear_sesion(aplicacion, 's', [f'2024-01-01T10:00:{segundo:02d}' for segundo in range(5)])
+    c = aplicacion.get_db().cursor()
+
+    vistos = []
+    pagina = aplicacion.pagina_mensajes(c, 's', 2)
+    while True:
+        vistos = ids(pagina) + vistos
+        if pagina['anterior'] is None:
+            break
+        pagina = aplicacion.pagina_mensajes(c, 's', 2, antes=aplicacion.decodificar_cursor(pagina['anterior']))
+    assert vistos == ['m00', 'm01', 'm02', 'm03', 'm04']
+
+    # Desde la primera página, hacia adelante hasta el final
+    vistos = ids(pagina)
+    while pagina['siguiente'] is not None:
+        pagina = aplicacion.pagina_mensajes(c, 's', 2, despues=aplicacion.decodificar_cursor(pagina['siguiente']))
+        vistos += ids(pagina)
+    assert vistos == ['m00', 'm01', 'm02', 'm03', 'm04']
+
+
+def test_despues_sin_mensajes_anteriores_no_da_cursor_anterior(aplicacion):
+    crear_sesion(aplicacion, 's', ['2024-01-01T10:00:00', '2024-01-01T10:00:01', '2024-01-01T10:00:02'])
+    c = aplicacion.get_db().cursor()
+    # Un cursor anterior al primer mensaje: la página empieza en m00 y no hay nada antes
+    pagina = aplicacion.pagina_mensajes(c, 's', 2, despues=('2024-01-01T09:00:00', ''))
+    assert ids(pagina) == ['m00', 'm01']
+    assert pagina['anterior'] is None
+    assert pagina['siguiente'] is not None
+
+    pagina = aplicacion.pagina_mensajes(c, 's', 2, despues=aplicacion.decodificar_cursor(pagina['siguiente']))
+    assert ids(pagina) == ['m02']
+    assert pagina['anterior'] is not None
+    assert pagina['siguiente'] is None
+    anterior = aplicacion.pagina_mensajes(c, 's', 2, antes=aplicacion.decodificar_cursor(pagina['anterior']))
+    assert ids(anterior) == ['m00', 'm01']
+
+
+def test_fechas_iguales_se_desempatan_por_id(aplicacion):
+    crear_sesion(aplicacion, 's', ['2024-01-01T10:00:00'] * 5)
+    c = aplicacion.get_db().cursor()
+    pagina = aplicacion.pagina_mensajes(c, 's', 2)
+    assert ids(pagina) == ['m03', 'm04']
+    pagina = aplicacion.pagina_mensajes(c, 's', 2, antes=aplicacion.decodificar_cursor(pagina['anterior']))
+    assert ids(pagina) == ['m01', 'm02']
+    pagina = aplicacion.pagina_mensajes(c, 's', 2, antes=aplicacion.decodificar_cursor(pagina['anterior']))
+    assert ids(pagina) == ['m00']
+    assert pagina['anterior'] is None
+    pagina = aplicacion.pagina_mensajes(c, 's', 2, despues=aplicacion.decodificar_cursor(pagina['siguiente']))
+    assert ids(pagina) == ['m01', 'm02']
+
+
+def test_sesion_vacia(aplicacion):
+    pagina = aplicacion.pagina_mensajes(aplicacion.get_db().cursor(), 'no-existe', 10)
+    assert pagina == {'mensajes': [], 'anterior': None, 'siguiente': None}
+
+
+def test_sesiones_paginadas_con_fechas_iguales(aplicacion, cliente):
+    for numero in range(3):
+        crear_sesion(aplicacion, f's{numero}', ['2024-01-01T10:00:00'])
+    vistas = []
+    url = '/api/historial?limite=2'
+    while url:
+        datos = cliente.get(url).get_json()
+        vistas += [sesion['id'] for sesion in datos['sesiones']]
+        url = f"/api/historial?limite=2&antes={datos['siguiente']}" if datos['siguiente'] else None
+    assert vistas == ['s2', 's1', 's0']
@@ -0,0 +1,91 @@
+"""Subida en lote cortada por un error a mitad de la respuesta"""
+import io
+import json
+import os
+import threading
+
+import pytest
+
+
+class IngestaFalsa:
+    """Ingesta en lote que solo anota los trabajos recibidos"""
+
+    def __init__(self):
+        self.recibidos = []
+        self.terminada = threading.Event()
+
+    def __call__(self, trabajos):
+        for trabajo in iter(trabajos.get, None):
+            self.recibidos.append(trabajo)
+        self.terminada.set()
+
+    def trabajos(self):
+        assert self.terminada.wait(5)
+        return self.recibidos
+
+
+@pytest.fixture
+def ingesta(aplicacion, monkeypatch):
+    falsa = IngestaFalsa()
+    monkeypatch.setattr(aplicacion, 'procesar_lote_pdfs', falsa)
+    return falsa
+
+
+def fallar_en_la_busqueda(aplicacion, monkeypatch, numero):
+    """Hace fallar la búsqueda por hash a partir de la llamada `numero`"""
+    original = aplicacion.buscar_pdf_por_hash
+    llamadas = []
+
+    def buscar_pdf_por_hash(c, content_hash):
+        llamadas.append(content_hash)
+        if len(llamadas) >= numero:
+            raise RuntimeError('base no disponible')
+        return original(c, content_hash)
+
+    monkeypatch.setattr(aplicacion, 'buscar_pdf_por_hash', buscar_pdf_por_hash)
+
+
+def subir(cliente, cantidad):
+    archivos = [(io.BytesIO(f'%PDF-1.4 documento {numero}'.encode()), f'doc{numero}.pdf')
+                for numero in range(cantidad)]
+    respuesta = cliente.post('/api/subir-pdfs', data={'archivos': archivos}, content_type='multipart/form-data')
+    assert respuesta.status_code == 200
+    return [json.loads(linea) for linea in respuesta.get_data(as_text=True).splitlines()]
+
+
+def pdfs_en_disco(aplicacion):
+    return sorted(os.listdir(aplicacion.app.config['UPLOAD_FOLDER']))
+
+
+def test_subida_completa(aplicacion, cliente, ingesta):
+    lineas = subir(cliente, 3)
+    assert lineas[-1] == {'fin': True, 'nuevos': 3, 'duplicados': 0, 'errores': 0}
+    assert len(ingesta.trabajos()) == 3
+    assert len(pdfs_en_disco(aplicacion)) == 3
+
+
+def test_error_informa_el_grupo_pendiente(aplicacion, cliente, ingesta, monkeypatch):
+    monkeypatch.setattr(aplicacion, 'ARCHIVOS_POR_GRUPO_LOTE', 10)
+    fallar_en_la_busqueda(aplicacion, monkeypatch, 3)
+
+    lineas = subir(cliente, 4)
+    *archivos, fin = lineas
+    assert fin == {'fin': True, 'error': 'base no disponible', 'nuevos': 0, 'duplicados': 0, 'errores': 2}
+    assert [linea['archivo'] for linea in archivos] == ['doc0.pdf', 'doc1.pdf']
+    assert not any(linea['exito'] for linea in archivos)
+    # Nada quedó registrado, en disco ni en la cola de ingesta
+    assert ingesta.trabajos() == []
+    assert pdfs_en_disco(aplicacion) == []
+    assert aplicacion.get_db().execute('SELECT COUNT(*) FROM pdf_files').fetchone()[0] == 0
+
+
+def test_error_conserva_los_grupos_confirmados(aplicacion, cliente, ingesta, monkeypatch):
+    monkeypatch.setattr(aplicacion, 'ARCHIVOS_POR_GRUPO_LOTE', 1)
+    fallar_en_la_busqueda(aplicacion, monkeypatch, 3)
+
+    *archivos, fin = subir(cliente, 4)
+    assert fin == {'fin': True, 'error': 'base no disponible', 'nuevos': 2, 'duplicados': 0, 'errores': 0}
+    assert [linea['archivo'] for linea in archivos] == ['doc0.pdf', 'doc1.pdf']
+    assert all(linea['exito'] for linea in archivos)
+    assert len(ingesta.trabajos()) == 2
+    assert len(pdfs_en_disco(aplicacion)) == 2
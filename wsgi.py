@@ -1,4 +1,6 @@
-from app import app
+from app import crear_app
+
+app = crear_app()
 
 if __name__ == "__main__":
     app.run()